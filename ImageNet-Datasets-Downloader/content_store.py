@@ -0,0 +1,115 @@
+import os
+import io
+import hashlib
+import sqlite3
+
+import numpy as np
+
+# Content addressed store of the downloaded images, shared by every class and every run.
+# Each image is registered with the sha256 of its bytes and, optionally, a 64 bit difference
+# hash (dHash) of its pixels, so that re-encoded or resized copies of a photo are found too.
+# The store is a sqlite database, every process opens its own connection.
+
+HASH_SIZE = 8
+
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def perceptual_hash(content):
+    # dHash: sign of the horizontal gradients of a 9x8 grayscale thumbnail
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(content))
+    img.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+    pixels = np.asarray(img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    # sqlite integers are signed 64 bit
+    return int(np.packbits(bits).view('>i8')[0])
+
+
+def content_hashes(content, perceptual=False):
+    # (sha256, dHash or None) of an image, to be computed away from the process querying the store
+    dhash = None
+    if perceptual:
+        try:
+            dhash = perceptual_hash(content)
+        except Exception:
+            dhash = None
+    return content_hash(content), dhash
+
+
+class ContentStore():
+    def __init__(self, path, max_distance=-1):
+        # max_distance < 0 disables the perceptual hash, 0 only matches identical dHashes
+        self.path = path
+        self.max_distance = max_distance
+        self.conn = None
+        self.pid = None
+        self.dhashes = np.zeros(0, dtype=np.int64)
+        self.dhash_paths = []
+        self.last_rowid = 0
+
+    def _connection(self):
+        # connections cannot be shared with forked workers
+        if self.conn is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS images '
+                              '(sha256 TEXT PRIMARY KEY, dhash INTEGER, path TEXT, wnid TEXT)')
+            self.pid = os.getpid()
+        return self.conn
+
+    def similar(self, dhash):
+        # path of a registered image whose dHash is within max_distance bits, if any
+        rows = self._connection().execute('SELECT rowid, dhash, path FROM images WHERE rowid > ? AND dhash IS NOT NULL',
+                                          (self.last_rowid,)).fetchall()
+        if rows:
+            self.last_rowid = max(row[0] for row in rows)
+            self.dhashes = np.concatenate([self.dhashes, np.array([row[1] for row in rows], dtype=np.int64)])
+            self.dhash_paths.extend(row[2] for row in rows)
+
+        if len(self.dhashes) == 0:
+            return None
+        xor = np.bitwise_xor(self.dhashes, np.int64(dhash))
+        distances = np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+        best = int(np.argmin(distances))
+        return self.dhash_paths[best] if distances[best] <= self.max_distance else None
+
+    def _other_copy(self, known_path, path):
+        return None if known_path == path and os.path.exists(path) else known_path
+
+    def duplicate_of(self, content, path, wnid='', hashes=None):
+        """Registers the image to be stored at path, unless its content is already known.
+        Returns the path of the known copy, or None when the image is new or is the known copy itself.
+        A known copy that is gone from disk was consumed by an earlier run and still counts as a duplicate.
+        hashes are the content_hashes of the image when they were already computed."""
+        conn = self._connection()
+        sha = hashes[0] if hashes is not None else content_hash(content)
+
+        row = conn.execute('SELECT path FROM images WHERE sha256 = ?', (sha,)).fetchone()
+        if row is not None:
+            return self._other_copy(row[0], path)
+
+        dhash = None
+        if self.max_distance >= 0:
+            dhash = hashes[1] if hashes is not None else content_hashes(content, True)[1]
+            if dhash is not None:
+                similar_path = self.similar(dhash)
+                if similar_path is not None and similar_path != path:
+                    return similar_path
+
+        # another process may register the same content at the same time, the first insert wins
+        cur = conn.execute('INSERT OR IGNORE INTO images (sha256, dhash, path, wnid) VALUES (?, ?, ?, ?)',
+                           (sha, dhash, path, wnid))
+        if cur.rowcount == 0:
+            row = conn.execute('SELECT path FROM images WHERE sha256 = ?', (sha,)).fetchone()
+            return self._other_copy(row[0], path)
+        return None
+
+    def close(self):
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
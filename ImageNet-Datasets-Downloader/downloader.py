@@ -1,17 +1,30 @@
 #!/usr/bin/env python3
 import os
+import io
 import numpy as np
 import requests
 import argparse
 import json
 import time
 import logging
-import csv
 
-from multiprocessing import Pool, Process, Value, Lock
+from multiprocessing import Pool, RawValue
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from metrics import Metrics, MetricsExporter
+from url_store import UrlStore
+from content_store import ContentStore, content_hashes
 
 from requests.exceptions import ConnectionError, ReadTimeout, TooManyRedirects, MissingSchema, InvalidURL
 
+import asyncio
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 parser = argparse.ArgumentParser(description='ImageNet image scraper')
 parser.add_argument('-scrape_only_flickr', default=True, type=lambda x: (str(x).lower() == 'true'))
 parser.add_argument('-number_of_classes', default = 10, type=int)
@@ -22,6 +35,20 @@ parser.add_argument('-class_list', default=[], nargs='*')
 parser.add_argument('-debug', default=False,type=lambda x: (str(x).lower() == 'true'))
 
 parser.add_argument('-multiprocessing_workers', default = 8, type=int)
+parser.add_argument('-engine', default='multiprocessing', choices=['multiprocessing', 'async'])
+parser.add_argument('-async_concurrency', default = 1000, type=int)
+parser.add_argument('-connections_per_host', default = 32, type=int)
+parser.add_argument('-metrics_file', default='', type=str)
+parser.add_argument('-metrics_format', default='jsonl', choices=['jsonl', 'prometheus'])
+parser.add_argument('-metrics_interval', default = 10.0, type=float)
+parser.add_argument('-concurrent_classes', default = 4, type=int)
+parser.add_argument('-overfetch', default = 2.0, type=float)
+parser.add_argument('-url_store', default='', type=str)
+parser.add_argument('-offline', default=False, type=lambda x: (str(x).lower() == 'true'))
+parser.add_argument('-dedup_db', default='', type=str)
+parser.add_argument('-dedup_distance', default=-1, type=int)
+parser.add_argument('-min_size', default = 200, type=int)
+parser.add_argument('-resize', default = 0, type=int)
 
 args, args_other = parser.parse_known_args()
 
@@ -32,10 +59,22 @@ if len(args.data_root) == 0:
     logging.error("-data_root is required to run downloader!")
     exit()
 
+if args.engine == 'async' and aiohttp is None:
+    logging.error("-engine async requires aiohttp (pip install aiohttp)")
+    exit()
+
 if not os.path.isdir(args.data_root):
     logging.error(f'folder {args.data_root} does not exist! please provide existing folder in -data_root arg!')
     exit()
 
+if args.offline and len(args.url_store) == 0:
+    logging.error("-offline requires -url_store")
+    exit()
+
+url_store = UrlStore(args.url_store) if len(args.url_store) > 0 else None
+
+content_store = ContentStore(args.dedup_db, args.dedup_distance) if len(args.dedup_db) > 0 else None
+
 
 IMAGENET_API_WNID_TO_URLS = lambda wnid: f'http://www.image-net.org/api/text/imagenet.synset.geturls?wnid={wnid}'
 
@@ -88,95 +127,18 @@ if not os.path.isdir(imagenet_images_folder):
     os.mkdir(imagenet_images_folder)
 
 
-scraping_stats = dict(
-    all=dict(
-        tried=0,
-        success=0,
-        time_spent=0,
-    ),
-    is_flickr=dict(
-        tried=0,
-        success=0,
-        time_spent=0,
-    ),
-    not_flickr=dict(
-        tried=0,
-        success=0,
-        time_spent=0,
-    )
-)
-
-def add_debug_csv_row(row):
-    with open('stats.csv', "a") as csv_f:
-        csv_writer = csv.writer(csv_f, delimiter=",")
-        csv_writer.writerow(row)
-
-class MultiStats():
-    def __init__(self):
-
-        self.lock = Lock()
-
-        self.stats = dict(
-            all=dict(
-                tried=Value('d', 0),
-                success=Value('d',0),
-                time_spent=Value('d',0),
-            ),
-            is_flickr=dict(
-                tried=Value('d', 0),
-                success=Value('d',0),
-                time_spent=Value('d',0),
-            ),
-            not_flickr=dict(
-                tried=Value('d', 0),
-                success=Value('d', 0),
-                time_spent=Value('d', 0),
-            )
-        )
-    def inc(self, cls, stat, val):
-        with self.lock:
-            self.stats[cls][stat].value += val
-
-    def get(self, cls, stat):
-        with self.lock:
-            ret = self.stats[cls][stat].value
-        return ret
-
-multi_stats = MultiStats()
+metrics = Metrics()
 
-
-if args.debug:
-    row = [
-        "all_tried",
-        "all_success",
-        "all_time_spent",
-        "is_flickr_tried",
-        "is_flickr_success",
-        "is_flickr_time_spent",
-        "not_flickr_tried",
-        "not_flickr_success",
-        "not_flickr_time_spent"
-    ]
-    add_debug_csv_row(row)
-
-def add_stats_to_debug_csv():
-    row = [
-        multi_stats.get('all', 'tried'),
-        multi_stats.get('all', 'success'),
-        multi_stats.get('all', 'time_spent'),
-        multi_stats.get('is_flickr', 'tried'),
-        multi_stats.get('is_flickr', 'success'),
-        multi_stats.get('is_flickr', 'time_spent'),
-        multi_stats.get('not_flickr', 'tried'),
-        multi_stats.get('not_flickr', 'success'),
-        multi_stats.get('not_flickr', 'time_spent'),
-    ]
-    add_debug_csv_row(row)
+metrics_exporter = None
+if len(args.metrics_file) > 0:
+    metrics_exporter = MetricsExporter(args.metrics_file, args.metrics_format, args.metrics_interval)
+elif args.debug:
+    metrics_exporter = MetricsExporter('stats.jsonl', 'jsonl', args.metrics_interval)
 
 def print_stats(cls, print_func):
 
-    actual_all_time_spent = time.time() - scraping_t_start.value
-    processes_all_time_spent = multi_stats.get('all', 'time_spent')
+    actual_all_time_spent = time.time() - metrics.started
+    processes_all_time_spent = metrics.get('all', 'time_spent')
 
     if processes_all_time_spent == 0:
         actual_processes_ratio = 1.0
@@ -186,81 +148,156 @@ def print_stats(cls, print_func):
     #print(f"actual all time: {actual_all_time_spent} proc all time {processes_all_time_spent}")
 
     print_func(f'STATS For class {cls}:')
-    print_func(f' tried {multi_stats.get(cls, "tried")} urls with'
-               f' {multi_stats.get(cls, "success")} successes')
+    print_func(f' tried {metrics.get(cls, "tried")} urls with'
+               f' {metrics.get(cls, "success")} successes')
 
-    if multi_stats.get(cls, "tried") > 0:
-        print_func(f'{100.0 * multi_stats.get(cls, "success")/multi_stats.get(cls, "tried")}% success rate for {cls} urls ')
-    if multi_stats.get(cls, "success") > 0:
-        print_func(f'{multi_stats.get(cls,"time_spent") * actual_processes_ratio / multi_stats.get(cls,"success")} seconds spent per {cls} succesful image download')
+    if metrics.get(cls, "tried") > 0:
+        print_func(f'{100.0 * metrics.get(cls, "success")/metrics.get(cls, "tried")}% success rate for {cls} urls ')
+    if metrics.get(cls, "success") > 0:
+        print_func(f'{metrics.get(cls,"time_spent") * actual_processes_ratio / metrics.get(cls,"success")} seconds spent per {cls} succesful image download')
 
 
-
-lock = Lock()
-url_tries = Value('d', 0)
-scraping_t_start = Value('d', time.time())
+# written by the main process only, workers just read it to skip work once the class is complete
 class_folder = ''
-class_images = Value('d', 0)
+class_images = RawValue('d', 0)
 
-def get_image(img_url):
+def url_class(img_url):
+    if 'flickr' in img_url:
+        return 'is_flickr'
+    return 'not_flickr'
+
+# an attempt is reported by the workers as ( host class, seconds spent, status ),
+# only the main process aggregates them
+def record_attempt(cls, t_spent, status):
+    if status not in ('success', 'failure', 'duplicate'):
+        logging.error(f'No such status {status}!!')
+        exit()
 
-    #print(f'Processing {img_url}')
+    metrics.observe(cls, t_spent, status)
+    if status == 'success':
+        logging.debug(f'Scraping stats')
+        print_stats('is_flickr', logging.debug)
+        print_stats('not_flickr', logging.debug)
+        print_stats('all', logging.debug)
 
-    #time.sleep(3)
+    if metrics.get('all', 'tried') % 250 == 0:
+        print(f'\nScraping stats:')
+        print_stats('is_flickr', print)
+        print_stats('not_flickr', print)
+        print_stats('all', print)
 
-    if len(img_url) <= 1:
-        return
+    if metrics_exporter is not None:
+        metrics_exporter.maybe_export(metrics)
 
+# cheap checks of the response, returns the file name to save the image under or None
+def check_response(img_url, headers, content):
+    if not 'content-type' in headers:
+        return None
 
-    cls_imgs = 0
-    with lock:
-        cls_imgs = class_images.value
+    if not 'image' in headers['content-type']:
+        logging.debug("Not an image")
+        return None
+    elif not 'jpeg' in headers['content-type']:
+        logging.debug("Not a supported image (JPEG)")
+        return None
 
-    if cls_imgs >= args.images_per_class:
-        return
+    if (len(content) < 1000):
+        return None
 
-    logging.debug(img_url)
+    logging.debug(headers['content-type'])
+    logging.debug(f'image size {len(content)}')
 
-    cls = ''
+    img_name = img_url.split('/')[-1]
+    img_name = img_name.split("?")[0]
 
-    if 'flickr' in img_url:
-        cls = 'is_flickr'
-    else:
-        cls = 'not_flickr'
-        if args.scrape_only_flickr:
-            return
+    if (len(img_name) <= 1):
+        return None
 
-    t_start = time.time()
+    return img_name
 
-    def finish(status):
-        t_spent = time.time() - t_start
-        multi_stats.inc(cls, 'time_spent', t_spent)
-        multi_stats.inc('all', 'time_spent', t_spent)
+# decode the image from the response buffer, so that broken, non JPEG or too small images
+# never reach the disk. returns the bytes to write (resized if resize > 0) or None
+def validate_image(content, min_size=0, resize=0):
+    try:
+        img = Image.open(io.BytesIO(content))
+        if img.format != 'JPEG' or min(img.size) < min_size:
+            return None
+        if resize > 0:
+            #   let the JPEG decoder downscale by a power of two while decoding
+            img.draft('RGB', (resize, resize))
+        img.load()
+    except (IOError, SyntaxError, ValueError, Image.DecompressionBombError):
+        return None
+
+    if resize <= 0:
+        return content
+
+    buffer = io.BytesIO()
+    img.convert('RGB').resize((resize, resize), Image.BICUBIC).save(buffer, 'JPEG', quality=95)
+    return buffer.getvalue()
+
+# validate_image followed by the content hashes the duplicate lookup needs, both decode the image
+# so the async engine runs them together in the executor. returns (bytes to write, hashes) or None
+def validate_and_hash(content, min_size=0, resize=0, dedup=False, perceptual=False):
+    content = validate_image(content, min_size, resize)
+    if content is None:
+        return None
+    return content, (content_hashes(content, perceptual) if dedup else None)
+
+def write_image(img_url, content, folder, img_name, hashes=None):
+    img_file_path = os.path.join(folder, img_name)
+
+    #   the same photo is often listed under several urls and classes
+    if content_store is not None:
+        known_path = content_store.duplicate_of(content, os.path.abspath(img_file_path), os.path.basename(folder),
+                                                hashes)
+        if known_path is not None:
+            logging.debug(f'{img_url} is a duplicate of {known_path}')
+            return 'duplicate'
 
-        multi_stats.inc(cls,'tried', 1)
-        multi_stats.inc('all', 'tried', 1)
+    logging.debug(f'Saving image in {img_file_path}')
 
-        if status == 'success':
-            multi_stats.inc(cls,'success', 1)
-            multi_stats.inc('all', 'success', 1)
+    #   write under a temporary name, so that readers never see a partial image
+    with open(img_file_path + '.part', 'wb') as img_f:
+        img_f.write(content)
+    os.replace(img_file_path + '.part', img_file_path)
 
-        elif status == 'failure':
-            pass
-        else:
-            logging.error(f'No such status {status}!!')
-            exit()
+    return 'success'
+
+def save_image(img_url, headers, content, folder):
+    img_name = check_response(img_url, headers, content)
+    if img_name is None:
+        return 'failure'
+
+    content = validate_image(content, args.min_size, args.resize)
+    if content is None:
+        logging.debug(f"Invalid or too small image {img_url}")
+        return 'failure'
+
+    return write_image(img_url, content, folder, img_name)
+
+def get_image(img_url):
+
+    #print(f'Processing {img_url}')
+
+    #time.sleep(3)
+
+    if len(img_url) <= 1:
+        return
+
+    if class_images.value >= args.images_per_class:
+        return
+
+    logging.debug(img_url)
+
+    cls = url_class(img_url)
+    if cls == 'not_flickr' and args.scrape_only_flickr:
         return
 
+    t_start = time.time()
 
-    with lock:
-        url_tries.value += 1
-        if url_tries.value % 250 == 0:
-            print(f'\nScraping stats:')
-            print_stats('is_flickr', print)
-            print_stats('not_flickr', print)
-            print_stats('all', print)
-            if args.debug:
-                add_stats_to_debug_csv()
+    def finish(status):
+        return cls, time.time() - t_start, status
 
     try:
         img_resp = requests.get(img_url, timeout = 1)
@@ -278,68 +315,156 @@ def get_image(img_url):
     except InvalidURL:
         return finish('failure')
 
-    if not 'content-type' in img_resp.headers:
-        return finish('failure')
-
-    if not 'image' in img_resp.headers['content-type']:
-        logging.debug("Not an image")
-        return finish('failure')
-    elif not 'jpeg' in img_resp.headers['content-type']:
-        logging.debug("Not a supported image (JPEG)")
-        return finish('failure')
-
-    if (len(img_resp.content) < 1000):
-        return finish('failure')
+    return finish(save_image(img_url, img_resp.headers, img_resp.content, class_folder))
 
-    logging.debug(img_resp.headers['content-type'])
-    logging.debug(f'image size {len(img_resp.content)}')
+def collect_attempt(attempt):
+    if attempt is None:
+        return
+    record_attempt(*attempt)
+    if attempt[2] == 'success':
+        class_images.value += 1
 
-    img_name = img_url.split('/')[-1]
-    img_name = img_name.split("?")[0]
 
-    if (len(img_name) <= 1):
-        return finish('failure')
+#   asyncio engine : a single process keeps thousands of requests in flight,
+#   reusing keep-alive connections from a per-host pool
+async def get_image_async(session, semaphore, executor, img_url, folder, class_counter):
 
-    img_file_path = os.path.join(class_folder, img_name)
-    logging.debug(f'Saving image in {img_file_path}')
+    cls = url_class(img_url)
 
-    with open(img_file_path, 'wb') as img_f:
-        img_f.write(img_resp.content)
+    async with semaphore:
+        if class_counter[0] >= args.images_per_class:
+            return
 
-        with lock:
-            class_images.value += 1
+        logging.debug(img_url)
+
+        t_start = time.time()
+
+        try:
+            async with session.get(img_url) as img_resp:
+                content = await img_resp.read()
+                headers = img_resp.headers
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.debug(f"{type(e).__name__} for url {img_url}")
+            return record_attempt(cls, time.time() - t_start, 'failure')
+
+    #   another request may have completed the class in the meantime
+    if class_counter[0] >= args.images_per_class:
+        return record_attempt(cls, time.time() - t_start, 'failure')
+
+    #   decoding, resizing and hashing would stall the event loop, they run in the executor processes
+    #   only the lookup of the hashes in the content store is left to the loop
+    img_name = check_response(img_url, headers, content)
+    validated = None
+    if img_name is not None:
+        validated = await asyncio.get_running_loop().run_in_executor(
+            executor, validate_and_hash, content, args.min_size, args.resize,
+            content_store is not None, args.dedup_distance >= 0)
+    if validated is None:
+        return record_attempt(cls, time.time() - t_start, 'failure')
+    content, hashes = validated
+
+    #   and again while the executor was validating, nothing else runs until the counter is updated
+    if class_counter[0] >= args.images_per_class:
+        return record_attempt(cls, time.time() - t_start, 'failure')
+
+    status = write_image(img_url, content, folder, img_name, hashes)
+    if status == 'success':
+        class_counter[0] += 1
+    return record_attempt(cls, time.time() - t_start, status)
+
+async def scrape_class_async(session, semaphore, executor, class_semaphore, class_wnid):
+
+    async with class_semaphore:
+        loop = asyncio.get_running_loop()
+        folder, urls = await loop.run_in_executor(None, get_class_urls, class_wnid)
+        urls = iter([ url for url in urls
+                      if len(url) > 1 and not (args.scrape_only_flickr and url_class(url) == 'not_flickr') ])
+
+        #   only keep as many requests in flight as needed to reach the quota,
+        #   assuming roughly 1 / overfetch of them succeed
+        class_counter = [0]
+        in_flight = set()
+        while class_counter[0] < args.images_per_class:
+            needed = args.images_per_class - class_counter[0]
+            target = min(args.async_concurrency, int(needed * args.overfetch + 0.999))
+            while len(in_flight) < target:
+                url = next(urls, None)
+                if url is None:
+                    break
+                in_flight.add(asyncio.ensure_future(get_image_async(session, semaphore, executor, url, folder, class_counter)))
+            if not in_flight:
+                break
+            _, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+
+        #   the quota is reached, whatever is still running is wasted work
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+async def scrape_classes_async(classes):
+
+    connector = aiohttp.TCPConnector(limit=args.async_concurrency,
+                                     limit_per_host=args.connections_per_host,
+                                     ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(sock_connect=1, sock_read=1)
+    semaphore = asyncio.Semaphore(args.async_concurrency)
+    class_semaphore = asyncio.Semaphore(args.concurrent_classes)
+
+    print(f"Async requests in flight: {args.async_concurrency}, classes in parallel: {args.concurrent_classes}")
+    with ProcessPoolExecutor(max_workers=args.multiprocessing_workers) as executor:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await asyncio.gather(*[ scrape_class_async(session, semaphore, executor, class_semaphore, class_wnid)
+                                    for class_wnid in classes ])
+
+def get_class_urls(class_wnid):
 
-        logging.debug(f'Scraping stats')
-        print_stats('is_flickr', logging.debug)
-        print_stats('not_flickr', logging.debug)
-        print_stats('all', logging.debug)
+    class_name = class_info_dict[class_wnid]["class_name"]
+    print(f'Scraping images for class \"{class_name}\"')
 
-        return finish('success')
+    folder = os.path.join(imagenet_images_folder, class_name)
+    if not os.path.exists(folder):
+        os.mkdir(folder)
 
+    urls = url_store.get(class_wnid) if url_store is not None else None
+    if urls is not None:
+        return folder, urls
 
-for class_wnid in classes_to_scrape:
+    if args.offline:
+        logging.error(f'Class {class_wnid} not found in url store {args.url_store}')
+        return folder, []
 
-    class_name = class_info_dict[class_wnid]["class_name"]
-    print(f'Scraping images for class \"{class_name}\"')
     url_urls = IMAGENET_API_WNID_TO_URLS(class_wnid)
 
     time.sleep(0.05)
     resp = requests.get(url_urls)
 
-    class_folder = os.path.join(imagenet_images_folder, class_name)
-    if not os.path.exists(class_folder):
-        os.mkdir(class_folder)
+    urls = [url.decode('utf-8') for url in resp.content.splitlines()]
+    return folder, urls
+
 
-    class_images.value = 0
+if args.engine == 'async':
+    asyncio.run(scrape_classes_async(classes_to_scrape))
+else:
+    for class_wnid in classes_to_scrape:
 
-    urls = [url.decode('utf-8') for url in resp.content.splitlines()]
+        class_folder, urls = get_class_urls(class_wnid)
 
-    if os.name == 'nt':
-        print("Windows does not support multiprocessing in python. \
-            Fallback to single thread work.")
-        for url in urls:
-            get_image(url)
-    else:
-        print(f"Multiprocessing workers: {args.multiprocessing_workers}")
-        with Pool(processes=args.multiprocessing_workers) as p:
-            p.map(get_image,urls)
+        class_images.value = 0
+
+        if os.name == 'nt':
+            print("Windows does not support multiprocessing in python. \
+                Fallback to single thread work.")
+            for url in urls:
+                collect_attempt(get_image(url))
+        else:
+            print(f"Multiprocessing workers: {args.multiprocessing_workers}")
+            #   leaving the pool terminates the workers, which cancels the requests
+            #   still in flight once the class quota is reached
+            with Pool(processes=args.multiprocessing_workers) as p:
+                for attempt in p.imap_unordered(get_image, urls):
+                    collect_attempt(attempt)
+                    if class_images.value >= args.images_per_class:
+                        break
+
+if metrics_exporter is not None:
+    metrics_exporter.export(metrics)
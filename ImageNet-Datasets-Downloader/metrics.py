@@ -0,0 +1,87 @@
+import json
+import os
+import time
+
+# Request metrics of the downloader, kept per host class (is_flickr / not_flickr / all).
+# A Metrics object is only ever touched by one process: workers report their attempts
+# back to the main process, which aggregates them here without any lock.
+
+HOST_CLASSES = ['all', 'is_flickr', 'not_flickr']
+
+# upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+
+METRIC_PREFIX = 'imagenet_downloader'
+
+
+class Metrics():
+    def __init__(self):
+        self.started = time.time()
+        self.stats = {cls: dict(tried=0, success=0, duplicate=0, time_spent=0.0,
+                                buckets=[0] * len(LATENCY_BUCKETS))
+                      for cls in HOST_CLASSES}
+
+    def observe(self, cls, t_spent, status):
+        for c in (cls, 'all'):
+            stats = self.stats[c]
+            stats['tried'] += 1
+            stats['time_spent'] += t_spent
+            if status in ('success', 'duplicate'):
+                stats[status] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if t_spent <= bound:
+                    stats['buckets'][i] += 1
+                    break
+
+    def get(self, cls, stat):
+        return self.stats[cls][stat]
+
+    def snapshot(self):
+        return dict(time=time.time(), uptime=time.time() - self.started,
+                    stats={cls: dict(stats, buckets=list(stats['buckets'])) for cls, stats in self.stats.items()})
+
+    def to_prometheus(self):
+        lines = [f'# TYPE {METRIC_PREFIX}_requests_total counter']
+        for cls in HOST_CLASSES:
+            stats = self.stats[cls]
+            lines.append(f'{METRIC_PREFIX}_requests_total{{host_class="{cls}",status="success"}} {stats["success"]}')
+            lines.append(f'{METRIC_PREFIX}_requests_total{{host_class="{cls}",status="duplicate"}} {stats["duplicate"]}')
+            lines.append(f'{METRIC_PREFIX}_requests_total{{host_class="{cls}",status="failure"}} {stats["tried"] - stats["success"] - stats["duplicate"]}')
+
+        lines.append(f'# TYPE {METRIC_PREFIX}_request_seconds histogram')
+        for cls in HOST_CLASSES:
+            stats = self.stats[cls]
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{METRIC_PREFIX}_request_seconds_bucket{{host_class="{cls}",le="{le}"}} {cumulative}')
+            lines.append(f'{METRIC_PREFIX}_request_seconds_sum{{host_class="{cls}"}} {stats["time_spent"]}')
+            lines.append(f'{METRIC_PREFIX}_request_seconds_count{{host_class="{cls}"}} {stats["tried"]}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter():
+    """Periodically writes Metrics as a Prometheus text file (replaced atomically,
+    suitable for the node_exporter textfile collector) or appends JSON lines."""
+
+    def __init__(self, path, fmt='jsonl', interval=10.0):
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.last_export = 0.0
+
+    def maybe_export(self, metrics):
+        if time.time() - self.last_export >= self.interval:
+            self.export(metrics)
+
+    def export(self, metrics):
+        self.last_export = time.time()
+        if self.fmt == 'prometheus':
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(metrics.to_prometheus())
+            os.replace(tmp_path, self.path)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(metrics.snapshot()) + '\n')
@@ -1,58 +1,172 @@
 import os
-import requests
 import csv
-import codecs
-import matplotlib.pyplot as plt
 import json
+import mmap
+import argparse
+from multiprocessing import Pool
+
+from url_store import write_index, CODEC_RAW, INDEX_FILENAME
 
-DATA_ROOT = '/Users/martinsf/ai/deep_learning_projects/data'
 URL_WORDNET = 'http://image-net.org/archive/words.txt'
 IMAGENET_API_WNID_TO_URLS = lambda wnid: f'http://www.image-net.org/api/text/imagenet.synset.geturls?wnid={wnid}'
 
 current_folder = os.path.dirname(os.path.realpath(__file__))
 
-wordnet_filename = URL_WORDNET.split('/')[-1]
-wordnet_file_path = os.path.join(current_folder, wordnet_filename)
-print(wordnet_file_path)
-if not os.path.exists(wordnet_file_path):
+parser = argparse.ArgumentParser(description='ImageNet class stats')
+# Downloaded from http://image-net.org/imagenet_data/urls/imagenet_fall11_urls.tgz
+parser.add_argument('-url_list', default='/Users/martinsf/ai/datasets/imagenet/fall11_urls.txt', type=str)
+parser.add_argument('-url_index', default='', type=str,
+                    help='folder where to write the per class offset index of url_list (see url_store.py)')
+parser.add_argument('-workers', default=os.cpu_count(), type=int)
+parser.add_argument('-plot', default=False, type=lambda x: (str(x).lower() == 'true'))
+
+
+def download_wordnet():
+    wordnet_filename = URL_WORDNET.split('/')[-1]
+    wordnet_file_path = os.path.join(current_folder, wordnet_filename)
+    print(wordnet_file_path)
+    if not os.path.exists(wordnet_file_path):
+        import requests
+
+        print(f'Downloading {URL_WORDNET}')
+        resp = requests.get(URL_WORDNET)
+
+        with open(wordnet_file_path, "wb") as file:
+            file.write(resp.content)
+
+    return wordnet_file_path
+
+
+def chunk_ranges(path, n_chunks):
+    # byte ranges of about equal size, each ending right after a newline
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = 0
+        for i in range(1, n_chunks + 1):
+            end = size if i == n_chunks else mm.find(b'\n', max(start, size * i // n_chunks)) + 1
+            if end <= 0:
+                end = size
+            if end > start:
+                ranges.append((start, end))
+            start = end
+            if start >= size:
+                break
+        mm.close()
+    return ranges
+
+
+def parse_chunk(task):
+    # count urls and flickr urls per class in [start, end) of the url list, and collect the
+    # byte ranges (start, end, url count) of the runs of consecutive lines of every class
+    path, start, end = task
+    counts = dict()
+    runs = []
+
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        run_wnid, run_start, run_count = None, start, 0
+        pos = start
+        while pos < end:
+            eol = mm.find(b'\n', pos, end)
+            eol = end if eol < 0 else eol + 1
+            line = mm[pos:eol]
+
+            tab = line.find(b'\t')
+            if tab >= 0:
+                wnid = line[:tab].split(b'_', 1)[0]
+                if wnid != run_wnid:
+                    if run_wnid is not None:
+                        runs.append((run_wnid, run_start, pos, run_count))
+                    run_wnid, run_start, run_count = wnid, pos, 0
+                run_count += 1
+
+                class_counts = counts.get(wnid)
+                if class_counts is None:
+                    class_counts = counts[wnid] = [0, 0]
+                class_counts[0] += 1
+                if b'flickr' in line[tab:]:
+                    class_counts[1] += 1
+            pos = eol
+
+        if run_wnid is not None:
+            runs.append((run_wnid, run_start, end, run_count))
+        mm.close()
+
+    return counts, runs
+
+
+def parse_url_list(path, workers):
+    img_url_dict = dict()
+    runs = []
+
+    with Pool(max(workers, 1)) as pool:
+        tasks = [(path, start, end) for start, end in chunk_ranges(path, max(workers, 1) * 4)]
+        for counts, chunk_runs in pool.imap(parse_chunk, tasks):
+            for wnid, (urls, flickr_urls) in counts.items():
+                wnid = wnid.decode('ascii', errors='ignore')
+                if not wnid in img_url_dict:
+                    img_url_dict[wnid] = dict(urls = 0, flickr_urls = 0)
+                img_url_dict[wnid]['urls'] += urls
+                img_url_dict[wnid]['flickr_urls'] += flickr_urls
+
+            for wnid, start, end, count in chunk_runs:
+                wnid = wnid.decode('ascii', errors='ignore')
+                # a run cut by a chunk boundary continues in the next chunk
+                if runs and runs[-1][0] == wnid and runs[-1][1] + runs[-1][2] == start:
+                    prev = runs[-1]
+                    runs[-1] = (wnid, prev[1], end - prev[1], prev[3] + count)
+                else:
+                    runs.append((wnid, start, end - start, count))
+
+    return img_url_dict, runs
+
+
+def plot_stats(total_url_counts, flickr_url_counts):
+    import matplotlib.pyplot as plt
 
-    print(f'Downloading {URL_WORDNET}')
-    resp = requests.get(URL_WORDNET)
+    fig, axs = plt.subplots(3,1)
+    plt.style.use('seaborn')
 
-    with open(wordnet_file_path, "wb") as file:
-        file.write(resp.content)
-        file.close()
+    plt.subplots_adjust(hspace = 0.5)
 
-# Downloaded from http://image-net.org/imagenet_data/urls/imagenet_fall11_urls.tgz
-url_list_filepath = '/Users/martinsf/ai/datasets/imagenet/fall11_urls.txt'
-img_url_dict = dict()
+    axs[0].hist(total_url_counts, range=(500,2000), bins=50, rwidth=0.8)
+    axs[0].set_title('All ImageNet urls')
+    axs[0].set_xticks([x for x in range(500,2000,150)])
+    axs[0].set_xlabel("Images per class")
+    axs[0].set_ylabel("Number of classes")
+
+    axs[1].set_title('Flickr ImageNet urls')
+    axs[1].hist(flickr_url_counts, range=(500,2000), bins=50, rwidth=0.8)
+    axs[1].set_xticks([x for x in range(500,2000,150)])
+    axs[1].set_xlabel("Images per class")
+    axs[1].set_ylabel("Number of classes")
+
+    axs[2].set_title('Flickr ImageNet urls')
+    axs[2].hist(flickr_url_counts, range=(500,2000), bins=50, rwidth=0.8, cumulative=-1)
+    axs[2].set_xticks([x for x in range(500,2000,150)])
+    axs[2].set_xlabel("Images per class")
+    axs[2].set_ylabel("Number of classes")
+
+    plt.show()
 
-total_urls = 0
-flickr_urls = 0
 
-#Go trough the urls list and count urls per class and flickr_urls per class, store the info in csv
-with codecs.open(url_list_filepath, 'r', encoding='utf-8', errors='ignore') as f:
-    it = 0
-    for line  in f:
-        it += 1
-        if it % 10000 == 0:
-            print(it)
-        row = line.split('\t')
+if __name__ == '__main__':
+    args = parser.parse_args()
 
-        if (len(row) != 2):
-            continue
-        id = row[0].split('_')[0]
-        url = row[1]
+    wordnet_file_path = download_wordnet()
 
-        if not id in img_url_dict:
-            img_url_dict[id] = dict(urls = 0, flickr_urls = 0)
+    #Go trough the urls list and count urls per class and flickr_urls per class, store the info in csv
+    img_url_dict, runs = parse_url_list(args.url_list, args.workers)
 
-        img_url_dict[id]['urls'] += 1
-        total_urls += 1
-        if 'flickr' in url:
-            flickr_urls += 1
-            img_url_dict[id]['flickr_urls'] += 1
+    total_urls = sum(val['urls'] for val in img_url_dict.values())
+    flickr_urls = sum(val['flickr_urls'] for val in img_url_dict.values())
 
+    if len(args.url_index) > 0:
+        os.makedirs(args.url_index, exist_ok=True)
+        write_index(os.path.join(args.url_index, INDEX_FILENAME), runs, CODEC_RAW, os.path.abspath(args.url_list))
+        print(f'Wrote offset index of {len(img_url_dict)} classes to {args.url_index}')
 
     wnid_to_class_dict = dict()
     with open(wordnet_file_path, "r") as word_list_file:
@@ -65,7 +179,6 @@ with codecs.open(url_list_filepath, 'r', encoding='utf-8', errors='ignore') as f
     class_info_json_filename = 'imagenet_class_info.json'
     class_info_json_filepath = os.path.join(current_folder, class_info_json_filename)
 
-    img_counts = []
     total_url_counts = []
     flickr_url_counts = []
 
@@ -81,40 +194,15 @@ with codecs.open(url_list_filepath, 'r', encoding='utf-8', errors='ignore') as f
                 flickr_img_url_count = val['flickr_urls'],
                 class_name = wnid_to_class_dict[key].split(',')[0]
             )
-            print(f'{wnid_to_class_dict[key]} {len(val)}')
             total_url_counts.append(val['urls'])
             csv_writer.writerow([key, wnid_to_class_dict[key].split(',')[0], val['urls'], val["flickr_urls"]])
 
             flickr_url_counts.append(val['flickr_urls'])
 
-
     with open(class_info_json_filepath,"w") as class_info_json_f:
         json.dump(class_info_dict, class_info_json_f)
-        csv_writer = csv.writer(class_info_json_f, delimiter=';')
 
     print(f'In total there are {total_urls} img urls and {flickr_urls} flickr urls')
 
-    fig, axs = plt.subplots(3,1)
-    plt.style.use('seaborn')
-
-    plt.subplots_adjust(hspace = 0.5)
-
-    axs[0].hist(total_url_counts, range=(500,2000), bins=50, rwidth=0.8)
-    axs[0].set_title('All ImageNet urls')
-    axs[0].set_xticks([x for x in range(500,2000,150)])
-    axs[0].set_xlabel("Images per class")
-    axs[0].set_ylabel("Number of classes")
-
-    axs[1].set_title('Flickr ImageNet urls')
-    axs[1].hist(flickr_url_counts, range=(500,2000), bins=50, rwidth=0.8)
-    axs[1].set_xticks([x for x in range(500,2000,150)])
-    axs[1].set_xlabel("Images per class")
-    axs[1].set_ylabel("Number of classes")
-
-    axs[2].set_title('Flickr ImageNet urls')
-    axs[2].hist(flickr_url_counts, range=(500,2000), bins=50, rwidth=0.8, cumulative=-1)
-    axs[2].set_xticks([x for x in range(500,2000,150)])
-    axs[2].set_xlabel("Images per class")
-    axs[2].set_ylabel("Number of classes")
-
-    plt.show()
\ No newline at end of file
+    if args.plot:
+        plot_stats(total_url_counts, flickr_url_counts)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+import os
+import mmap
+import zlib
+import struct
+import argparse
+import json
+import time
+
+# Local store of the image URL lists of every WNID, so that the downloader does not need
+# the ImageNet API to discover URLs.
+#
+# A store is an index file and a data file:
+#   urls.idx : header, then fixed size records (wnid, offset, length, url count) sorted by wnid
+#   urls.dat : zlib compressed blobs of newline separated URLs ('z' codec)
+# The index can also point into an uncompressed fall11_urls.txt dump ('r' codec), where each
+# record covers the lines 'wnid_imgid<TAB>url' of one WNID (see prepare_stats.py).
+# Both files are memory mapped, a lookup is a binary search over the index records.
+
+IMAGENET_API_WNID_TO_URLS = lambda wnid: f'http://www.image-net.org/api/text/imagenet.synset.geturls?wnid={wnid}'
+
+INDEX_FILENAME = 'urls.idx'
+DATA_FILENAME = 'urls.dat'
+
+INDEX_MAGIC = b'URLIDX01'
+CODEC_ZLIB = b'z'
+CODEC_RAW = b'r'
+
+# magic, codec, data path length
+HEADER = struct.Struct('<8sc3xI')
+# wnid, offset, length, url count
+RECORD = struct.Struct('<12sQII')
+
+
+def write_index(index_path, records, codec, data_path):
+    records = sorted(records, key=lambda r: r[0])
+    data_path = data_path.encode('utf-8')
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(INDEX_MAGIC, codec, len(data_path)))
+        f.write(data_path)
+        for wnid, offset, length, count in records:
+            f.write(RECORD.pack(wnid.encode('ascii'), offset, length, count))
+    os.replace(tmp_path, index_path)
+
+
+def read_codec(index_path):
+    with open(index_path, 'rb') as f:
+        magic, codec, _ = HEADER.unpack(f.read(HEADER.size))
+    if magic != INDEX_MAGIC:
+        raise ValueError(f'{index_path} is not a URL store index')
+    return codec
+
+
+def read_records(index_path):
+    with open(index_path, 'rb') as f:
+        magic, codec, path_len = HEADER.unpack(f.read(HEADER.size))
+        f.read(path_len)
+        records = []
+        for raw in iter(lambda: f.read(RECORD.size), b''):
+            wnid, offset, length, count = RECORD.unpack(raw)
+            records.append((wnid.rstrip(b'\0').decode('ascii'), offset, length, count))
+    return records
+
+
+class UrlStore():
+    def __init__(self, path):
+        index_path = os.path.join(path, INDEX_FILENAME) if os.path.isdir(path) else path
+
+        self.index_f = open(index_path, 'rb')
+        self.index = mmap.mmap(self.index_f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.codec, path_len = HEADER.unpack_from(self.index, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f'{index_path} is not a URL store index')
+        data_path = bytes(self.index[HEADER.size:HEADER.size + path_len]).decode('utf-8')
+        data_path = os.path.join(os.path.dirname(os.path.abspath(index_path)), data_path)
+
+        self.records_start = HEADER.size + path_len
+        self.n_records = (len(self.index) - self.records_start) // RECORD.size
+
+        self.data_f = open(data_path, 'rb')
+        self.data = mmap.mmap(self.data_f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(data_path) > 0 else b''
+
+    def close(self):
+        self.index.close()
+        self.index_f.close()
+        if len(self.data) > 0:
+            self.data.close()
+        self.data_f.close()
+
+    def _record(self, i):
+        wnid, offset, length, count = RECORD.unpack_from(self.index, self.records_start + i * RECORD.size)
+        return wnid.rstrip(b'\0'), offset, length, count
+
+    def _find(self, wnid):
+        key = wnid.encode('ascii')
+        lo, hi = 0, self.n_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        # a WNID may have several records, when it was not contiguous in its source
+        found = []
+        while lo < self.n_records and self._record(lo)[0] == key:
+            found.append(self._record(lo))
+            lo += 1
+        return found
+
+    def __contains__(self, wnid):
+        return len(self._find(wnid)) > 0
+
+    def count(self, wnid):
+        return sum(count for _, _, _, count in self._find(wnid))
+
+    def wnids(self):
+        return sorted(set(self._record(i)[0].decode('ascii') for i in range(self.n_records)))
+
+    def get(self, wnid):
+        records = self._find(wnid)
+        if not records:
+            return None
+
+        urls = []
+        for _, offset, length, _ in records:
+            blob = self.data[offset:offset + length]
+            if self.codec == CODEC_ZLIB:
+                urls.extend(zlib.decompress(blob).decode('utf-8', errors='ignore').split('\n'))
+            else:
+                for line in bytes(blob).splitlines():
+                    row = line.split(b'\t', 1)
+                    if len(row) == 2:
+                        urls.append(row[1].decode('utf-8', errors='ignore').strip())
+        return [url for url in urls if len(url) > 0]
+
+
+class UrlStoreWriter():
+    def __init__(self, store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+        self.index_path = os.path.join(store_dir, INDEX_FILENAME)
+        self.records = []
+        if os.path.exists(self.index_path):
+            # records of a raw index point into a text dump, they cannot be mixed with zlib blobs
+            if read_codec(self.index_path) != CODEC_ZLIB:
+                raise ValueError(f'{self.index_path} indexes a raw URL dump (prepare_stats.py -url_index), '
+                                 'build the store in another directory')
+            self.records = read_records(self.index_path)
+        # classes already in the store, adding them again would duplicate their URLs
+        self.known = set(r[0] for r in self.records)
+        self.data_f = open(os.path.join(store_dir, DATA_FILENAME), 'ab')
+
+    def add(self, wnid, urls):
+        blob = zlib.compress('\n'.join(urls).encode('utf-8'), 6)
+        offset = self.data_f.tell()
+        self.data_f.write(blob)
+        self.records.append((wnid, offset, len(blob), len(urls)))
+
+    def close(self):
+        self.data_f.close()
+        write_index(self.index_path, self.records, CODEC_ZLIB, DATA_FILENAME)
+
+
+def fetch_urls(wnid):
+    import requests
+    resp = requests.get(IMAGENET_API_WNID_TO_URLS(wnid))
+    return [url.decode('utf-8', errors='ignore').strip() for url in resp.content.splitlines() if len(url.strip()) > 0]
+
+
+def populate_from_api(store_dir, wnids):
+    writer = UrlStoreWriter(store_dir)
+    try:
+        for i, wnid in enumerate(wnids):
+            if wnid in writer.known:
+                continue
+            writer.add(wnid, fetch_urls(wnid))
+            time.sleep(0.05)
+            if i % 100 == 0:
+                print(f'{i} / {len(wnids)} classes fetched')
+    finally:
+        writer.close()
+
+
+def populate_from_dump(store_dir, dump_path):
+    # the dump is sorted by image id, so the lines of a WNID are (mostly) contiguous
+    # a WNID may get several records from this dump, but none if the store already had it
+    writer = UrlStoreWriter(store_dir)
+    known = set(writer.known)
+    current, urls = None, []
+    try:
+        with open(dump_path, 'rb') as f:
+            for line in f:
+                row = line.split(b'\t', 1)
+                if len(row) != 2:
+                    continue
+                wnid = row[0].split(b'_')[0].decode('ascii', errors='ignore')
+                if wnid != current:
+                    if current is not None and current not in known:
+                        writer.add(current, urls)
+                    current, urls = wnid, []
+                urls.append(row[1].decode('utf-8', errors='ignore').strip())
+        if current is not None and current not in known:
+            writer.add(current, urls)
+    finally:
+        writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the local store of ImageNet URL lists')
+    parser.add_argument('-store', required=True, type=str)
+    parser.add_argument('-from_dump', default='', type=str, help='path to fall11_urls.txt')
+    parser.add_argument('-from_api', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='fetch the URL lists of every class of imagenet_class_info.json')
+    args = parser.parse_args()
+
+    if len(args.from_dump) > 0:
+        populate_from_dump(args.store, args.from_dump)
+    elif args.from_api:
+        current_folder = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(current_folder, 'imagenet_class_info.json')) as class_info_json_f:
+            class_info_dict = json.load(class_info_json_f)
+        populate_from_api(args.store, sorted(class_info_dict.keys()))
+
+    store = UrlStore(args.store)
+    print(f'{args.store} holds URL lists of {len(store.wnids())} classes')
+    store.close()
@@ -17,6 +17,13 @@ amp_min = 0.17
 amp_max = 0.56
 
 
+#   random generator of one sample, keyed by the run seed and the sample index only,
+#   so that a sample gets the same parameters whichever process renders it
+#   ( same keying as refraction.sampleRng in run.py )
+def sample_rng( seed, s_idx ):
+
+    return random.Random( "{}:{}".format( seed, s_idx ) )
+
 #   define animation frame range to be rendered
 def set_target_frame( f_start, f_end ):
 
@@ -30,13 +37,22 @@ def set_target_frame( f_start, f_end ):
     bpy.context.scene.frame_end = f_end
 
 #   setup keyframe parameters FOR musgrave texture nodes
-def set_param_musgrave( node_c, node_f, wave_scale=0.0 ):
-        
+#   W keyframes ( [start, end] ) and fine scale can be given explicitly, so that
+#   several processes rendering different frames of one sample agree on them
+#   rng draws the missing ones, the process-global random state by default
+def set_param_musgrave( node_c, node_f, wave_scale=0.0, w_coarse=None, w_fine=None, scale_fine=None, rng=random ):
+
     #   random W-param for this sample
-    m1_start = random.uniform( w_init_min, w_init_max )
-    m1_end = m1_start + random.uniform( w_offset_min, w_offset_max ) * ( -1 ) ** random.randint( 0, 1 )
-    m2_start = random.uniform( w_init_min, w_init_max )
-    m2_end = m2_start + random.uniform( w_offset_min, w_offset_max ) * ( -1 ) ** random.randint( 0, 1 )
+    if w_coarse is None:
+        m1_start = rng.uniform( w_init_min, w_init_max )
+        m1_end = m1_start + rng.uniform( w_offset_min, w_offset_max ) * ( -1 ) ** rng.randint( 0, 1 )
+    else:
+        m1_start, m1_end = w_coarse
+    if w_fine is None:
+        m2_start = rng.uniform( w_init_min, w_init_max )
+        m2_end = m2_start + rng.uniform( w_offset_min, w_offset_max ) * ( -1 ) ** rng.randint( 0, 1 )
+    else:
+        m2_start, m2_end = w_fine
 
     #   bound to keyframe
     bpy.context.scene.frame_set( 1 )
@@ -57,20 +73,24 @@ def set_param_musgrave( node_c, node_f, wave_scale=0.0 ):
     logging.debug( "\tMusgrave[1].W : {:.4f} -> {:.4f}".format( m2_start, m2_end ) )
 
     #   control scale param
-    scale_c = random.uniform( scale_c_min, scale_c_max ) if wave_scale == 0.0 else wave_scale
+    scale_c = rng.uniform( scale_c_min, scale_c_max ) if wave_scale == 0.0 else wave_scale
     scale_offset = ( scale_c_max - scale_c ) / ( scale_c_max - scale_c_min ) * 0.8 + 2.7
-    scale_f = random.gauss( scale_c + scale_offset, 0.25 ) #  approx. by chebyshev's inequality
+    scale_f = rng.gauss( scale_c + scale_offset, 0.25 ) if scale_fine is None else scale_fine #  approx. by chebyshev's inequality
     node_c.inputs[2].default_value = scale_c
     node_f.inputs[2].default_value = scale_f
 
     logging.debug( "\tMusgrave[0].Scale : {:.4f}".format( scale_c ) )
     logging.debug( "\tMusgrave[1].Scale : {:.4f}".format( scale_f ) )
 
+    return dict( w_coarse=[ m1_start, m1_end ], w_fine=[ m2_start, m2_end ], scale_coarse=scale_c, scale_fine=scale_f )
+
 #   setup ampifier factor for the amount of distortion
-def set_param_amplifier( node, factor=0.0 ):
+def set_param_amplifier( node, factor=0.0, rng=random ):
 
     #   control amplifier param
-    amp_factor = random.uniform( amp_min, amp_max ) if factor == 0.0 else factor
+    amp_factor = rng.uniform( amp_min, amp_max ) if factor == 0.0 else factor
     node.inputs[1].default_value = amp_factor
 
     logging.debug( "\tAmplifier.Value : {:.4f}".format( amp_factor ) )
+
+    return amp_factor
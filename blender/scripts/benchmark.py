@@ -0,0 +1,162 @@
+import bpy
+import os
+import json
+import time
+import logging
+import itertools
+import numpy as np
+
+#   render quality benchmark
+#   renders frames of one sample at reference quality, then with every cheaper setting of the sweep,
+#   and measures the wall-clock time per frame against PSNR / SSIM relative to the reference.
+#   the cheapest Pareto-optimal setting meeting the quality thresholds is written as a preset
+#   that device.apply_preset can load.
+
+#   reference quality
+reference_setting = dict( samples=1024, max_bounces=12, tile_size=64, resolution_percentage=100 )
+
+#   settings swept, every combination is rendered
+sweep_values = dict(
+    samples=[ 4, 8, 16, 32, 64, 128 ],
+    max_bounces=[ 2, 4, 8 ],
+    tile_size=[ 32, 256 ],
+    resolution_percentage=[ 50, 100 ] )
+
+#   file name of the per-setting results, next to the preset
+results_name = "benchmark.jsonl"
+
+
+#   every combination of the swept settings
+def sweep_settings():
+
+    keys = sorted( sweep_values )
+    return [ dict( zip( keys, values ) ) for values in itertools.product( *[ sweep_values[k] for k in keys ] ) ]
+
+#   render a single frame to path, returns ( wall-clock seconds, float RGB pixels ( H, W, 3 ) )
+def render_frame( scene, frame, path ):
+
+    scene.frame_set( frame )
+    scene.render.filepath = path
+
+    t_start = time.monotonic()
+    bpy.ops.render.render( write_still=True )
+    seconds = time.monotonic() - t_start
+
+    img = bpy.data.images.load( path, check_existing=False )
+    width, height = img.size
+    pixels = np.empty( width * height * 4, dtype=np.float32 )
+    img.pixels.foreach_get( pixels )
+    bpy.data.images.remove( img )
+
+    return seconds, pixels.reshape( height, width, 4 )[..., :3]
+
+#   nearest neighbour resize, to compare lower resolution renders with the reference
+def resize_to( pixels, shape ):
+
+    rows = ( np.arange( shape[0] ) * pixels.shape[0] // shape[0] ).astype( np.intp )
+    cols = ( np.arange( shape[1] ) * pixels.shape[1] // shape[1] ).astype( np.intp )
+    return pixels[rows][:, cols]
+
+def psnr( a, b ):
+
+    mse = float( np.mean( ( a - b ) ** 2 ) )
+    return float( "inf" ) if mse == 0.0 else 10.0 * np.log10( 1.0 / mse )
+
+#   mean of every win x win window, through summed area tables
+def box_mean( x, win ):
+
+    c = np.cumsum( np.cumsum( np.pad( x, ( ( 1, 0 ), ( 1, 0 ) ) ), axis=0 ), axis=1 )
+    return ( c[win:, win:] - c[:-win, win:] - c[win:, :-win] + c[:-win, :-win] ) / ( win * win )
+
+#   structural similarity of the luminance, with uniform 8x8 windows
+def ssim( a, b, win=8 ):
+
+    luma = np.array( [ 0.2126, 0.7152, 0.0722 ], dtype=np.float64 )
+    x = a.astype( np.float64 ) @ luma
+    y = b.astype( np.float64 ) @ luma
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+
+    mx, my = box_mean( x, win ), box_mean( y, win )
+    vx = box_mean( x * x, win ) - mx * mx
+    vy = box_mean( y * y, win ) - my * my
+    cxy = box_mean( x * y, win ) - mx * my
+    s = ( ( 2 * mx * my + c1 ) * ( 2 * cxy + c2 ) ) / ( ( mx * mx + my * my + c1 ) * ( vx + vy + c2 ) )
+    return float( np.mean( s ) )
+
+#   results not beaten on both time and quality by another one
+def pareto( results ):
+
+    front = []
+    for r in results:
+        dominated = any( o['seconds'] <= r['seconds'] and o['psnr'] >= r['psnr'] and
+                         ( o['seconds'] < r['seconds'] or o['psnr'] > r['psnr'] ) for o in results )
+        if not dominated:
+            front.append( r )
+    return sorted( front, key=lambda r: r['seconds'] )
+
+#   render the reference and the sweep on CPU, write the results and the chosen preset
+def run( scene, device, frames, out_dir, preset_path, min_psnr=35.0, min_ssim=0.95 ):
+
+    os.makedirs( out_dir, exist_ok=True )
+
+    #   every setting is applied relative to the scene as loaded, and the scene is restored afterwards
+    original = device.current_settings( scene )
+    original_device = scene.cycles.device
+
+    #   compare the same way on every machine, and without JPEG artifacts
+    sweep_device = 'CPU'
+    scene.cycles.device = sweep_device
+    file_format = scene.render.image_settings.file_format
+    scene.render.image_settings.file_format = 'PNG'
+
+    print( ">>>>>\tRendering reference {}".format( reference_setting ) )
+    device.apply_settings( scene, reference_setting, original )
+    reference = {}
+    reference_seconds = 0.0
+    for f in frames:
+        seconds, reference[f] = render_frame( scene, f, os.path.join( out_dir, "reference_{:04d}.png".format( f ) ) )
+        reference_seconds += seconds / len( frames )
+
+    results = []
+    results_path = os.path.join( os.path.dirname( preset_path ) or ".", results_name )
+    with open( results_path, "w" ) as results_fp:
+        for setting in sweep_settings():
+            device.apply_settings( scene, setting, original )
+            seconds, psnrs, ssims = 0.0, [], []
+            for f in frames:
+                t, pixels = render_frame( scene, f, os.path.join( out_dir, "sweep_{:04d}.png".format( f ) ) )
+                pixels = resize_to( pixels, reference[f].shape )
+                seconds += t / len( frames )
+                psnrs.append( psnr( pixels, reference[f] ) )
+                ssims.append( ssim( pixels, reference[f] ) )
+
+            result = dict( setting, seconds=seconds, psnr=float( np.mean( psnrs ) ), ssim=float( np.mean( ssims ) ) )
+            results.append( result )
+            results_fp.write( json.dumps( result ) + "\n" )
+            print( "{}\t{:.3f} s/frame\tPSNR {:.2f} dB\tSSIM {:.4f}".format( setting, seconds, result['psnr'], result['ssim'] ) )
+
+    scene.render.image_settings.file_format = file_format
+    device.apply_settings( scene, original )
+    scene.cycles.device = original_device
+
+    #   cheapest Pareto-optimal setting that is good enough, the reference otherwise
+    front = pareto( results )
+    good = [ r for r in front if r['psnr'] >= min_psnr and r['ssim'] >= min_ssim ]
+    chosen = good[0] if good else dict( reference_setting, seconds=reference_seconds, psnr=float( "inf" ), ssim=1.0 )
+
+    preset = { k: chosen[k] for k in reference_setting }
+    preset['device'] = sweep_device
+    preset['benchmark'] = dict( seconds=chosen['seconds'], psnr=chosen['psnr'], ssim=chosen['ssim'],
+                                reference_seconds=reference_seconds, min_psnr=min_psnr, min_ssim=min_ssim,
+                                pareto=front )
+    with open( preset_path, "w" ) as preset_fp:
+        json.dump( preset, preset_fp, indent=2 )
+
+    print( "Pareto front :" )
+    for r in front:
+        print( "\t{}".format( r ) )
+    print( "Preset {} written to {} ( {:.3f} s/frame, reference {:.3f} s/frame )".format(
+        { k: chosen[k] for k in reference_setting }, preset_path, chosen['seconds'], reference_seconds ) )
+    logging.debug( "Benchmark results at : {}".format( results_path ) )
+
+    return preset
@@ -1,7 +1,19 @@
 import bpy
+import os
+import json
 import logging
 
-def customize( gpu_id=-1 ):
+#   render quality settings a preset can hold ( see benchmark.py )
+preset_keys = ( "samples", "max_bounces", "tile_size", "resolution_percentage" )
+
+#   CPU threads work best on small tiles, GPUs on large ones
+cpu_tile_size = 32
+
+def customize( gpu_id=-1, cpu=False, threads=0, cores=None ):
+
+    if cpu:
+        use_cpu( threads, cores )
+        return
 
     #   set render device on scene settings
     bpy.context.scene.cycles.device = 'GPU'
@@ -48,3 +60,88 @@ def customize( gpu_id=-1 ):
         for device in cycles_pref.devices:
             device.use = True
             logging.debug( "\t{}".format( device.name ) )
+
+#   render on CPU only, with a fixed number of threads ( 0 lets Blender use every core )
+#   restricted to the given cores, so that several processes can share a node without competing
+def use_cpu( threads=0, cores=None ):
+
+    scene = bpy.context.scene
+    scene.cycles.device = 'CPU'
+    bpy.context.preferences.addons['cycles'].preferences.compute_device_type = 'NONE'
+
+    if threads > 0:
+        scene.render.threads_mode = 'FIXED'
+        scene.render.threads = threads
+    apply_settings( scene, dict( tile_size=cpu_tile_size ) )
+
+    if cores and pin_cores( cores ):
+        logging.debug( "Pinned to core(s) {}".format( cores ) )
+
+    logging.debug( "Rendering on CPU with {} thread(s)".format( threads if threads > 0 else "all" ) )
+
+#   restrict every thread of this process ( and the ones it starts later ) to the given cores
+def pin_cores( cores ):
+
+    if not hasattr( os, "sched_setaffinity" ):
+        return False
+
+    tids = [ int( tid ) for tid in os.listdir( "/proc/self/task" ) ] if os.path.isdir( "/proc/self/task" ) else [ 0 ]
+    for tid in tids:
+        try:
+            os.sched_setaffinity( tid, cores )
+        except OSError:
+            #   thread exited meanwhile
+            pass
+    return True
+
+#   render quality settings of the scene, as taken by apply_settings
+def current_settings( scene ):
+
+    settings = dict( samples=scene.cycles.samples, max_bounces=scene.cycles.max_bounces,
+                     transmission_bounces=scene.cycles.transmission_bounces,
+                     resolution_percentage=scene.render.resolution_percentage )
+    settings["tile_size"] = scene.cycles.tile_size if hasattr( scene.cycles, "tile_size" ) else scene.render.tile_x
+    return settings
+
+#   apply render quality settings, only the given keys are changed
+#   max_bounces caps the transmission bounces of base ( the scene's own settings by default ), so that
+#   a low cap applied before does not carry over to a higher one
+def apply_settings( scene, settings, base=None ):
+
+    if "samples" in settings:
+        scene.cycles.samples = settings["samples"]
+    if "max_bounces" in settings:
+        transmission_bounces = ( base or {} ).get( "transmission_bounces", scene.cycles.transmission_bounces )
+        scene.cycles.max_bounces = settings["max_bounces"]
+        scene.cycles.transmission_bounces = min( transmission_bounces, settings["max_bounces"] )
+    if "transmission_bounces" in settings:
+        scene.cycles.transmission_bounces = settings["transmission_bounces"]
+    if "tile_size" in settings:
+        #   Cycles X has a single tile size, older versions a tile per axis
+        if hasattr( scene.cycles, "tile_size" ):
+            scene.cycles.tile_size = settings["tile_size"]
+        else:
+            scene.render.tile_x = settings["tile_size"]
+            scene.render.tile_y = settings["tile_size"]
+    if "resolution_percentage" in settings:
+        scene.render.resolution_percentage = settings["resolution_percentage"]
+
+#   apply the preset file written by the benchmark, if there is one
+def apply_preset( preset_path ):
+
+    if not preset_path or not os.path.exists( preset_path ):
+        return None
+
+    with open( preset_path, "r" ) as preset_fp:
+        preset = json.load( preset_fp )
+    settings = { k: preset[k] for k in preset_keys if k in preset }
+
+    #   the best tile size depends on the device, it only applies to the one the sweep ran on
+    #   ( presets without a device were all measured on CPU )
+    if preset.get( "device", "CPU" ) != bpy.context.scene.cycles.device:
+        settings.pop( "tile_size", None )
+    apply_settings( bpy.context.scene, settings )
+
+    logging.debug( "Render preset {} : {}".format( preset_path, settings ) )
+
+    return settings
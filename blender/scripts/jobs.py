@@ -0,0 +1,267 @@
+import os
+import json
+import shutil
+import time
+import uuid
+
+#   file-based job queue shared by run.py and the persistent render workers
+#   each job is a JSON file moving from pending/ to running/ to done/,
+#   os.rename is atomic so a job can be claimed by exactly one worker
+#   the queue can live on a directory shared by several nodes : a claimed job is leased,
+#   its worker renews the lease by touching the running file ( heartbeat ) and any node
+#   puts jobs whose running file was not touched for longer than the lease back to pending
+#   every run publishes its jobs in a new generation ( a subdirectory of the shared queue directory
+#   named in its GENERATION file ), so that nodes joining the queue never mistake the leftovers of
+#   a previous run for the current one, and a generation is only deleted once no node is attached to it
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+
+#   marker file telling waiting workers that no more jobs will be submitted
+CLOSED = "closed"
+
+#   file touched to read the clock of the file system holding the queue
+CLOCK = "clock"
+
+#   file of the shared queue directory naming its current generation
+GENERATION = "generation"
+
+#   directory of a generation holding one file per attached node, touched while the node works on it
+NODES = "nodes"
+
+#   seconds after which a node that stopped touching its file is not attached anymore
+node_timeout = 600
+
+#   job file name expression to be formatted later
+job_name_format = "{:08d}"
+job_name_ext = ".json"
+
+
+#   create queue subdirectories if they do not exist yet
+def init_queue( q_dir ):
+
+    for state in ( PENDING, RUNNING, DONE ):
+        os.makedirs( os.path.join( q_dir, state ), exist_ok=True )
+
+#   start a new generation of the shared queue directory q_root, returns its id
+#   the generation is ready ( subdirectories created ) before it is published
+def new_generation( q_root ):
+
+    generation = "{}-{}".format( time.strftime( "%Y%m%d-%H%M%S" ), uuid.uuid4().hex[:8] )
+    init_queue( os.path.join( q_root, generation ) )
+    tmp_path = os.path.join( q_root, GENERATION + ".tmp" )
+    with open( tmp_path, "w" ) as fp:
+        fp.write( generation )
+    os.replace( tmp_path, os.path.join( q_root, GENERATION ) )
+    return generation
+
+#   id of the current generation of q_root, None if no run published jobs there yet
+def current_generation( q_root ):
+
+    try:
+        with open( os.path.join( q_root, GENERATION ), "r" ) as fp:
+            return fp.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+#   a closed generation without pending or running jobs has nothing left for a joining node
+def is_finished( q_dir ):
+
+    return is_closed( q_dir ) and not list_jobs( q_dir, PENDING ) and not list_jobs( q_dir, RUNNING )
+
+#   mark ( or keep marking ) node_id as working on the generation q_dir
+def attach( q_dir, node_id ):
+
+    nodes_dir = os.path.join( q_dir, NODES )
+    os.makedirs( nodes_dir, exist_ok=True )
+    node_path = os.path.join( nodes_dir, sanitize_worker_id( node_id ) )
+    with open( node_path, "a" ):
+        pass
+    os.utime( node_path )
+
+def detach( q_dir, node_id ):
+
+    try:
+        os.remove( os.path.join( q_dir, NODES, sanitize_worker_id( node_id ) ) )
+    except FileNotFoundError:
+        pass
+
+#   nodes that touched their file of the generation q_dir within the last timeout seconds
+def attached_nodes( q_dir, timeout=None ):
+
+    nodes_dir = os.path.join( q_dir, NODES )
+    if not os.path.isdir( nodes_dir ):
+        return []
+    now = fs_time( q_dir )
+    timeout = node_timeout if timeout is None else timeout
+    attached = []
+    for name in os.listdir( nodes_dir ):
+        try:
+            if now - os.stat( os.path.join( nodes_dir, name ) ).st_mtime <= timeout:
+                attached.append( name )
+        except FileNotFoundError:
+            continue
+    return attached
+
+#   delete the generations of q_root other than the current one that no node is attached to
+def remove_stale_generations( q_root ):
+
+    current = current_generation( q_root )
+    removed = []
+    for name in os.listdir( q_root ):
+        q_dir = os.path.join( q_root, name )
+        if name == current or not os.path.isdir( os.path.join( q_dir, PENDING ) ):
+            continue
+        if attached_nodes( q_dir ):
+            continue
+        shutil.rmtree( q_dir, ignore_errors=True )
+        removed.append( name )
+    return removed
+
+#   no more jobs will be submitted to this queue
+def close( q_dir ):
+
+    open( os.path.join( q_dir, CLOSED ), "w" ).close()
+
+def is_closed( q_dir ):
+
+    return os.path.exists( os.path.join( q_dir, CLOSED ) )
+
+#   worker ids are embedded in file names, so they cannot contain dots
+def sanitize_worker_id( worker_id ):
+
+    return str( worker_id ).replace( '.', '-' ).replace( os.sep, '-' )
+
+#   split a job file name into its job name and the id of the worker holding it
+def parse_name( file_name ):
+
+    parts = file_name[:-len( job_name_ext )].split( '.', 1 )
+    return parts[0], ( parts[1] if len( parts ) > 1 else None )
+
+#   write a JSON file atomically
+def write_json( path, content ):
+
+    tmp_path = path + ".tmp"
+    with open( tmp_path, "w" ) as fp:
+        json.dump( content, fp )
+    os.replace( tmp_path, path )
+
+#   put a new job into the pending queue
+def submit( q_dir, job_idx, job ):
+
+    name = job_name_format.format( job_idx ) + job_name_ext
+    write_json( os.path.join( q_dir, PENDING, name ), job )
+    return name
+
+#   list job file names in the given state
+#   a queue that does not exist ( yet ) has no jobs
+def list_jobs( q_dir, state ):
+
+    if not os.path.isdir( os.path.join( q_dir, state ) ):
+        return []
+    return sorted( f for f in os.listdir( os.path.join( q_dir, state ) ) if f.endswith( job_name_ext ) )
+
+#   take the next pending job, returns ( path of the claimed file, job ) or None if queue is empty
+def claim( q_dir, worker_id ):
+
+    worker_id = sanitize_worker_id( worker_id )
+
+    for name in list_jobs( q_dir, PENDING ):
+        job_name, _ = parse_name( name )
+        claimed_path = os.path.join( q_dir, RUNNING, job_name + '.' + worker_id + job_name_ext )
+        try:
+            os.rename( os.path.join( q_dir, PENDING, name ), claimed_path )
+        except FileNotFoundError:
+            #   another worker was faster
+            continue
+
+        try:
+            #   the lease starts now, not when the job was submitted
+            heartbeat( claimed_path )
+            with open( claimed_path, "r" ) as fp:
+                return claimed_path, json.load( fp )
+        except FileNotFoundError:
+            #   expired by another node before the lease could start
+            continue
+
+    return None
+
+#   renew the lease of a claimed job, returns False if it expired and was re-queued meanwhile
+def heartbeat( claimed_path ):
+
+    try:
+        os.utime( claimed_path )
+    except FileNotFoundError:
+        return False
+    return True
+
+#   current time of the file system holding the queue, nodes sharing it may disagree on theirs
+def fs_time( q_dir ):
+
+    clock_path = os.path.join( q_dir, CLOCK )
+    with open( clock_path, "a" ):
+        pass
+    os.utime( clock_path )
+    return os.stat( clock_path ).st_mtime
+
+#   put running jobs whose lease was not renewed for lease seconds back to pending
+def expire( q_dir, lease ):
+
+    now = fs_time( q_dir )
+    expired = []
+    for name in list_jobs( q_dir, RUNNING ):
+        running_path = os.path.join( q_dir, RUNNING, name )
+        try:
+            if now - os.stat( running_path ).st_mtime <= lease:
+                continue
+            job_name, _ = parse_name( name )
+            os.rename( running_path, os.path.join( q_dir, PENDING, job_name + job_name_ext ) )
+        except FileNotFoundError:
+            #   completed or expired by another node meanwhile
+            continue
+        expired.append( job_name )
+
+    return expired
+
+#   mark a claimed job as done, optionally attaching a result record
+#   a job whose lease expired is still done, it is taken back from pending if nobody claimed it again
+def complete( claimed_path, result=None, job=None ):
+
+    q_dir = os.path.dirname( os.path.dirname( claimed_path ) )
+    job_name, worker_id = parse_name( os.path.basename( claimed_path ) )
+
+    try:
+        with open( claimed_path, "r" ) as fp:
+            job = json.load( fp )
+    except FileNotFoundError:
+        job = dict( job if job is not None else {} )
+    job['worker'] = worker_id
+    if result is not None:
+        job['result'] = result
+
+    write_json( os.path.join( q_dir, DONE, job_name + job_name_ext ), job )
+    for path in ( claimed_path, os.path.join( q_dir, PENDING, job_name + job_name_ext ) ):
+        try:
+            os.remove( path )
+        except FileNotFoundError:
+            pass
+
+#   put running jobs back to pending, either all of them or those of a single worker
+def requeue( q_dir, worker_id=None ):
+
+    if worker_id is not None:
+        worker_id = sanitize_worker_id( worker_id )
+
+    requeued = []
+    for name in list_jobs( q_dir, RUNNING ):
+        job_name, owner = parse_name( name )
+        if worker_id is not None and owner != worker_id:
+            continue
+        try:
+            os.rename( os.path.join( q_dir, RUNNING, name ), os.path.join( q_dir, PENDING, job_name + job_name_ext ) )
+        except FileNotFoundError:
+            continue
+        requeued.append( job_name )
+
+    return requeued
@@ -4,29 +4,56 @@ import sys
 import os.path
 import logging
 import time
+import random
 import argparse
 import json
+from contextlib import contextmanager
 
 #   import custom modules
 device = bpy.data.texts.load( bpy.path.abspath( "//scripts/device.py" ) ).as_module()
 anim = bpy.data.texts.load( bpy.path.abspath( "//scripts/anim.py" ) ).as_module()
+jobs = bpy.data.texts.load( bpy.path.abspath( "//scripts/jobs.py" ) ).as_module()
+projection = bpy.data.texts.load( bpy.path.abspath( "//scripts/projection.py" ) ).as_module()
+benchmark = bpy.data.texts.load( bpy.path.abspath( "//scripts/benchmark.py" ) ).as_module()
+timing = bpy.data.texts.load( bpy.path.abspath( "//scripts/timing.py" ) ).as_module()
+timeline = bpy.data.texts.load( bpy.path.abspath( "//scripts/timeline.py" ) ).as_module()
 
 #   sample file expression to be formatted later
 sample_name_format = "{:04d}"
 sample_name_ext = ".jpg"
 
+#   render quality preset written by the benchmark, applied at init when it exists
+default_preset_path = "//render_preset.json"
+
+#   exit codes of a persistent worker
+EXIT_QUEUE_EMPTY = 0
+EXIT_RECYCLE = 75
+
+#   what is being rendered, for the per-frame timing, trace and lease handlers
+render_state = dict( stage="frame", sample=-1, t_pre=0.0, t_post=0.0, claimed=None )
+
 #   setup logging level
 #logging.basicConfig( level=logging.DEBUG )
 
 
 #   substitute texture by the new one with corresponding sample index
-def change_texture( node_texture, s_dir, s_idx ):
+#   in_place reloads the image of the previous sample from the new file instead, so that
+#   the material keeps referencing the same image ( see --persistent_data )
+def change_texture( node_texture, s_dir, s_idx, in_place=False ):
 
     #   define image database in .blend file
     db_img = bpy.data.images
+    s_path = os.path.join( s_dir, sample_name_format.format( s_idx ) + sample_name_ext )
+
+    #   only images loaded here are reloaded, not the one saved in the .blend file
+    if in_place and node_texture.image is not None and node_texture.image.get( "sample_texture", False ):
+        node_texture.image.filepath = s_path
+        node_texture.image.reload()
+        return
 
     #   load new image
-    new_img = db_img.load( os.path.join( s_dir, sample_name_format.format( s_idx ) + sample_name_ext ), check_existing=False )
+    new_img = db_img.load( s_path, check_existing=False )
+    new_img["sample_texture"] = True
 
     #   replace the existing image
     old_img = node_texture.image
@@ -45,6 +72,58 @@ def render_undistorted( scene, s_idx, o_dir ):
     #   render single frame
     bpy.ops.render.render( write_still=True )
 
+#   render UNDISTORTED version with the water surface flattened
+def render_flat( scene, mat_water, node_amplifier, node_out, s_idx, o_dir ):
+
+    #   with persistent data, the displacement is scaled to zero in place
+    #   so that the node tree keeps its links and the render data stays valid
+    in_place = scene.render.use_persistent_data
+    amp_factor = node_amplifier.inputs[1].default_value
+    if in_place:
+        if not node_amplifier.outputs[0].is_linked:
+            mat_water.node_tree.links.new( node_amplifier.outputs[0], node_out.inputs[2] )
+        node_amplifier.inputs[1].default_value = 0.0
+
+    #   otherwise unlink musgrave texture (displacement controller)
+    elif node_amplifier.outputs[0].is_linked:
+        mat_water.node_tree.links.remove( node_amplifier.outputs[0].links[0] )
+
+    render_state['stage'] = "undistorted"
+    render_undistorted( scene, s_idx, o_dir )
+    render_state['stage'] = "frame"
+
+    #   restore the displacement
+    if in_place:
+        node_amplifier.inputs[1].default_value = amp_factor
+    else:
+        #   relink musgrave texture
+        mat_water.node_tree.links.new( node_amplifier.outputs[0], node_out.inputs[2] )
+
+#   compute UNDISTORTED version from the texture, without rendering
+#   the first sample of every projection is rendered and compared with the projection instead,
+#   projections too far from Cycles are refused and every target is rendered
+def write_undistorted( scene, node_texture, s_dir, s_idx, o_dir, render_flat_target, min_psnr=projection.default_min_psnr ):
+
+    s_path = os.path.join( s_dir, sample_name_format.format( s_idx ) + sample_name_ext )
+    o_path = os.path.join( o_dir, "undistorted", sample_name_format.format( s_idx ) + sample_name_ext )
+    cache_dir = os.path.join( o_dir, "cache" )
+
+    calibration = projection.get_calibration( scene, cache_dir )
+    if calibration is None:
+        render_flat_target()
+        calibration = projection.calibrate( scene, node_texture.image, o_path, cache_dir, min_psnr )
+        print( "Analytic undistorted target {} against Cycles : {:.2f} dB ( {:.2f} dB before calibration, {:.2f} dB required )".format(
+            "accepted" if calibration['ok'] else "REFUSED, rendering instead", calibration['psnr'], calibration['psnr_raw'], min_psnr ) )
+        return
+    if not calibration['ok']:
+        render_flat_target()
+        return
+
+    with timed( "undistorted", sample=s_idx ):
+        cached = projection.write_undistorted( scene, node_texture.image, s_path, o_path, cache_dir )
+
+    logging.debug( "Undistorted target {}".format( "taken from cache" if cached else "projected" ) )
+
 #   render DISTORTED version
 def render_distorted( scene, s_idx, o_dir ):
 
@@ -54,8 +133,56 @@ def render_distorted( scene, s_idx, o_dir ):
     #   render animation
     bpy.ops.render.render( animation=True, write_still=True )
 
+#   per-frame wall-clock timing : Blender calls these around every frame it renders and writes
+def on_render_pre( scene, *args ):
+
+    render_state['t_pre'] = time.monotonic()
+
+def on_render_post( scene, *args ):
+
+    render_state['t_post'] = time.monotonic()
+    seconds = render_state['t_post'] - render_state['t_pre']
+    timing.record( render_state['stage'], seconds, sample=render_state['sample'], frame=scene.frame_current )
+    timeline.complete( render_state['stage'], seconds, "render", sample=render_state['sample'], frame=scene.frame_current )
+
+    #   every rendered frame renews the lease of the job being rendered
+    if render_state['claimed'] is not None and not jobs.heartbeat( render_state['claimed'] ):
+        print( "Lease of {} expired, the job was re-queued.".format( os.path.basename( render_state['claimed'] ) ) )
+
+def on_render_write( scene, *args ):
+
+    seconds = time.monotonic() - render_state['t_post']
+    timing.record( render_state['stage'] + "_write", seconds, sample=render_state['sample'], frame=scene.frame_current )
+    timeline.complete( render_state['stage'] + "_write", seconds, "render", sample=render_state['sample'], frame=scene.frame_current )
+
+def add_render_handlers():
+
+    if on_render_pre not in bpy.app.handlers.render_pre:
+        bpy.app.handlers.render_pre.append( on_render_pre )
+        bpy.app.handlers.render_post.append( on_render_post )
+        bpy.app.handlers.render_write.append( on_render_write )
+
+#   write timing records to path, tagged with the device and worker
+def init_timing( path, gpu_id, worker_id="" ):
+
+    timing.open_records( path, device=gpu_id, worker=worker_id )
+    add_render_handlers()
+
+#   join the run.py trace timeline ( enabled through the environment, see timeline.py )
+def init_trace( gpu_id, worker_id="" ):
+
+    timeline.init( "blender {}".format( worker_id if len( worker_id ) > 0 else os.getpid() ), device=gpu_id )
+    add_render_handlers()
+
+#   time the enclosed block for the timing records and the trace
+@contextmanager
+def timed( stage, **fields ):
+
+    with timeline.span( stage, "render", **fields ), timing.timed( stage, **fields ):
+        yield
+
 #   setup the environment before rendering
-def init( f_start, f_end, gpu_id ):
+def init( f_start, f_end, gpu_id, preset_path="", cpu=False, threads=0, cores=None, persistent_data=False ):
 
     print( ">>>>>\tStart initializing" )
 
@@ -63,10 +190,75 @@ def init( f_start, f_end, gpu_id ):
     anim.set_target_frame( f_start, f_end )
 
     #   set render device on scene settings
-    device.customize( gpu_id )
+    device.customize( gpu_id, cpu, threads, cores )
+
+    #   measured render quality settings, if benchmarked
+    if device.apply_preset( preset_path ) is not None:
+        print( "Render preset {} applied".format( preset_path ) )
+
+    #   keep scene, BVH and kernels between renders, only what changes is synchronized
+    bpy.data.scenes['Scene'].render.use_persistent_data = persistent_data
+
+#   find the cheapest render settings matching the reference quality on one sample
+def run_benchmark( s_idx, s_dir, o_dir, frames, preset_path, seed=0, min_psnr=35.0, min_ssim=0.95 ):
+
+    materials = bpy.data.materials
+    node_tex = materials['Material.Text'].node_tree.nodes["Image Texture"]
+    mat_water = materials['Material.Water']
+    node_amplifier = mat_water.node_tree.nodes["Amplifier"]
+    node_out = mat_water.node_tree.nodes["Material Output"]
+
+    change_texture( node_tex, s_dir, s_idx )
+    rng = anim.sample_rng( seed, s_idx )
+    anim.set_param_musgrave( mat_water.node_tree.nodes["Musgrave.Coarse"], mat_water.node_tree.nodes["Musgrave.Fine"], rng=rng )
+    anim.set_param_amplifier( node_amplifier, rng=rng )
+    if not node_amplifier.outputs[0].is_linked:
+        mat_water.node_tree.links.new( node_amplifier.outputs[0], node_out.inputs[2] )
+
+    return benchmark.run( bpy.data.scenes['Scene'], device, frames, os.path.join( o_dir, "benchmark" ),
+                          preset_path, min_psnr, min_ssim )
+
+#   render the same samples without, then with persistent data ( and in place material updates ),
+#   and compare the time per frame and per sample of both
+def run_persistent_benchmark( s_start, s_end, s_dir, o_dir, seed=0 ):
+
+    bench_dir = os.path.join( o_dir, "benchmark" )
+    records_path = os.path.join( bench_dir, "persistent.timing.jsonl" )
+    os.makedirs( bench_dir, exist_ok=True )
+    if os.path.exists( records_path ):
+        os.remove( records_path )
+
+    scene = bpy.data.scenes['Scene']
+    num_samples = s_end - s_start + 1
+    add_render_handlers()
+
+    #   warm up first, what the very first render compiles and loads would count against the baseline
+    render( s_start, s_start, s_dir, os.path.join( bench_dir, "warmup" ), [0.0], [0.0], seed=seed )
+
+    for mode in ( "baseline", "persistent" ):
+        print( ">>>>>\tBenchmark : {}".format( mode ) )
+        scene.render.use_persistent_data = ( mode == "persistent" )
+        timing.open_records( records_path, device=mode )
+        render( s_start, s_end, s_dir, os.path.join( bench_dir, mode ), [0.0] * num_samples, [0.0] * num_samples, seed=seed )
+    timing.close_records()
+
+    summary = timing.summarize( timing.load( [ records_path ] ) )
+    timing.print_summary( summary )
+    for stage in ( "frame", "undistorted", "sample" ):
+        if stage in summary["baseline"] and stage in summary["persistent"]:
+            before, after = summary["baseline"][stage]["mean"], summary["persistent"][stage]["mean"]
+            print( "{} : {:.3f} s -> {:.3f} s ( x{:.2f} )".format( stage, before, after, before / after if after > 0 else 0.0 ) )
+    logging.debug( "Benchmark records at : {}".format( records_path ) )
+
+    return summary
 
 #   render, ain't nothing else
-def render( s_start, s_end, s_dir, o_dir, wave_scales, amplifiers ):
+#   musgrave is an optional list of per-sample dicts with explicit 'w_coarse', 'w_fine' and 'scale_fine'
+#   undistorted is either 'render', 'analytic' or 'skip' ( another process produces it )
+#   with a seed >= 0, parameters left to draw only depend on ( seed, sample index ), see anim.sample_rng
+#   returns the resolved parameters of every sample
+def render( s_start, s_end, s_dir, o_dir, wave_scales, amplifiers, undistorted='render', musgrave=None, seed=-1,
+            analytic_min_psnr=projection.default_min_psnr ):
 
     assert s_start <= s_end, "First sample is not followed by last sample."
     assert s_start >= 0, "First sample index cannot be lower than 0."
@@ -85,9 +277,10 @@ def render( s_start, s_end, s_dir, o_dir, wave_scales, amplifiers ):
     #   define scene to be rendered
     scene = bpy.data.scenes['Scene']
 
-    #   initialize performance timer
+    #   initialize performance timer ( wall clock, GPU rendering and file writes happen outside this thread )
     num_samples = s_end - s_start + 1
     t_avg_per_sample = 0.0
+    resolved = []
 
     logging.debug( "Render sample {} -> {}".format( s_start, s_end ) )
     logging.debug( "Retrieve samples from : {}".format( s_dir ) )
@@ -98,40 +291,53 @@ def render( s_start, s_end, s_dir, o_dir, wave_scales, amplifiers ):
         print( "Rendering sample [{} out of {}]...".format( s_idx - s_start + 1, num_samples ) )
 
         #   start the timer
-        t_start = time.process_time()
+        t_start = time.monotonic()
+        render_state['sample'] = s_idx
+        timeline.begin( "sample", "render", sample=s_idx )
 
         logging.debug( "Loading texture..." )
 
         #   load new image
-        change_texture( node_tex, s_dir, s_idx )
+        with timed( "texture_load", sample=s_idx ):
+            change_texture( node_tex, s_dir, s_idx, scene.render.use_persistent_data )
 
         logging.debug( "Initialize animation parameter..." )
 
         #   setup material parameters
         # anim.set_param_musgrave( node_musgrave_c, node_musgrave_f, wave_scale )
         # anim.set_param_amplifier( node_amplifier, amplifier )
-        anim.set_param_musgrave( node_musgrave_c, node_musgrave_f, wave_scales.pop(0) )
-        anim.set_param_amplifier( node_amplifier, amplifiers.pop(0) )
+        with timed( "params", sample=s_idx ):
+            rng = anim.sample_rng( seed, s_idx ) if seed >= 0 else random
+            sample_musgrave = musgrave.pop(0) if musgrave else {}
+            sample_params = anim.set_param_musgrave( node_musgrave_c, node_musgrave_f, wave_scales.pop(0), rng=rng, **sample_musgrave )
+            sample_params['amplifier'] = anim.set_param_amplifier( node_amplifier, amplifiers.pop(0), rng=rng )
+        resolved.append( sample_params )
 
         logging.debug( "Render..." )
 
-        #   unlink musgrave texture (displacement controller)
-        if node_amplifier.outputs[0].is_linked:
-            mat_water.node_tree.links.remove( node_amplifier.outputs[0].links[0] )
-
-        #   render undistorted version first
-        render_undistorted( scene, s_idx, o_dir )
+        if undistorted == 'skip':
+            if not node_amplifier.outputs[0].is_linked:
+                mat_water.node_tree.links.new( node_amplifier.outputs[0], node_out.inputs[2] )
+        elif undistorted == 'analytic':
+            #   project the texture instead of rendering the flat surface
+            write_undistorted( scene, node_tex, s_dir, s_idx, o_dir,
+                               lambda: render_flat( scene, mat_water, node_amplifier, node_out, s_idx, o_dir ), analytic_min_psnr )
 
-        #   relink musgrave texture
-        mat_water.node_tree.links.new( node_amplifier.outputs[0], node_out.inputs[2] )
+            if not node_amplifier.outputs[0].is_linked:
+                mat_water.node_tree.links.new( node_amplifier.outputs[0], node_out.inputs[2] )
+        else:
+            #   render undistorted version first
+            render_flat( scene, mat_water, node_amplifier, node_out, s_idx, o_dir )
 
         #   then render distorted version
         render_distorted( scene, s_idx, o_dir )
 
         #   stop the timer, and calculate exec. time per sample
-        t_end = time.process_time()
+        t_end = time.monotonic()
         t_diff = t_end - t_start
         t_avg_per_sample += t_diff / num_samples
+        timing.record( "sample", t_diff, sample=s_idx, frames=scene.frame_end - scene.frame_start + 1 )
+        timeline.end( "sample", "render" )
 
         print( "Sample [{}] completed! with {} s.".format( s_idx, t_diff ) )
 
@@ -139,6 +345,74 @@ def render( s_start, s_end, s_dir, o_dir, wave_scales, amplifiers ):
 
     logging.debug( "Results available at : {}".format( o_dir ) )
 
+    return resolved
+
+#   resident memory of this process in MB
+def memory_usage():
+
+    try:
+        with open( "/proc/self/statm", "r" ) as statm_fp:
+            rss_pages = int( statm_fp.read().split()[1] )
+        return rss_pages * os.sysconf( 'SC_PAGE_SIZE' ) / ( 1024 * 1024 )
+    except ( OSError, ValueError, AttributeError ):
+        pass
+
+    try:
+        import resource
+        #   peak resident set size, in KB on linux
+        return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024
+    except ImportError:
+        return 0.0
+
+#   keep the scene loaded and take sample jobs from the queue until it is empty
+#   with wait, an empty queue is polled until it is closed by the producer
+def serve( q_dir, worker_id, max_samples, max_memory, undistorted='render', wait=False, analytic_min_psnr=projection.default_min_psnr ):
+
+    print( ">>>>>\tStart serving jobs from {}".format( q_dir ) )
+
+    #   leases are renewed after every frame
+    add_render_handlers()
+
+    num_rendered = 0
+    while True:
+
+        claimed = jobs.claim( q_dir, worker_id )
+        if claimed is None:
+            if wait and not jobs.is_closed( q_dir ):
+                time.sleep( 0.5 )
+                continue
+            print( "Job queue is empty, {} samples rendered by this worker.".format( num_rendered ) )
+            return EXIT_QUEUE_EMPTY
+        claimed_path, job = claimed
+        render_state['claimed'] = claimed_path
+
+        s_start, s_end = job['samples']
+        f_start, f_end = job['frames']
+        t_start = time.monotonic()
+        timeline.begin( "job", "render", samples=[ s_start, s_end ], frames=[ f_start, f_end ] )
+
+        anim.set_target_frame( f_start, f_end )
+        #   frame shards after the first one leave the undistorted target to the first
+        resolved = render( s_start, s_end, job['sample_dir'], job['output_dir'], list( job['wave_scales'] ), list( job['amplifiers'] ),
+                undistorted if job.get( 'undistorted', True ) else 'skip', job.get( 'musgrave' ), job.get( 'seed', -1 ),
+                analytic_min_psnr )
+
+        #   report wall-clock throughput of this device and the parameters used back to the scheduler
+        jobs.complete( claimed_path, dict( seconds=time.monotonic() - t_start,
+                                           frames=( s_end - s_start + 1 ) * ( f_end - f_start + 1 ),
+                                           params=resolved ), job )
+        render_state['claimed'] = None
+        timeline.end( "job", "render" )
+
+        #   recycle this worker to release leaked memory
+        num_rendered += s_end - s_start + 1
+        if max_samples > 0 and num_rendered >= max_samples:
+            print( "Recycling worker after {} samples.".format( num_rendered ) )
+            return EXIT_RECYCLE
+        if max_memory > 0 and memory_usage() >= max_memory:
+            print( "Recycling worker with {:.0f} MB in use.".format( memory_usage() ) )
+            return EXIT_RECYCLE
+
 
 if __name__ == "__main__":
 
@@ -159,14 +433,59 @@ if __name__ == "__main__":
             help='''distortion amplifier. recommended values are between 0.17 - 0.56. 
                     this will be applied to **ALL** samples. if you are not certain, 
                     leave this parameter to let the script properly randomize for **EACH** sample.''' )
+    parser.add_argument( '--preset', type=str, default=default_preset_path,
+            help='''render quality preset ( JSON ) applied before rendering if it exists,
+                    default is render_preset.json next to the .blend file.''' )
+    parser.add_argument( '--benchmark', action='store_true',
+            help='''render the first sample at reference quality and with cheaper settings on CPU,
+                    report time per frame against PSNR / SSIM and write the chosen preset to --preset.''' )
+    parser.add_argument( '--persistent_data', action='store_true',
+            help='''keep the render data ( scene, BVH, kernels ) between frames and samples, the texture and the
+                    material are updated in place instead of being replaced or relinked.''' )
+    parser.add_argument( '--benchmark_persistent', action='store_true',
+            help='''render --samples without and with --persistent_data and compare the time per frame and per sample.''' )
+    parser.add_argument( '--min_psnr', type=float, default=35.0,
+            help='(benchmark only) minimum PSNR in dB of the chosen preset against the reference.' )
+    parser.add_argument( '--min_ssim', type=float, default=0.95,
+            help='(benchmark only) minimum SSIM of the chosen preset against the reference.' )
+    parser.add_argument( '--timing_file', type=str, default='',
+            help='''append wall-clock timing records ( JSON lines, see timing.py ) of every stage, sample and
+                    frame to this file.''' )
+    parser.add_argument( '--seed', type=int, default=-1,
+            help='''run seed, randomized parameters of a sample then only depend on it and on the sample index,
+                    whichever process renders it. default is -1 ( process-global random state ).''' )
     parser.add_argument( '--param_file', type=str, default='',
             help='''path to JSON file containing wave scale and amplifier parameter list. note that
                     the length of parameter list must compatible with given sample indices.''' )
     parser.add_argument( '--gpu_id', type=int, default=-1,
             help='''(CUDA only) gpu id to be used (will use this gpu only), use all that is available if not specified. 
                     No effect on non-NVIDIA system''' )
+    parser.add_argument( '--cpu', action='store_true',
+            help='render on CPU only, with --threads threads pinned to --cores.' )
+    parser.add_argument( '--threads', type=int, default=0,
+            help='(CPU only) number of render threads, default is 0 ( every core ).' )
+    parser.add_argument( '--cores', type=int, nargs='+', default=[],
+            help='(CPU only) core indices this process is restricted to, default is every core.' )
     parser.add_argument( '--output_dir', type=str, default='../../data',
             help='directory to place output images (in distorted/undistorted directories), default is ../../data.' )
+    parser.add_argument( '--undistorted', type=str, default='render', choices=[ 'render', 'analytic', 'skip' ],
+            help='''how to produce the undistorted target. 'analytic' projects the texture through a
+                    precomputed per-camera map instead of rendering it (cached by image content). the first sample
+                    of every camera is rendered to calibrate the map, which is refused below --analytic_min_psnr.''' )
+    parser.add_argument( '--analytic_min_psnr', type=float, default=projection.default_min_psnr,
+            help='(analytic only) minimum PSNR in dB of the calibrated projection against the Cycles render.' )
+    parser.add_argument( '--queue_dir', type=str, default='',
+            help='''run as a persistent worker taking sample jobs from this queue directory (see jobs.py)
+                    instead of rendering --samples. exits when the queue is empty. the directory can be shared
+                    by several nodes, the lease of a job is renewed after every rendered frame.''' )
+    parser.add_argument( '--wait', action='store_true',
+            help='(worker only) keep polling an empty queue until it is closed ( see jobs.close ).' )
+    parser.add_argument( '--worker_id', type=str, default='',
+            help='name of this worker in the job queue, default is the process id.' )
+    parser.add_argument( '--max_samples', type=int, default=0,
+            help='(worker only) exit for recycling after rendering this many samples, 0 means no limit.' )
+    parser.add_argument( '--max_memory', type=float, default=0.0,
+            help='(worker only) exit for recycling once resident memory exceeds this many MB, 0 means no limit.' )
 
     if '--' in sys.argv:
         args = parser.parse_args( sys.argv[sys.argv.index('--') + 1:] )
@@ -182,10 +501,37 @@ if __name__ == "__main__":
     output_dir = os.path.abspath( bpy.path.abspath( '//' + args.output_dir ) )
     param_file = os.path.abspath( bpy.path.abspath( '//' + args.param_file ) )
 
-    init( frame_start, frame_end, gpu_id )
-    if len(param_file) == 0:
+    preset_path = bpy.path.abspath( args.preset ) if args.preset.startswith( "//" ) else os.path.abspath( args.preset )
+
+    if args.benchmark:
+        init( frame_start, frame_end, gpu_id )
+        run_benchmark( sample_start, sample_dir, output_dir, list( range( frame_start, frame_end + 1 ) ), preset_path,
+                       max( args.seed, 0 ), args.min_psnr, args.min_ssim )
+        sys.exit( 0 )
+
+    if args.benchmark_persistent:
+        init( frame_start, frame_end, gpu_id, preset_path, args.cpu, args.threads, args.cores )
+        run_persistent_benchmark( sample_start, sample_end, sample_dir, output_dir, max( args.seed, 0 ) )
+        sys.exit( 0 )
+
+    init( frame_start, frame_end, gpu_id, preset_path, args.cpu, args.threads, args.cores, args.persistent_data )
+    #   CPU workers are told apart by their worker id
+    device_tag = ( args.worker_id if len(args.worker_id) > 0 else "cpu" ) if args.cpu else gpu_id
+    if len(args.timing_file) > 0:
+        timing_file = args.timing_file if os.path.isabs( args.timing_file ) else bpy.path.abspath( '//' + args.timing_file )
+        init_timing( os.path.abspath( timing_file ), device_tag, args.worker_id )
+    if timeline.enabled():
+        init_trace( device_tag, args.worker_id )
+    if len(args.queue_dir) > 0:
+        queue_dir = args.queue_dir if os.path.isabs( args.queue_dir ) else bpy.path.abspath( '//' + args.queue_dir )
+        queue_dir = os.path.abspath( queue_dir )
+        worker_id = args.worker_id if len(args.worker_id) > 0 else str( os.getpid() )
+        sys.exit( serve( queue_dir, worker_id, args.max_samples, args.max_memory, args.undistorted, args.wait,
+                         args.analytic_min_psnr ) )
+    elif len(args.param_file) == 0:
         num_samples = sample_end - sample_start + 1
-        render( sample_start, sample_end, sample_dir, output_dir, [wave_scale] * num_samples, [amplifier] * num_samples )
+        render( sample_start, sample_end, sample_dir, output_dir, [wave_scale] * num_samples, [amplifier] * num_samples, args.undistorted,
+                seed=args.seed, analytic_min_psnr=args.analytic_min_psnr )
     else:
         #   load parameters from file
         with open( param_file, "r" ) as param_fp:
@@ -204,5 +550,12 @@ if __name__ == "__main__":
         wave_scales = wave_scales_all[sample_start:sample_end+1]
         amplifiers = amplifiers_all[sample_start:sample_end+1]
 
-        render( sample_start, sample_end, sample_dir, output_dir, wave_scales, amplifiers )
+        #   explicit W keyframes and fine scales, if the parameter file has them
+        musgrave = None
+        if 'w_coarse' in params:
+            musgrave = [ dict( w_coarse=params['w_coarse'][i], w_fine=params['w_fine'][i], scale_fine=params['fine_scales'][i] )
+                         for i in range( sample_start, sample_end + 1 ) ]
+
+        render( sample_start, sample_end, sample_dir, output_dir, wave_scales, amplifiers, args.undistorted, musgrave,
+                args.seed if args.seed >= 0 else params.get( 'seed', -1 ), args.analytic_min_psnr )
 
@@ -0,0 +1,280 @@
+import bpy
+import os
+import shutil
+import json
+import hashlib
+import logging
+import numpy as np
+
+#   analytic replacement of the UNDISTORTED render
+#   without the displacement, the camera sees the texture plane through a flat water
+#   surface, so every output pixel maps to a fixed texture coordinate. that mapping
+#   ( projection map ) only depends on the camera and the resolution and is computed once.
+#   the map ignores refraction / reflection at the flat water surface and the view transform ( Filmic ),
+#   so every projection is calibrated against one Cycles render of the flat water first : a per-channel
+#   tone curve is fitted from the texture values to the rendered ones, and the projection is refused
+#   ( targets are rendered instead ) if the corrected result still differs from Cycles by more than min_psnr.
+
+#   name of the material holding the sample texture
+texture_material_name = "Material.Text"
+
+#   projection maps already computed by this process, keyed by camera/resolution
+map_memo = {}
+
+#   calibrations already read by this process, keyed by camera/resolution
+calibration_memo = {}
+
+#   default agreement required between the calibrated projection and Cycles, in dB
+default_min_psnr = 30.0
+
+#   levels of the fitted tone curve
+curve_levels = 256
+
+
+#   render resolution in pixels ( width, height )
+def output_resolution( scene ):
+
+    scale = scene.render.resolution_percentage / 100.0
+    return int( scene.render.resolution_x * scale ), int( scene.render.resolution_y * scale )
+
+#   find the object showing the sample texture
+def texture_plane( scene ):
+
+    for obj in scene.objects:
+        if obj.type != 'MESH':
+            continue
+        for slot in obj.material_slots:
+            if slot.material is not None and slot.material.name == texture_material_name:
+                return obj
+
+    raise RuntimeError( "No object uses material {}".format( texture_material_name ) )
+
+#   hash of everything the projection map depends on
+def map_key( scene ):
+
+    cam = scene.camera
+    plane = texture_plane( scene )
+    h = hashlib.sha1()
+    for value in ( output_resolution( scene ), cam.data.type, cam.data.lens, cam.data.ortho_scale,
+                   cam.data.sensor_width, cam.data.sensor_height, cam.data.sensor_fit,
+                   cam.data.shift_x, cam.data.shift_y,
+                   [ tuple( row ) for row in cam.matrix_world ], [ tuple( row ) for row in plane.matrix_world ] ):
+        h.update( repr( value ).encode() )
+    return h.hexdigest()[:16]
+
+#   compute texture coordinates ( u, v ) in [0, 1] for every output pixel, shape ( H, W, 2 )
+#   pixels whose ray misses the plane get NaN
+def compute_map( scene ):
+
+    width, height = output_resolution( scene )
+    cam = scene.camera
+    plane = texture_plane( scene )
+
+    #   camera frame corners in world space : top-right, bottom-right, bottom-left, top-left
+    frame = [ cam.matrix_world @ corner for corner in cam.data.view_frame( scene=scene ) ]
+    tr, br, bl, tl = [ np.array( corner ) for corner in frame ]
+
+    xs = ( np.arange( width ) + 0.5 ) / width
+    ys = ( np.arange( height ) + 0.5 ) / height
+    points = tl[None, None, :] + ( tr - tl )[None, None, :] * xs[None, :, None] + ( bl - tl )[None, None, :] * ys[:, None, None]
+
+    cam_origin = np.array( cam.matrix_world.translation )
+    if cam.data.type == 'ORTHO':
+        cam_dir = -np.array( cam.matrix_world.to_3x3().col[2] )
+        origins = points
+        directions = np.broadcast_to( cam_dir, points.shape )
+    else:
+        origins = np.broadcast_to( cam_origin, points.shape )
+        directions = points - cam_origin
+
+    #   intersect rays with the plane z = 0 in its local space
+    to_local = np.array( plane.matrix_world.inverted() )
+    o_local = origins @ to_local[:3, :3].T + to_local[:3, 3]
+    d_local = directions @ to_local[:3, :3].T
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        t = -o_local[..., 2] / d_local[..., 2]
+    hit = o_local + d_local * t[..., None]
+    hit[ ~( t > 0 ) ] = np.nan
+
+    #   normalize by the plane bounding box to get texture coordinates
+    bbox = np.array( [ tuple( v ) for v in plane.bound_box ] )
+    lo, hi = bbox.min( axis=0 ), bbox.max( axis=0 )
+    uv = ( hit[..., :2] - lo[:2] ) / ( hi[:2] - lo[:2] )
+
+    logging.debug( "Projection map computed for {}x{}".format( width, height ) )
+
+    return uv.astype( np.float32 )
+
+#   projection map for the current scene, from memory, disk cache or computed
+def get_map( scene, cache_dir ):
+
+    key = map_key( scene )
+    if key in map_memo:
+        return key, map_memo[key]
+
+    map_path = os.path.join( cache_dir, "projection_" + key + ".npy" )
+    if os.path.exists( map_path ):
+        uv = np.load( map_path )
+    else:
+        uv = compute_map( scene )
+        os.makedirs( cache_dir, exist_ok=True )
+        np.save( map_path, uv )
+
+    map_memo[key] = uv
+    return key, uv
+
+#   read pixels of a Blender image as float RGBA, shape ( H, W, 4 ), first row at the bottom
+def image_pixels( img ):
+
+    width, height = img.size
+    pixels = np.empty( width * height * 4, dtype=np.float32 )
+    img.pixels.foreach_get( pixels )
+    return pixels.reshape( height, width, 4 )
+
+#   apply the projection map to the texture with bilinear filtering
+def apply_map( pixels, uv ):
+
+    height, width = pixels.shape[:2]
+    valid = np.isfinite( uv[..., 0] ) & ( uv[..., 0] >= 0.0 ) & ( uv[..., 0] <= 1.0 ) & ( uv[..., 1] >= 0.0 ) & ( uv[..., 1] <= 1.0 )
+    u = np.clip( np.nan_to_num( uv[..., 0] ) * width - 0.5, 0.0, width - 1.0 )
+    v = np.clip( np.nan_to_num( uv[..., 1] ) * height - 0.5, 0.0, height - 1.0 )
+    u0 = np.minimum( np.floor( u ).astype( np.intp ), max( width - 2, 0 ) )
+    v0 = np.minimum( np.floor( v ).astype( np.intp ), max( height - 2, 0 ) )
+    u1 = np.minimum( u0 + 1, width - 1 )
+    v1 = np.minimum( v0 + 1, height - 1 )
+    fu = ( u - u0 )[..., None]
+    fv = ( v - v0 )[..., None]
+
+    top = pixels[v0, u0] * ( 1.0 - fu ) + pixels[v0, u1] * fu
+    bottom = pixels[v1, u0] * ( 1.0 - fu ) + pixels[v1, u1] * fu
+    out = top * ( 1.0 - fv ) + bottom * fv
+    out[ ~valid ] = ( 0.0, 0.0, 0.0, 1.0 )
+    return out
+
+#   hash of the sample file content
+def file_hash( path ):
+
+    h = hashlib.sha1()
+    with open( path, "rb" ) as fp:
+        for chunk in iter( lambda: fp.read( 1 << 20 ), b"" ):
+            h.update( chunk )
+    return h.hexdigest()
+
+#   write float RGBA pixels ( first row at the bottom ) as a JPEG through Blender
+def save_pixels( pixels, path ):
+
+    height, width = pixels.shape[:2]
+    img = bpy.data.images.new( "undistorted.analytic", width, height )
+    img.pixels.foreach_set( pixels.ravel() )
+    img.filepath_raw = path
+    img.file_format = 'JPEG'
+    img.save()
+    bpy.data.images.remove( img )
+
+#   projected pixels ( first row at the bottom ) and the mask of pixels whose ray hits the texture
+def project( scene, img, cache_dir ):
+
+    _, uv = get_map( scene, cache_dir )
+    valid = np.isfinite( uv[..., 0] ) & ( uv[..., 0] >= 0.0 ) & ( uv[..., 0] <= 1.0 ) & ( uv[..., 1] >= 0.0 ) & ( uv[..., 1] <= 1.0 )
+
+    #   projection map rows start at the top of the frame, Blender images at the bottom
+    return apply_map( image_pixels( img ), uv )[::-1], valid[::-1]
+
+#   per-channel tone curve taking projected values to rendered ones, shape ( 3, curve_levels )
+#   levels without any pixel are interpolated from their neighbours
+def fit_curve( projected, rendered, valid ):
+
+    levels = np.arange( curve_levels ) / ( curve_levels - 1.0 )
+    curve = np.empty( ( 3, curve_levels ), dtype=np.float64 )
+    for c in range( 3 ):
+        bins = np.clip( np.rint( projected[..., c][valid] * ( curve_levels - 1 ) ).astype( np.intp ), 0, curve_levels - 1 )
+        counts = np.bincount( bins, minlength=curve_levels )
+        sums = np.bincount( bins, weights=rendered[..., c][valid], minlength=curve_levels )
+        seen = counts > 0
+        curve[c] = np.interp( levels, levels[seen], sums[seen] / counts[seen] ) if seen.any() else levels
+    return curve
+
+def apply_curve( pixels, curve ):
+
+    levels = np.arange( curve_levels ) / ( curve_levels - 1.0 )
+    out = pixels.copy()
+    for c in range( 3 ):
+        out[..., c] = np.interp( pixels[..., c], levels, curve[c] )
+    return out
+
+def psnr( a, b ):
+
+    mse = float( np.mean( ( a - b ) ** 2 ) )
+    return float( "inf" ) if mse == 0.0 else 10.0 * np.log10( 1.0 / mse )
+
+def calibration_path( cache_dir, key ):
+
+    return os.path.join( cache_dir, "projection_" + key + ".calibration.json" )
+
+#   calibration of the current projection, None if it was never compared with Cycles
+def get_calibration( scene, cache_dir ):
+
+    key = map_key( scene )
+    if key not in calibration_memo:
+        path = calibration_path( cache_dir, key )
+        if not os.path.exists( path ):
+            return None
+        with open( path, "r" ) as fp:
+            calibration_memo[key] = json.load( fp )
+    return calibration_memo[key]
+
+#   compare the projection of img with the Cycles render of the same flat water ( rendered_path ),
+#   fit the tone curve and decide whether the projection can replace the render
+def calibrate( scene, img, rendered_path, cache_dir, min_psnr=default_min_psnr ):
+
+    key = map_key( scene )
+    projected, valid = project( scene, img, cache_dir )
+
+    rendered_img = bpy.data.images.load( rendered_path, check_existing=False )
+    rendered = image_pixels( rendered_img )
+    bpy.data.images.remove( rendered_img )
+
+    if rendered.shape != projected.shape or not valid.any():
+        calibration = dict( key=key, psnr_raw=0.0, psnr=0.0, min_psnr=min_psnr, ok=False, curve=None )
+    else:
+        curve = fit_curve( projected, rendered, valid )
+        corrected = apply_curve( projected, curve )
+        calibration = dict( key=key, min_psnr=min_psnr, curve=curve.tolist(),
+                            psnr_raw=psnr( projected[..., :3], rendered[..., :3] ),
+                            psnr=psnr( corrected[..., :3], rendered[..., :3] ) )
+        calibration['ok'] = calibration['psnr'] >= min_psnr
+
+    os.makedirs( cache_dir, exist_ok=True )
+    path = calibration_path( cache_dir, key )
+    with open( path + ".tmp", "w" ) as fp:
+        json.dump( calibration, fp )
+    os.replace( path + ".tmp", path )
+    calibration_memo[key] = calibration
+
+    logging.debug( "Projection {} against Cycles : {:.2f} dB raw, {:.2f} dB calibrated".format(
+        key, calibration['psnr_raw'], calibration['psnr'] ) )
+
+    return calibration
+
+#   produce the undistorted target of a sample without rendering, returns True on cache hit
+#   the projection must have been calibrated ( see calibrate ) and accepted
+def write_undistorted( scene, img, img_path, out_path, cache_dir ):
+
+    key = map_key( scene )
+    calibration = get_calibration( scene, cache_dir )
+    assert calibration is not None and calibration['ok'], "Projection {} was not accepted against Cycles.".format( key )
+
+    #   results are keyed by projection and image content
+    cached_path = os.path.join( cache_dir, "undistorted_calibrated", key + "_" + file_hash( img_path ) + ".jpg" )
+    os.makedirs( os.path.dirname( out_path ), exist_ok=True )
+    if os.path.exists( cached_path ):
+        shutil.copyfile( cached_path, out_path )
+        return True
+
+    projected, _ = project( scene, img, cache_dir )
+    out = apply_curve( projected, np.array( calibration['curve'] ) )
+    save_pixels( np.ascontiguousarray( out ), out_path )
+
+    os.makedirs( os.path.dirname( cached_path ), exist_ok=True )
+    shutil.copyfile( out_path, cached_path )
+    return False
@@ -0,0 +1,115 @@
+import os
+import glob
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+#   opt-in trace timeline of a whole run.py invocation, in the Chrome trace event format
+#   ( chrome://tracing, https://ui.perfetto.dev ).
+#   tracing is enabled by setting trace_dir_env to a directory, which every subprocess inherits.
+#   each process appends begin / end events, one JSON object per line, to its own trace.<pid>.jsonl
+#   in that directory, and merge() turns all of them into a single timeline.
+#   this module does not depend on bpy, run.py and the Blender workers share it
+
+#   environment variable holding the trace directory
+trace_dir_env = "RENDER_TRACE_DIR"
+trace_name_format = "trace.{}.jsonl"
+
+#   file events are appended to, the process it belongs to and the fields added to every event
+trace_fp = None
+trace_pid = None
+trace_tags = {}
+trace_lock = threading.Lock()
+
+
+def enabled():
+
+    return len( os.environ.get( trace_dir_env, "" ) ) > 0
+
+#   enable tracing for this process and every subprocess started afterwards
+def enable( trace_dir ):
+
+    os.makedirs( trace_dir, exist_ok=True )
+    os.environ[trace_dir_env] = os.path.abspath( trace_dir )
+
+#   name this process on the timeline and tag its events with the given fields ( device ... )
+def init( process_name, **tags ):
+
+    trace_tags.clear()
+    trace_tags.update( tags )
+    event( "process_name", "M", args=dict( name=process_name ) )
+
+#   per-process file, reopened in processes forked after it was opened ( process pools )
+def trace_file():
+
+    global trace_fp, trace_pid
+    if trace_pid != os.getpid():
+        trace_fp = open( os.path.join( os.environ[trace_dir_env], trace_name_format.format( os.getpid() ) ), "a" )
+        trace_pid = os.getpid()
+    return trace_fp
+
+#   timestamps are wall-clock microseconds, the only clock all processes agree on
+def event( name, ph, cat="run", ts=None, **fields ):
+
+    if not enabled():
+        return
+    entry = dict( fields, name=name, cat=cat, ph=ph, ts=( time.time() * 1e6 if ts is None else ts ),
+                  pid=os.getpid(), tid=threading.get_ident() )
+    entry['args'] = dict( trace_tags, **entry.get( 'args', {} ) )
+    with trace_lock:
+        fp = trace_file()
+        fp.write( json.dumps( entry ) + "\n" )
+        fp.flush()
+
+def begin( name, cat="run", **args ):
+
+    event( name, "B", cat, args=args )
+
+def end( name, cat="run", **args ):
+
+    event( name, "E", cat, args=args )
+
+#   event of a block that already ended, seconds long
+def complete( name, seconds, cat="run", **args ):
+
+    event( name, "X", cat, ts=( time.time() - seconds ) * 1e6, dur=seconds * 1e6, args=args )
+
+def instant( name, cat="run", **args ):
+
+    event( name, "i", cat, s="p", args=args )
+
+#   begin and end events around the enclosed block
+@contextmanager
+def span( name, cat="run", **args ):
+
+    begin( name, cat, **args )
+    try:
+        yield
+    finally:
+        end( name, cat )
+
+#   merge the event files of every process into one Chrome trace JSON, returns the number of events
+def merge( trace_dir, out_path ):
+
+    events = []
+    for path in sorted( glob.glob( os.path.join( trace_dir, trace_name_format.format( "*" ) ) ) ):
+        with open( path, "r" ) as fp:
+            for line in fp:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    events.append( json.loads( line ) )
+                except ValueError:
+                    #   last line of a process killed while writing
+                    pass
+
+    #   process names first, every other event in time order
+    events.sort( key=lambda e: ( e['ph'] != "M", e['ts'] ) )
+
+    os.makedirs( os.path.dirname( os.path.abspath( out_path ) ), exist_ok=True )
+    with open( out_path + ".tmp", "w" ) as fp:
+        json.dump( dict( traceEvents=events, displayTimeUnit="ms" ), fp )
+    os.replace( out_path + ".tmp", out_path )
+    return len( events )
@@ -0,0 +1,109 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from contextlib import contextmanager
+
+#   wall-clock timing records of the render workers, one JSON object per line :
+#   { "time", "pid", "device", "stage", "seconds", "sample", "frame" }
+#   stages are texture_load, params, undistorted ( render or projection ), undistorted_write,
+#   frame ( render of one distorted frame ), frame_write and sample ( everything for one sample )
+#   this module does not depend on bpy, run.py uses it to summarize the records of every device
+
+#   file records are appended to, and fields added to every record
+records_fp = None
+record_tags = {}
+
+
+#   start appending records to path, tagged with the given fields ( device, worker ... )
+def open_records( path, **tags ):
+
+    global records_fp
+    close_records()
+    os.makedirs( os.path.dirname( os.path.abspath( path ) ), exist_ok=True )
+    records_fp = open( path, "a" )
+    record_tags.clear()
+    record_tags.update( tags, pid=os.getpid() )
+
+def close_records():
+
+    global records_fp
+    if records_fp is not None:
+        records_fp.close()
+        records_fp = None
+
+def record( stage, seconds, **fields ):
+
+    if records_fp is None:
+        return
+    entry = dict( record_tags, time=time.time(), stage=stage, seconds=seconds, **fields )
+    records_fp.write( json.dumps( entry ) + "\n" )
+    records_fp.flush()
+
+#   time the enclosed block with the monotonic clock
+@contextmanager
+def timed( stage, **fields ):
+
+    t_start = time.monotonic()
+    try:
+        yield
+    finally:
+        record( stage, time.monotonic() - t_start, **fields )
+
+#   read every record of the given files
+def load( paths ):
+
+    records = []
+    for path in paths:
+        with open( path, "r" ) as fp:
+            for line in fp:
+                line = line.strip()
+                if line:
+                    records.append( json.loads( line ) )
+    return records
+
+def percentile( values, q ):
+
+    values = sorted( values )
+    return values[ min( len( values ) - 1, int( q * len( values ) ) ) ]
+
+#   { device: { stage: { count, total, mean, p50, p95, max } } }, device "all" aggregates every device
+def summarize( records ):
+
+    seconds = {}
+    for r in records:
+        for device in ( str( r.get( "device", "?" ) ), "all" ):
+            seconds.setdefault( device, {} ).setdefault( r["stage"], [] ).append( r["seconds"] )
+
+    return { device: { stage: dict( count=len( values ), total=sum( values ), mean=sum( values ) / len( values ),
+                                    p50=percentile( values, 0.5 ), p95=percentile( values, 0.95 ), max=max( values ) )
+                       for stage, values in stages.items() }
+             for device, stages in seconds.items() }
+
+def print_summary( summary ):
+
+    for device in sorted( summary, key=lambda d: ( d == "all", d ) ):
+        stages = summary[device]
+        total = sum( s["total"] for stage, s in stages.items() if stage != "sample" )
+        print( "Device {} :".format( device ) )
+        for stage, s in sorted( stages.items(), key=lambda item: -item[1]["total"] ):
+            share = " {:5.1f}%".format( 100.0 * s["total"] / total ) if stage != "sample" and total > 0 else "       "
+            print( "\t{:<18}{:>7} x  mean {:8.3f} s  p50 {:8.3f} s  p95 {:8.3f} s  max {:8.3f} s  total {:10.1f} s{}".format(
+                stage, s["count"], s["mean"], s["p50"], s["p95"], s["max"], s["total"], share ) )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser( description='Summarize render timing records ( render.timing.N.jsonl ).' )
+    parser.add_argument( 'paths', nargs='+', help='record files or glob patterns.' )
+    parser.add_argument( '--json', action='store_true', help='print the summary as JSON.' )
+    args = parser.parse_args()
+
+    paths = sorted( set( p for pattern in args.paths for p in ( glob.glob( pattern ) or [ pattern ] ) ) )
+    summary = summarize( load( paths ) )
+    if args.json:
+        json.dump( summary, sys.stdout, indent=2 )
+    else:
+        print_summary( summary )
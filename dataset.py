@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+#   Random access reader of the ( distorted frames, undistorted target, params ) pairs produced by run.py,
+#   either as loose JPEGs ( blender/output, params from its manifest.json ) or as packed shards
+#   ( blender/shards, see shards.py ). Shards are memory mapped and members are decoded straight from
+#   the mapping. With a cache directory, every decoded sample is also kept as uint8 .npy arrays which
+#   are memory mapped on later reads, so that only the first epoch pays for JPEG decoding.
+
+import os
+import io
+import json
+import mmap
+import random
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+import manifest as manifest_module
+import shards
+
+MANIFEST_NAME = 'manifest.json'
+CACHE_FRAMES_FORMAT = '{:06d}.frames.npy'
+CACHE_TARGET_FORMAT = '{:06d}.target.npy'
+
+def decodeJpeg(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert('RGB'), dtype=np.uint8)
+
+#   dataset opened by each decoding process of GeneratedDataset.batches, only sample ids are sent to it
+_worker_dataset = None
+
+def _openWorkerDataset(path, cache_dir):
+    global _worker_dataset
+    _worker_dataset = GeneratedDataset(path, cache_dir)
+
+def _workerBatch(sample_ids):
+    return _worker_dataset.batch(sample_ids)
+
+def saveArray(path, array):
+    tmp_path = '{}.{}.tmp.npy'.format(path, os.getpid())
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+class GeneratedDataset():
+    def __init__(self, path, cache_dir=None):
+        '''path is a shard directory ( holding index.json ) or a render output directory'''
+        self.path = path
+        self.cache_dir = cache_dir
+        self.maps = {}
+
+        index_path = os.path.join(path, shards.SHARD_INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as fp:
+                self.index = json.load(fp)
+            self.packed = True
+            self.n_frames = self.index['n_frames']
+            self.ids = sorted(int(sample_id) for sample_id in self.index['samples'])
+        else:
+            self.index = None
+            self.packed = False
+            self.manifest = manifest_module.Manifest(os.path.join(path, MANIFEST_NAME))
+            undistorted_dir = os.path.join(path, 'undistorted')
+            self.ids = sorted(int(os.path.splitext(name)[0]) for name in os.listdir(undistorted_dir)
+                              if name.endswith('.jpg')) if os.path.isdir(undistorted_dir) else []
+            first_frames = os.path.join(path, 'distorted', '{:04d}'.format(self.ids[0])) if self.ids else None
+            self.n_frames = len(os.listdir(first_frames)) if first_frames and os.path.isdir(first_frames) else 0
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    #   memory maps cannot be sent to worker processes, every process opens its own
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['maps'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.sample(self.ids[i])
+
+    def sampleIds(self):
+        return list(self.ids)
+
+    def _shardMap(self, shard):
+        if shard not in self.maps:
+            with open(os.path.join(self.path, self.index['shards'][shard]), 'rb') as fp:
+                self.maps[shard] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[shard]
+
+    def _member(self, sample_id, member):
+        entry = self.index['samples'][str(sample_id)]
+        offset, size = entry['members'][member]
+        return self._shardMap(entry['shard'])[offset:offset + size]
+
+    def params(self, sample_id):
+        if self.packed:
+            return json.loads(bytes(self._member(sample_id, shards.PARAMS_NAME)).decode('utf-8'))
+        entry = self.manifest.sample(sample_id)
+        return dict(entry['params'], source=entry['source'], hash=entry['hash']) if entry is not None else {}
+
+    def _decode(self, sample_id):
+        if self.packed:
+            target = decodeJpeg(self._member(sample_id, shards.UNDISTORTED_NAME))
+            frames = np.stack([ decodeJpeg(self._member(sample_id, shards.FRAME_NAME_FORMAT.format(f)))
+                                for f in range(1, self.n_frames + 1) ])
+        else:
+            undistorted, frame_paths = manifest_module.outputPaths(self.path, sample_id, self.n_frames)
+            with open(undistorted, 'rb') as fp:
+                target = decodeJpeg(fp.read())
+            frames = []
+            for f in range(1, self.n_frames + 1):
+                with open(frame_paths[f], 'rb') as fp:
+                    frames.append(decodeJpeg(fp.read()))
+            frames = np.stack(frames)
+        return frames, target
+
+    def arrays(self, sample_id):
+        '''( distorted frames uint8 ( F, H, W, 3 ), undistorted target uint8 ( H, W, 3 ) )'''
+        if self.cache_dir is None:
+            return self._decode(sample_id)
+
+        frames_path = os.path.join(self.cache_dir, CACHE_FRAMES_FORMAT.format(sample_id))
+        target_path = os.path.join(self.cache_dir, CACHE_TARGET_FORMAT.format(sample_id))
+        if not (os.path.exists(frames_path) and os.path.exists(target_path)):
+            frames, target = self._decode(sample_id)
+            saveArray(frames_path, frames)
+            saveArray(target_path, target)
+        return np.load(frames_path, mmap_mode='r'), np.load(target_path, mmap_mode='r')
+
+    def sample(self, sample_id):
+        '''( distorted frames, undistorted target, params ) of a sample'''
+        frames, target = self.arrays(sample_id)
+        return frames, target, self.params(sample_id)
+
+    def batch(self, sample_ids):
+        '''stacked ( frames ( B, F, H, W, 3 ), targets ( B, H, W, 3 ), list of params )'''
+        samples = [ self.sample(sample_id) for sample_id in sample_ids ]
+        return (np.stack([ s[0] for s in samples ]), np.stack([ s[1] for s in samples ]),
+                [ s[2] for s in samples ])
+
+    def batches(self, batch_size, shuffle=False, seed=None, n_workers=0, drop_last=False):
+        '''iterate over batches, decoded by n_workers processes ( 0 decodes in the calling process )'''
+        ids = list(self.ids)
+        if shuffle:
+            random.Random(seed).shuffle(ids)
+        groups = [ ids[i:i + batch_size] for i in range(0, len(ids), batch_size) ]
+        if drop_last and groups and len(groups[-1]) < batch_size:
+            groups.pop()
+
+        if n_workers <= 0:
+            for group in groups:
+                yield self.batch(group)
+            return
+
+        #   every worker opens the dataset once, sending it along with each batch would pickle the whole index
+        with Pool(processes=n_workers, initializer=_openWorkerDataset, initargs=(self.path, self.cache_dir)) as p:
+            for batch in p.imap(_workerBatch, groups):
+                yield batch
+
+    def close(self):
+        for m in self.maps.values():
+            m.close()
+        self.maps = {}
@@ -1,54 +1,28 @@
+import io
 import os
+import sys
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from PIL import Image
 
-WordNet_ID_page = urllib.request.urlopen('http://www.image-net.org/api/text/imagenet.synset.obtain_synset_list')
-WordNet_ID_list = []
-URLs_list = []
+WNID_LIST_URL = 'http://www.image-net.org/api/text/imagenet.synset.obtain_synset_list'
+WNID_TO_URLS_URL = 'http://www.image-net.org/api/text/imagenet.synset.geturls?wnid={}'
+MIN_RESOLUTION = 200  # images with a smaller width or height are rejected
+TARGET_SIZE = (224, 224)  # resolution of the saved images
 
 
-# get the WordNet_ID page and create the WordNet_ID list
-def getWNIDPage():
-    for line in WordNet_ID_page:
-        decoded_line = line.decode("utf-8").strip()
-        if len(decoded_line) > 5:
-            WordNet_ID_list.append(decoded_line)
-    print("Successfully created the WordNet_ID list which contains elements : {} ".format(len(WordNet_ID_list)))
-
-
-# create the URLs list from a one WordNet_ID page
-def createURLsList(word_net_id):
-    imagenet_api_wnid_to_urls = lambda \
-            wnid: f'http://www.image-net.org/api/text/imagenet.synset.geturls?wnid={word_net_id}'
-    wnid_to_urls_page = urllib.request.urlopen(imagenet_api_wnid_to_urls(word_net_id))  # to resolve the links
-    for line in wnid_to_urls_page:
-        decoded_line = line.decode("utf-8")
-        if len(decoded_line) > 3:
-            URLs_list.append(decoded_line)
-    print("Successfully fetched {} links from the '{}' WordNet_ID".format(len(URLs_list), word_net_id))
-
-
-# verify that the image is valid and returns the resolution
-def verifyImage(img_name, path):
-    img = Image.open(path + img_name)  # open the image file
+# decode the downloaded bytes in memory, raises IOError/SyntaxError if the image is not a valid JPEG
+# returns the image resized to target_size, or None if its resolution is too small
+def decodeImage(data, min_resolution=MIN_RESOLUTION, target_size=TARGET_SIZE):
+    img = Image.open(io.BytesIO(data))
+    if img.format != 'JPEG':
+        raise SyntaxError("not a JPEG image")
     width, height = img.size
-    img.verify()  # verify that it is, in fact an image
-    # print('Image is valid')
-    return width, height
-
-
-# resize the image resolution to (224,224)
-def resizeImage(img_name, path):
-    img = Image.open(path + img_name)  # open the image file
-    new_image = img.resize((224, 224))
-    new_image.save(path + img_name)
-    # print("image is resized")
-
-
-# delete image if corrupted or if the resolution is too small
-def deleteImage(img_name, path):
-    os.remove(path + img_name)  # delete corrupted images
-    # print("corrupted image is deleted")
+    if width < min_resolution or height < min_resolution:
+        return None
+    img.draft('RGB', target_size)  # let the JPEG decoder downscale while decoding
+    img.load()  # decode the whole image, fails on truncated data
+    return img.convert('RGB').resize(target_size)
 
 
 # create or complete the path if its not exist
@@ -58,56 +32,130 @@ def createFolder(path):
         print("The directory: {} is successfully created".format(path))
 
 
-# to download a specific number of images
-def downloadSamples(num_downloaded_img, output_path):
-    output_path = output_path + '/'  # to assure saving the images in the specific folder
-    createFolder(output_path)  # call createFolder() to create '../../data/samples' output folder path
-    valid_images = 0  # indication for valid images
-    invalid_images = 0  # indication for invalid images
-    invalid_links = 0  # indication for invalid links
-    low_resolution_image = 0  # indication for low resolution images
-    itercounter = 0  # indication for the loop
-    while WordNet_ID_list:
-        if valid_images > num_downloaded_img - 1:  # after reaching the number of required image quit the function
-            print(valid_images, "Valid images with size (224,224) saved ,", invalid_images,
-                  'Invalid images deleted ,', invalid_links, "Invalid Links", low_resolution_image,
-                  " low resolution image deleted")
-            break
-        if len(URLs_list) == 0:  # if the URLs list empty generate new one
-            word_net_id = WordNet_ID_list.pop()  # get new word_net_id
-            createURLsList(word_net_id)  # generate new URLs list
-            print("WordNet ID list has elements {} left ".format(len(WordNet_ID_list)))
-        url = URLs_list.pop()  # get URL to download the image
+class ImageDownloader:
+    """Downloads valid ImageNet images, picking WordNet_IDs one after the other.
+    Nothing is fetched before the first call to downloadSamples(). Up to `workers` URLs are
+    downloaded, decoded and resized at the same time."""
+
+    def __init__(self, workers=16, timeout=10, min_resolution=MIN_RESOLUTION, target_size=TARGET_SIZE,
+                 url_store_path=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.min_resolution = min_resolution
+        self.target_size = target_size
+        self.url_store_path = url_store_path
+        self.url_store = None
+        self.word_net_ids = None  # fetched lazily by getWNIDPage()
+        self.urls = []
+
+    # get the WordNet_ID page and create the WordNet_ID list
+    def getWNIDPage(self):
+        self.word_net_ids = []
+        with urllib.request.urlopen(WNID_LIST_URL, timeout=self.timeout) as page:
+            for line in page:
+                decoded_line = line.decode("utf-8").strip()
+                if len(decoded_line) > 5:
+                    self.word_net_ids.append(decoded_line)
+        print("Successfully created the WordNet_ID list which contains elements : {} ".format(len(self.word_net_ids)))
+
+    # local store of URL lists (built by ImageNet-Datasets-Downloader/url_store.py), opened on first use
+    def getURLStore(self):
+        if self.url_store is None and self.url_store_path is not None:
+            sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'ImageNet-Datasets-Downloader'))
+            from url_store import UrlStore
+            self.url_store = UrlStore(self.url_store_path)
+        return self.url_store
+
+    # create the URLs list from a one WordNet_ID page
+    def createURLsList(self, word_net_id):
+        url_store = self.getURLStore()
+        if url_store is not None and word_net_id in url_store:
+            self.urls.extend(url_store.get(word_net_id))
+            print("Successfully read {} links of the '{}' WordNet_ID from the URL store".format(len(self.urls), word_net_id))
+            return
+        with urllib.request.urlopen(WNID_TO_URLS_URL.format(word_net_id), timeout=self.timeout) as page:
+            for line in page:
+                decoded_line = line.decode("utf-8").strip()
+                if len(decoded_line) > 3:
+                    self.urls.append(decoded_line)
+        print("Successfully fetched {} links from the '{}' WordNet_ID".format(len(self.urls), word_net_id))
+
+    # next URL to try, None once every WordNet_ID is exhausted
+    def nextURL(self):
+        if self.word_net_ids is None:
+            self.getWNIDPage()
+        while len(self.urls) == 0:  # if the URLs list empty generate new one
+            if not self.word_net_ids:
+                return None
+            word_net_id = self.word_net_ids.pop()  # get new word_net_id
+            self.createURLsList(word_net_id)  # generate new URLs list
+            print("WordNet ID list has elements {} left ".format(len(self.word_net_ids)))
+        return self.urls.pop()
+
+    # download, verify and resize one image in a worker thread, returns ( status, JPEG bytes )
+    def fetchImage(self, url):
         try:
-            img_name = f"{valid_images:04d}.jpg"  # create the image name
-            urllib.request.urlretrieve(url, output_path + img_name)  # get the image and save it
-            try:
-                width, height = verifyImage(img_name, output_path)  # verify the image and get width & height for check
-                if width < 200 or height < 200:  # if the height or the width less than 200 delete the image
-                    deleteImage(img_name, output_path)
-                    low_resolution_image += 1  # invalid image increased
-                resizeImage(img_name, output_path)  # resize the image to (224,224)
-                valid_images += 1  # valid image increased after verifying and resizing image
-            except (IOError, SyntaxError):
-                deleteImage(img_name, output_path)  # delete image if it's not valid
-                invalid_images += 1  # invalid image increased
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:  # get the image in memory
+                data = response.read()
         except Exception:
-            invalid_links += 1  # invalid links increased
-
-        itercounter += 1
-        if itercounter % 50 == 0:
-            print('in iteration number : {} there is {} Valid images with size (224,224) saved, {} Invalid images '
-                  'deleted,{} low resolution image deleted and {} Invalid '
-                  'Links"'.format(itercounter, valid_images, invalid_images, low_resolution_image, invalid_links))
-
-
-'''def main(num_downloaded_img, path):
-    downloadSamples(num_downloaded_img, path)
+            return 'invalid_link', None
+        try:
+            img = decodeImage(data, self.min_resolution, self.target_size)
+        except (IOError, SyntaxError, ValueError):
+            return 'invalid_image', None
+        if img is None:
+            return 'low_resolution', None
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG')
+        return 'valid', buffer.getvalue()
+
+    # to download a specific number of images, returns the counters
+    def downloadSamples(self, num_downloaded_img, output_path):
+        createFolder(output_path)
+        counters = dict(valid=0, invalid_image=0, invalid_link=0, low_resolution=0)
+        itercounter = 0
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = set()
+            while counters['valid'] < num_downloaded_img:
+                #   keep every worker busy, but do not start much more than what is still needed
+                while len(in_flight) < min(self.workers, 2 * (num_downloaded_img - counters['valid'])):
+                    url = self.nextURL()
+                    if url is None:
+                        break
+                    in_flight.add(executor.submit(self.fetchImage, url))
+                if not in_flight:
+                    break
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    status, data = future.result()
+                    if status == 'valid':
+                        if counters['valid'] >= num_downloaded_img:  # more images than needed came back
+                            continue
+                        img_name = f"{counters['valid']:04d}.jpg"  # create the image name
+                        with open(os.path.join(output_path, img_name), 'wb') as fp:  # the only write of the image
+                            fp.write(data)
+                    counters[status] += 1
+
+                    itercounter += 1
+                    if itercounter % 50 == 0:
+                        print('in iteration number : {} there is {} Valid images with size {} saved, {} Invalid images '
+                              'skipped,{} low resolution image skipped and {} Invalid '
+                              'Links'.format(itercounter, counters['valid'], self.target_size, counters['invalid_image'],
+                                             counters['low_resolution'], counters['invalid_link']))
+
+            for future in in_flight:
+                future.cancel()
+
+        print(counters['valid'], "Valid images with size {} saved ,".format(self.target_size), counters['invalid_image'],
+              'Invalid images skipped ,', counters['invalid_link'], "Invalid Links", counters['low_resolution'],
+              " low resolution image skipped")
+        return counters
 
 
 if __name__ == '__main__':
     num_downloaded_img = 100  # number of samples to be downloaded
     output_path = '../../data/samples'  # output folder path
-    getWNIDPage()  # to be executed only one time to initialize the lists needed to generate Links
-    main(num_downloaded_img, output_path)  # to be executed as many as we want samples and there is
-'''
\ No newline at end of file
+    downloader = ImageDownloader(workers=16)
+    downloader.downloadSamples(num_downloaded_img, output_path)  # to be executed as many as we want samples
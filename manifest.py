@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+#   Bookkeeping of a run.py invocation, so that an interrupted run can be resumed.
+#   The manifest records which stages are complete and, per sample, the source image,
+#   its hash, its distortion parameters and the size and checksum of every output file.
+
+import os
+import json
+import random
+import hashlib
+
+MANIFEST_VERSION = 1
+
+def fileHash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def jpegComplete(path):
+    '''whether a JPEG file ends with its end of image marker, files cut short while being written do not'''
+    with open(path, 'rb') as fp:
+        fp.seek(max(os.path.getsize(path) - 64, 0))
+        tail = fp.read().rstrip(b'\x00')
+    return tail.endswith(b'\xff\xd9')
+
+def outputPaths(output_dir, sample_id, n_frames, name_format="{:04d}.jpg"):
+    '''paths of the undistorted target and of every distorted frame of a sample'''
+    sample_name = name_format.format(sample_id)
+    undistorted = os.path.join(output_dir, 'undistorted', sample_name)
+    distorted_dir = os.path.join(output_dir, 'distorted', os.path.splitext(sample_name)[0])
+    frames = { f: os.path.join(distorted_dir, name_format.format(f)) for f in range(1, n_frames + 1) }
+    return undistorted, frames
+
+class Manifest():
+    def __init__(self, path):
+        self.path = path
+        self.data = dict(version=MANIFEST_VERSION, stages={}, samples={})
+
+        if os.path.exists(path):
+            with open(path, 'r') as fp:
+                self.data = json.load(fp)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.data, fp)
+        os.replace(tmp_path, self.path)
+
+    def seed(self, seed=None):
+        '''run seed of the per-sample parameters, the one of the interrupted run when resuming'''
+        if 'seed' not in self.data:
+            self.data['seed'] = seed if seed is not None else random.randrange(2 ** 31)
+            self.save()
+        elif seed is not None and seed != self.data['seed']:
+            print('Resuming with the seed {} of the previous run instead of {}'.format(self.data['seed'], seed))
+        return self.data['seed']
+
+    def stageDone(self, stage):
+        return self.data['stages'].get(stage, {}).get('done', False)
+
+    def markStage(self, stage, done=True, **info):
+        self.data['stages'][stage] = dict(info, done=done)
+        self.save()
+
+    def sample(self, sample_id):
+        return self.data['samples'].get(str(sample_id))
+
+    def sources(self):
+        return set(entry['source'] for entry in self.data['samples'].values())
+
+    def recordSample(self, sample_id, source, sample_path, params, sample_hash=None):
+        '''register a prepared sample, any previously recorded output is forgotten'''
+        self.data['samples'][str(sample_id)] = dict(
+            source=source,
+            hash=sample_hash if sample_hash is not None else fileHash(sample_path),
+            params=params,
+            outputs={})
+
+    def validSample(self, sample_id, sample_path):
+        '''whether the prepared sample image is still the one recorded'''
+        entry = self.sample(sample_id)
+        return entry is not None and os.path.exists(sample_path) and fileHash(sample_path) == entry['hash']
+
+    def _present(self, entry, path):
+        if not os.path.exists(path):
+            return False
+        recorded = entry['outputs'].get(os.path.basename(os.path.dirname(path)) + '/' + os.path.basename(path))
+        #   a size mismatch means the file was cut short while being written,
+        #   a file never recorded ( run stopped while rendering ) is checked for its end marker
+        if recorded is None:
+            return jpegComplete(path)
+        return recorded[0] == os.path.getsize(path)
+
+    def missingOutputs(self, sample_id, output_dir, n_frames):
+        '''returns ( missing frame numbers, whether the undistorted target is missing )'''
+        entry = self.sample(sample_id) or dict(outputs={})
+        undistorted, frames = outputPaths(output_dir, sample_id, n_frames)
+        missing_frames = [ f for f, path in frames.items() if not self._present(entry, path) ]
+        return missing_frames, not self._present(entry, undistorted)
+
+    def recordOutputs(self, sample_id, output_dir, n_frames):
+        '''store size and checksum of the complete output files of a sample that exist on disk'''
+        entry = self.sample(sample_id)
+        if entry is None:
+            return
+        undistorted, frames = outputPaths(output_dir, sample_id, n_frames)
+        for path in [undistorted] + list(frames.values()):
+            key = os.path.basename(os.path.dirname(path)) + '/' + os.path.basename(path)
+            if not os.path.exists(path):
+                entry['outputs'].pop(key, None)
+            elif entry['outputs'].get(key, [None])[0] != os.path.getsize(path):
+                #   a truncated file is forgotten, so that it gets rendered again
+                if jpegComplete(path):
+                    entry['outputs'][key] = [os.path.getsize(path), fileHash(path)]
+                else:
+                    entry['outputs'].pop(key, None)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+#   Blender-free re-implementation of the water_noise.blend distortion.
+#
+#   The scene is a textured plane seen through a flat water surface whose
+#   height is driven by two animated Musgrave (fBm) textures, multiplied by
+#   the 'Amplifier' node and plugged into the material displacement.  Since the
+#   camera looks straight down at the plane, path tracing it boils down to a
+#   refraction of the texture coordinates by the gradient of that height field,
+#   which is what this module computes with plain NumPy arrays.
+
+import functools
+import random
+
+import numpy as np
+from PIL import Image, ImageOps
+
+#   keep in sync with blender/scripts/anim.py
+W_INIT_MIN = -50.0
+W_INIT_MAX = 50.0
+W_OFFSET_MIN = 1.5
+W_OFFSET_MAX = 2.8
+SCALE_C_MIN = 3.2
+SCALE_C_MAX = 8.0
+AMP_MIN = 0.17
+AMP_MAX = 0.56
+
+#   keyframes of the W parameters are set at frame 1 and 100 (anim.set_param_musgrave)
+KEYFRAME_FIRST = 1
+KEYFRAME_LAST = 100
+
+#   Musgrave node settings (Blender defaults : fBM, detail 2, dimension 2, lacunarity 2)
+MUSGRAVE_DETAIL = 2
+MUSGRAVE_DIMENSION = 2.0
+MUSGRAVE_LACUNARITY = 2.0
+
+#   optics of the water layer : index of refraction and depth between surface and texture
+WATER_IOR = 1.333
+WATER_DEPTH = 0.02
+
+#   fallback resolution when neither the command line nor a calibration gives the one of the scene
+RENDER_RESOLUTION = (256, 256)
+
+#   ways of fitting a sample image to the render resolution : scale it to cover the frame and crop
+#   the center (keeps the aspect ratio), or stretch it to the frame
+TEXTURE_FITS = ('crop', 'stretch')
+
+#   bounds and steps of the search of the water depth matching the distortion of a Blender render
+CALIBRATION_DEPTH_RANGE = (WATER_DEPTH / 16.0, WATER_DEPTH * 16.0)
+CALIBRATION_DEPTH_STEPS = 12
+
+#   the height field is evaluated on a grid this many times coarser than the image
+SURFACE_SUBSAMPLE = 2
+
+#   fixed permutation table, the per-sample variation comes from the W parameters
+_PERM = np.random.RandomState(0).permutation(256)
+_PERM = np.concatenate([_PERM, _PERM])
+
+_GRAD3 = np.array([[1, 1, 0], [-1, 1, 0], [1, -1, 0], [-1, -1, 0],
+                   [1, 0, 1], [-1, 0, 1], [1, 0, -1], [-1, 0, -1],
+                   [0, 1, 1], [0, -1, 1], [0, 1, -1], [0, -1, -1]], dtype=np.float32)
+
+#   gradient components looked up directly by hash value
+_GRAD_X, _GRAD_Y, _GRAD_Z = _GRAD3[np.arange(256) % 12].T.copy()
+
+def sampleRng(seed, sample_id):
+    '''random generator of one sample, keyed by the run seed and the sample id only, so that any
+    sample draws the same parameters whichever process handles it ( same keying as anim.sample_rng )'''
+    return random.Random('{}:{}'.format(seed, sample_id))
+
+def drawSampleParams(rng, wave_scale=0.0, amplifier=0.0):
+    '''draw the per-sample animation parameters the same way anim.py does.
+    rng is a random.Random instance (or the random module itself).'''
+    w_c = rng.uniform(W_INIT_MIN, W_INIT_MAX)
+    w_c_end = w_c + rng.uniform(W_OFFSET_MIN, W_OFFSET_MAX) * (-1) ** rng.randint(0, 1)
+    w_f = rng.uniform(W_INIT_MIN, W_INIT_MAX)
+    w_f_end = w_f + rng.uniform(W_OFFSET_MIN, W_OFFSET_MAX) * (-1) ** rng.randint(0, 1)
+
+    scale_c = rng.uniform(SCALE_C_MIN, SCALE_C_MAX) if wave_scale == 0.0 else wave_scale
+    scale_offset = (SCALE_C_MAX - scale_c) / (SCALE_C_MAX - SCALE_C_MIN) * 0.8 + 2.7
+    scale_f = rng.gauss(scale_c + scale_offset, 0.25)
+
+    amp = rng.uniform(AMP_MIN, AMP_MAX) if amplifier == 0.0 else amplifier
+
+    return dict(w_coarse=[w_c, w_c_end], w_fine=[w_f, w_f_end],
+                scale_coarse=scale_c, scale_fine=scale_f, amplifier=amp)
+
+def keyframeValue(start, end, frames):
+    '''evaluate the (auto-clamped bezier) W keyframe curve at the given frames.
+    with only two keyframes, the handles are flat and the curve is exactly a smoothstep'''
+    t = (np.asarray(frames, dtype=np.float32) - KEYFRAME_FIRST) / (KEYFRAME_LAST - KEYFRAME_FIRST)
+    t = np.clip(t, 0.0, 1.0)
+    return start + (end - start) * t * t * (3.0 - 2.0 * t)
+
+def _fade(t):
+    return t * t * t * (t * (t * 6.0 - 15.0) + 10.0)
+
+def _slice(hashes, x, y, u, v):
+    '''bilinear blend of the four corner gradients of one lattice slice of constant W.
+    returns the plane part of the noise and its slope along W, the noise at the fractional
+    position z above the slice being plane + z * slope'''
+    h00, h10, h01, h11 = hashes
+    p00 = _GRAD_X[h00] * x + _GRAD_Y[h00] * y
+    p10 = _GRAD_X[h10] * (x - 1) + _GRAD_Y[h10] * y
+    p01 = _GRAD_X[h01] * x + _GRAD_Y[h01] * (y - 1)
+    p11 = _GRAD_X[h11] * (x - 1) + _GRAD_Y[h11] * (y - 1)
+    plane = p00 + u * (p10 - p00)
+    plane += v * (p01 + u * (p11 - p01) - plane)
+    g00, g10, g01, g11 = _GRAD_Z[h00], _GRAD_Z[h10], _GRAD_Z[h01], _GRAD_Z[h11]
+    slope = g00 + u * (g10 - g00)
+    slope += v * (g01 + u * (g11 - g01) - slope)
+    return plane, slope
+
+def perlin3(x, y, z):
+    '''vectorized 3D gradient noise in [-1, 1].
+    x and y are plane coordinates of shape (1, H, W), z holds one value per frame (F, 1, 1)'''
+    x, y = x[0], y[0]
+    z = np.asarray(z, dtype=np.float32).reshape(-1)
+    xf, yf, zf = np.floor(x), np.floor(y), np.floor(z)
+    xi, yi, zi = xf.astype(np.intp) & 255, yf.astype(np.intp) & 255, zf.astype(np.intp) & 255
+    x, y, z = x - xf, y - yf, z - zf
+    u, v, w = _fade(x), _fade(y), _fade(z)
+
+    #   a frame only differs from the lattice slices of W around it by its z coordinate, and the
+    #   noise is linear in z within a slice : the plane terms are computed once per distinct slice
+    #   ( a few for a whole animation ) instead of once per frame
+    a = _PERM[xi] + yi
+    b = _PERM[xi + 1] + yi
+    corners = _PERM[a], _PERM[b], _PERM[a + 1], _PERM[b + 1]
+    slices = np.unique(np.concatenate([zi, zi + 1]))
+    planes = np.empty((len(slices),) + x.shape, dtype=np.float32)
+    slopes = np.empty_like(planes)
+    for i, s in enumerate(slices):
+        planes[i], slopes[i] = _slice([_PERM[c + s] for c in corners], x, y, u, v)
+
+    lower = np.searchsorted(slices, zi)
+    upper = np.searchsorted(slices, zi + 1)
+    z, w = z[:, None, None], w[:, None, None]
+    y1 = planes[lower] + z * slopes[lower]
+    y2 = planes[upper] + (z - 1) * slopes[upper]
+    return y1 + w * (y2 - y1)
+
+def musgrave(x, y, w, scale):
+    '''fBm Musgrave texture evaluated at plane coordinates (x, y) and W parameter'''
+    x, y, w = x * scale, y * scale, w * scale
+    gain = MUSGRAVE_LACUNARITY ** -MUSGRAVE_DIMENSION
+    value = 0.0
+    amp = 1.0
+    for _ in range(MUSGRAVE_DETAIL):
+        value = value + perlin3(x, y, w) * amp
+        amp *= gain
+        x, y, w = x * MUSGRAVE_LACUNARITY, y * MUSGRAVE_LACUNARITY, w * MUSGRAVE_LACUNARITY
+    return value
+
+def heightField(params, frames, resolution=RENDER_RESOLUTION):
+    '''water surface height for every requested frame, shape (F, H, W).
+    the plane spans [-1, 1] along the width, and keeps square pixels along the height'''
+    width, height = resolution
+    extent = height / width
+    ys, xs = np.meshgrid(np.linspace(-extent, extent, height, dtype=np.float32),
+                         np.linspace(-1.0, 1.0, width, dtype=np.float32), indexing='ij')
+    w_c = keyframeValue(params['w_coarse'][0], params['w_coarse'][1], frames)[:, None, None]
+    w_f = keyframeValue(params['w_fine'][0], params['w_fine'][1], frames)[:, None, None]
+
+    surface = musgrave(xs[None], ys[None], w_c, params['scale_coarse'])
+    surface += musgrave(xs[None], ys[None], w_f, params['scale_fine'])
+    return surface * params['amplifier']
+
+def refractionOffsets(surface, depth=WATER_DEPTH):
+    '''texture coordinate offsets (in pixels) caused by refraction through the surface'''
+    n_frames, height, width = surface.shape
+    #   plane coordinates span [-1, 1] along the width, so one pixel is 2 / width units wide
+    pixel = 2.0 / width
+    d_y, d_x = np.gradient(surface, pixel, pixel, axis=(1, 2))
+    k = depth * (1.0 - 1.0 / WATER_IOR) / pixel
+    return -k * d_x, -k * d_y
+
+def sampleBilinear(image, u, v):
+    '''sample image (H, W, C) at fractional pixel positions u (x) and v (y)'''
+    height, width, channels = image.shape
+    u = np.clip(u, 0.0, width - 1.0)
+    v = np.clip(v, 0.0, height - 1.0)
+    u0 = np.minimum(np.floor(u), width - 2.0)
+    v0 = np.minimum(np.floor(v), height - 2.0)
+    fu = u - u0
+    fv = v - v0
+
+    #   bilinear weights of the four taps, shared by the channels
+    w11 = fu * fv
+    w10 = fu - w11
+    w01 = fv - w11
+    w00 = 1.0 - fu - w01
+
+    #   gather each channel from a flat plane of the image, 1D takes are much cheaper than
+    #   2D fancy indexing or taking whole pixels
+    idx = v0.astype(np.intp) * width + u0.astype(np.intp)
+    taps = ((idx, w00), (idx + 1, w10), (idx + width, w01), (idx + width + 1, w11))
+    out = np.empty(u.shape + (channels,), dtype=np.float32)
+    for c in range(channels):
+        plane = np.ascontiguousarray(image[..., c]).reshape(-1)
+        acc = plane.take(taps[0][0]) * taps[0][1]
+        for tap, weight in taps[1:]:
+            acc += plane.take(tap) * weight
+        out[..., c] = acc
+    return out
+
+def loadTexture(image_path, resolution=RENDER_RESOLUTION, fit='crop'):
+    '''load a sample image as the texture seen by the (undistorted) camera'''
+    image = Image.open(image_path).convert('RGB')
+    resolution = tuple(int(size) for size in resolution)
+    if image.size != resolution:
+        if fit == 'crop':
+            image = ImageOps.fit(image, resolution, Image.BILINEAR)
+        else:
+            image = image.resize(resolution, Image.BILINEAR)
+    return np.asarray(image, dtype=np.float32)
+
+def fitCurve(source, target):
+    '''per-channel tone curve (3, 256) mapping the 8 bit values of source to the mean of target,
+    levels never seen are interpolated ( same fit as blender/scripts/projection.py )'''
+    levels = np.arange(256)
+    curve = np.empty((3, 256), dtype=np.uint8)
+    for c in range(3):
+        bins = source[..., c].astype(np.intp).reshape(-1)
+        counts = np.bincount(bins, minlength=256)
+        sums = np.bincount(bins, weights=target[..., c].reshape(-1), minlength=256)
+        seen = counts > 0
+        curve[c] = np.rint(np.interp(levels, levels[seen], sums[seen] / counts[seen]))
+    return curve
+
+def applyCurve(pixels, curve):
+    '''map 8 bit pixels (..., 3) through a tone curve, returns uint8'''
+    pixels = pixels.astype(np.uint8, copy=False)
+    out = np.empty_like(pixels)
+    for c in range(3):
+        out[..., c] = curve[c][pixels[..., c]]
+    return out
+
+def psnr(a, b):
+    '''peak signal to noise ratio of two 8 bit images, in dB'''
+    mse = np.mean((a.astype(np.float32) - b.astype(np.float32)) ** 2)
+    return float('inf') if mse == 0.0 else float(10.0 * np.log10(255.0 ** 2 / mse))
+
+@functools.lru_cache(maxsize=None)
+def _interpolationMatrix(size_out, size_in):
+    '''dense (size_out, size_in) matrix of linear interpolation weights'''
+    pos = np.linspace(0.0, size_in - 1.0, size_out)
+    i0 = np.minimum(pos.astype(np.intp), size_in - 2)
+    frac = pos - i0
+    mat = np.zeros((size_out, size_in), dtype=np.float32)
+    mat[np.arange(size_out), i0] = 1.0 - frac
+    mat[np.arange(size_out), i0 + 1] = frac
+    return mat
+
+def upsample(field, height, width):
+    '''bilinearly resize a stack of 2D fields (F, h, w) to (F, height, width)'''
+    n_frames, h, w = field.shape
+    if (h, w) == (height, width):
+        return field
+    #   separable interpolation as two small matrix products
+    return _interpolationMatrix(height, h) @ field @ _interpolationMatrix(width, w).T
+
+def distortFrames(texture, params, frames, depth=WATER_DEPTH):
+    '''render the distorted animation frames of a texture, returns uint8 (F, H, W, C)'''
+    height, width = texture.shape[:2]
+
+    #   the surface is smooth compared to the texture, evaluate it on a coarser grid
+    surface = heightField(params, frames, (width // SURFACE_SUBSAMPLE, height // SURFACE_SUBSAMPLE))
+    off_x, off_y = refractionOffsets(surface, depth)
+    scale_x = width / surface.shape[2]
+    scale_y = height / surface.shape[1]
+
+    #   frames are warped one at a time, the temporaries of a whole batch do not fit in the cache,
+    #   and from a channel-planar copy of the texture so that sampleBilinear gathers contiguous planes
+    texture = np.moveaxis(np.ascontiguousarray(np.moveaxis(texture, 2, 0)), 0, 2)
+    ys, xs = np.meshgrid(np.arange(height, dtype=np.float32),
+                         np.arange(width, dtype=np.float32), indexing='ij')
+    out = np.empty((len(off_x), height, width, texture.shape[2]), dtype=np.uint8)
+    for i in range(len(off_x)):
+        u = xs + upsample(off_x[i:i + 1] * scale_x, height, width)[0]
+        v = ys + upsample(off_y[i:i + 1] * scale_y, height, width)[0]
+        warped = sampleBilinear(texture, u, v)
+        warped += 0.5
+        out[i] = warped
+    return out
+
+def calibrate(sample_path, params, reference, reference_frames, frames):
+    '''fit the approximation to a Blender render of one sample : the undistorted render gives the
+    resolution of the scene, how the texture is fitted to it and the tone curve of the view transform,
+    the distorted frames give the water depth.
+    reference is the undistorted render (H, W, 3) and reference_frames the distorted ones (F, H, W, 3),
+    both 8 bit, rendered from params at the given frames.'''
+    height, width = reference.shape[:2]
+    best = None
+    for fit in TEXTURE_FITS:
+        texture = loadTexture(sample_path, (width, height), fit)
+        curve = fitCurve(texture, reference)
+        score = psnr(applyCurve(texture, curve), reference)
+        if best is None or score > best[0]:
+            best = (score, fit, texture, curve)
+    score, fit, texture, curve = best
+
+    #   this noise is not the one of Blender, frames cannot match pixel for pixel. the depth is
+    #   chosen so that the frames differ from the undistorted image as much as Blender's do
+    target = np.mean(np.abs(reference_frames.astype(np.float32) - reference))
+    undistorted = applyCurve(texture, curve).astype(np.float32)
+    def distortion(depth):
+        return np.mean(np.abs(applyCurve(distortFrames(texture, params, frames, depth), curve) - undistorted))
+
+    low, high = np.log(CALIBRATION_DEPTH_RANGE[0]), np.log(CALIBRATION_DEPTH_RANGE[1])
+    for _ in range(CALIBRATION_DEPTH_STEPS):
+        middle = (low + high) / 2.0
+        if distortion(np.exp(middle)) < target:
+            low = middle
+        else:
+            high = middle
+    depth = float(np.exp((low + high) / 2.0))
+
+    return dict(resolution=[width, height], texture_fit=fit, curve=curve.tolist(), water_depth=depth,
+                psnr=score, distortion=float(target), distortion_fit=float(distortion(depth)))
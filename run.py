@@ -6,8 +6,21 @@ import argparse
 import sys
 import subprocess
 import random
+import shutil
 from PIL import Image
 import json
+import time
+import signal
+import threading
+import atexit
+import socket
+import importlib.util
+from multiprocessing import Pool
+
+import refraction
+import manifest as manifest_module
+from manifest import Manifest
+import shards
 
 DOWNLOADS_ROOT = 'ImageNet-Datasets-Downloader'
 DOWNLOADER_PATH = os.path.join(DOWNLOADS_ROOT, 'downloader.py')
@@ -20,101 +33,730 @@ BLENDER_SAMPLES_REL_PATH = 'samples'
 BLENDER_OUTPUT_REL_PATH = 'output'
 BLENDER_BLEND_REL_PATH = 'water_noise.blend'
 BLENDER_SCRIPT_REL_PATH = os.path.join('scripts', 'main_render.py')
+BLENDER_QUEUE_REL_PATH = 'queue'
+BLENDER_SHARDS_REL_PATH = 'shards'
 BLENDER_SAMPLES_PATH = os.path.join(BLENDER_ROOT, BLENDER_SAMPLES_REL_PATH)
+BLENDER_WORKER_EXIT_RECYCLE = 75
+BLENDER_PYTHON_EXIT_CODE = 1
+BLENDER_TEXTURE_SIZE = 512
+BLENDER_NUMPY_CALIBRATION_REL_PATH = 'numpy_calibration'
+MANIFEST_PATH = os.path.join(BLENDER_ROOT, BLENDER_OUTPUT_REL_PATH, 'manifest.json')
+NUMPY_CALIBRATION_PATH = os.path.join(BLENDER_ROOT, 'numpy_calibration.json')
+NUMPY_CALIBRATION_FRAMES = 10
+DEDUP_DB_PATH = os.path.join(DOWNLOADS_ROOT, 'content.sqlite')
+
+#   job queue module shared with the Blender workers
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), BLENDER_ROOT, 'scripts'))
+import jobs
+import timing
+import timeline
+
+#   content hash store shared with the downloader
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), DOWNLOADS_ROOT))
+from content_store import ContentStore
+
+def downloaderEngineArgs():
+    #   only the asyncio engine of the downloader scrapes several classes at once, it needs aiohttp
+    return ['-engine', 'async'] if importlib.util.find_spec('aiohttp') is not None else []
 
-def downloadClasses(downloader_path, n_classes, n_images_per_class, data_root):
+def downloadClasses(downloader_path, n_classes, n_images_per_class, data_root, dedup_db='', dedup_distance=-1):
     args_list = ['python', DOWNLOADER_PATH,
                 '-number_of_classes', n_classes,
                 '-images_per_class', n_images_per_class,
-                '-data_root', data_root]
+                '-data_root', data_root] + downloaderEngineArgs()
+    if len(dedup_db) > 0:
+        args_list += ['-dedup_db', dedup_db, '-dedup_distance', dedup_distance]
     args = ' '.join(str(arg) for arg in args_list)
-    subprocess.call(args, shell=True)
+    with timeline.span('download', classes=n_classes):
+        subprocess.call(args, shell=True)
+
+def countDownloadedClasses(input_dir, n_images_per_class):
+    if not os.path.isdir(input_dir):
+        return 0
+    #   images still being written end with .part, a download cancelled at the quota may leave some behind
+    return sum(1 for cls in os.listdir(input_dir)
+               if len([ name for name in os.listdir(os.path.join(input_dir, cls))
+                        if not name.endswith('.part') ]) >= n_images_per_class)
+
+def prepareSample(job):
+    source_path, sample_path, texture_size = job
+    with timeline.span('prepare_sample', sample=os.path.basename(sample_path)):
+        return prepareSampleImage(source_path, sample_path, texture_size)
+
+def prepareSampleImage(source_path, sample_path, texture_size):
+
+    #   a JPEG that already fits the texture is linked (or copied) without re-encoding
+    image = Image.open(source_path)
+    if image.format == 'JPEG' and image.mode == 'RGB' and max(image.size) <= texture_size:
+        image.close()
+        if os.path.exists(sample_path):
+            os.remove(sample_path)
+        try:
+            os.link(source_path, sample_path)
+        except OSError:
+            shutil.copyfile(source_path, sample_path)
+    else:
+        #   draft lets the JPEG decoder downscale by a power of two while decoding
+        image.draft('RGB', (texture_size, texture_size))
+        image = image.convert('RGB')
+        image.thumbnail((texture_size, texture_size), Image.BICUBIC)
+        image.save(sample_path, 'JPEG', quality=95)
+
+    return manifest_module.fileHash(sample_path)
 
-def prepareBlenderData(input_dir, output_dir, n_samples, n_samples_per_class, wave_scale, amplifier):
+def prepareBlenderData(input_dir, output_dir, n_samples, n_samples_per_class, wave_scale, amplifier,
+        manifest=None, texture_size=BLENDER_TEXTURE_SIZE, n_workers=0, content_store=None, seed=0):
     os.makedirs(output_dir, exist_ok=True)
 
     #   prepare parameters dictionary
-    params = {}
-    params['wave_scales'] = [] if wave_scale == 0.0 else [wave_scale] * n_samples
-    params['amplifiers'] = [] if amplifier == 0.0 else [amplifier] * n_samples
+    params = dict(wave_scales=[], amplifiers=[], w_coarse=[], w_fine=[], fine_scales=[], seed=seed)
 
-    next_sample_id = 0
-    for cls in os.listdir(input_dir):
+    def addParams(sample_params):
+        params['wave_scales'].append( sample_params['scale_coarse'] )
+        params['amplifiers'].append( sample_params['amplifier'] )
+        params['w_coarse'].append( sample_params['w_coarse'] )
+        params['w_fine'].append( sample_params['w_fine'] )
+        params['fine_scales'].append( sample_params['scale_fine'] )
+
+    #   samples prepared by a previous (interrupted) run are kept as they are
+    used_sources = manifest.sources() if manifest is not None else set()
+
+    def reuseValidSamples(next_sample_id):
+        while manifest is not None and next_sample_id < n_samples and manifest.validSample(
+                next_sample_id, os.path.join(output_dir, BLENDER_SAMPLE_NAME_FORMAT.format(next_sample_id))):
+            addParams(manifest.sample(next_sample_id)['params'])
+            next_sample_id += 1
+        return next_sample_id
+
+    #   pick the samples first, the image work itself is spread over a process pool
+    selected = []
+    n_duplicates = 0
+    next_sample_id = reuseValidSamples(0)
+    for cls in sorted(os.listdir(input_dir)) if os.path.isdir(input_dir) else []:
         cls_path = os.path.join(input_dir, cls)
-        samples = os.listdir(cls_path)
-        random.shuffle(samples)
-        samples = samples[:n_samples_per_class]
+        samples = sorted( s for s in os.listdir(cls_path)
+                          if not s.endswith('.part') and os.path.join(cls_path, s) not in used_sources )
+        random.Random('{}:{}'.format(seed, cls)).shuffle(samples)
 
+        n_taken = 0
         for sample_name in samples:
-            if next_sample_id == n_samples:
+            if next_sample_id == n_samples or n_taken == n_samples_per_class:
                 break
             sample_path = os.path.join(cls_path, sample_name)
+
+            #   a photo already used by another class or by an earlier run is not rendered twice
+            if content_store is not None:
+                with open(sample_path, 'rb') as fp:
+                    known_path = content_store.duplicate_of(fp.read(), os.path.abspath(sample_path), cls)
+                if known_path is not None:
+                    n_duplicates += 1
+                    continue
+            n_taken += 1
+
             new_sample_name = BLENDER_SAMPLE_NAME_FORMAT.format(next_sample_id)
             new_sample_path = os.path.join(output_dir, new_sample_name)
-            image = Image.open(sample_path)
-            image.save(new_sample_path)
-            next_sample_id += 1
 
-            #   generate this sample's distortion parameter
-            if wave_scale == 0.0:
-                params['wave_scales'].append( random.uniform( 3.2, 8.0 ) )
-            if amplifier == 0.0:
-                params['amplifiers'].append( random.uniform( 0.17, 0.56 ) )
+            #   generate this sample's distortion parameter, including the W keyframes
+            #   so that every process rendering a part of this sample agrees on them
+            sample_params = refraction.drawSampleParams(refraction.sampleRng(seed, next_sample_id), wave_scale, amplifier)
+            sample_params['seed'] = seed
+            addParams(sample_params)
+
+            selected.append((next_sample_id, sample_path, new_sample_path, sample_params))
+            next_sample_id = reuseValidSamples(next_sample_id + 1)
+
+    if n_duplicates > 0:
+        print('Skipped {} duplicate images'.format(n_duplicates))
+
+    with timeline.span('prepare', samples=len(selected)), Pool(processes=n_workers if n_workers > 0 else None) as p:
+        prepared = p.imap(prepareSample, [ (src, dst, texture_size) for _, src, dst, _ in selected ], chunksize=8)
+        for (sample_id, src, dst, sample_params), sample_hash in zip(selected, prepared):
+            if manifest is not None:
+                manifest.recordSample(sample_id, src, dst, sample_params, sample_hash)
+                if sample_id % 1000 == 0:
+                    manifest.save()
+
+    if manifest is not None:
+        manifest.save()
 
     #   save parameters as JSON file
     with open( os.path.join( BLENDER_ROOT, BLENDER_SAMPLE_PARAM_FILE_NAME ), "w" ) as param_fp:
         json.dump( params, param_fp )
 
+    return next_sample_id
+
+def pendingSamples(manifest, output_dir, n_samples, n_frames_per_sample):
+    #   samples with missing outputs : { sample id: ( missing frames, undistorted missing ) }
+    #   only prepared samples count, the others have no image nor parameters to render with yet
+    todo = {}
+    for sample_id in range(n_samples):
+        if manifest.sample(sample_id) is None:
+            continue
+        missing_frames, undistorted_missing = manifest.missingOutputs(sample_id, output_dir, n_frames_per_sample)
+        if missing_frames or undistorted_missing:
+            todo[sample_id] = (missing_frames, undistorted_missing)
+    return todo
+
+def frameRuns(frames, max_length):
+    #   split sorted frame numbers into contiguous [first, last] ranges of at most max_length frames
+    runs = []
+    for f in frames:
+        if runs and runs[-1][1] == f - 1 and runs[-1][1] - runs[-1][0] + 1 < max_length:
+            runs[-1][1] = f
+        else:
+            runs.append([f, f])
+    return runs
+
+def sampleMusgrave(params, sample_id):
+    if 'w_coarse' not in params:
+        return None
+    return dict(w_coarse=params['w_coarse'][sample_id],
+                w_fine=params['w_fine'][sample_id],
+                scale_fine=params['fine_scales'][sample_id])
+
+def submitSampleJobs(queue_dir, samples_dir, output_dir, n_samples, n_frames_per_sample,
+        batch_size=1, frames_per_job=0, todo=None):
+    with open( os.path.join( BLENDER_ROOT, BLENDER_SAMPLE_PARAM_FILE_NAME ), "r" ) as param_fp:
+        params = json.load( param_fp )
+
+    if frames_per_job <= 0 or 'w_coarse' not in params:
+        frames_per_job = n_frames_per_sample
+
+    #   jobs left over by a previous run are stale, this run publishes a new generation of the queue
+    #   ( other nodes may still be attached to older ones, they are only deleted once left )
+    q_root = queue_dir
+    generation = jobs.new_generation(q_root)
+    queue_dir = os.path.join(q_root, generation)
+    jobs.remove_stale_generations(q_root)
+    print('Jobs published to {} as generation {}'.format(q_root, generation))
+
+    #   when resuming, every sample gets its own jobs covering only what is missing
+    if todo is not None:
+        job_idx = 0
+        for sample_id, (missing_frames, undistorted_missing) in sorted(todo.items()):
+            runs = frameRuns(missing_frames, frames_per_job) if missing_frames else [[1, 1]]
+            for i, (f_start, f_end) in enumerate(runs):
+                jobs.submit(queue_dir, job_idx, dict(
+                    samples=[sample_id, sample_id],
+                    frames=[f_start, f_end],
+                    undistorted=(undistorted_missing and i == 0),
+                    sample_dir=os.path.abspath(samples_dir),
+                    output_dir=os.path.abspath(output_dir),
+                    wave_scales=params['wave_scales'][sample_id:sample_id + 1],
+                    amplifiers=params['amplifiers'][sample_id:sample_id + 1],
+                    musgrave=[sampleMusgrave(params, sample_id)] if 'w_coarse' in params else None,
+                    seed=params.get('seed', -1)))
+                job_idx += 1
+        return generation
+
+    job_idx = 0
+    for first in range(0, n_samples, batch_size):
+        last = min(first + batch_size, n_samples) - 1
+        musgrave = [ sampleMusgrave(params, sample_id) for sample_id in range(first, last + 1) ]
+
+        #   split the frames of this batch into shards, only the first one renders the undistorted target
+        for f_start in range(1, n_frames_per_sample + 1, frames_per_job):
+            f_end = min(f_start + frames_per_job, n_frames_per_sample + 1) - 1
+            jobs.submit(queue_dir, job_idx, dict(
+                samples=[first, last],
+                frames=[f_start, f_end],
+                undistorted=(f_start == 1),
+                sample_dir=os.path.abspath(samples_dir),
+                output_dir=os.path.abspath(output_dir),
+                wave_scales=params['wave_scales'][first:last + 1],
+                amplifiers=params['amplifiers'][first:last + 1],
+                musgrave=musgrave if musgrave[0] is not None else None,
+                seed=params.get('seed', -1)))
+            job_idx += 1
+    return generation
+
+def autoFramesPerJob(n_samples, n_frames_per_sample, batch_size, n_devices):
+    #   with fewer sample batches than devices, split frames so that every device gets work
+    n_batches = (n_samples + batch_size - 1) // batch_size
+    if n_batches >= 2 * n_devices:
+        return 0
+    n_shards = min((2 * n_devices + n_batches - 1) // n_batches, n_frames_per_sample)
+    return (n_frames_per_sample + n_shards - 1) // n_shards
+
+def reportThroughput(queue_dir):
+    #   aggregate the timing each worker attached to its finished jobs
+    per_worker = {}
+    for name in jobs.list_jobs(queue_dir, jobs.DONE):
+        with open(os.path.join(queue_dir, jobs.DONE, name), "r") as job_fp:
+            job = json.load(job_fp)
+        result = job.get('result', {})
+        stats = per_worker.setdefault(job.get('worker'), dict(samples=0, frames=0, seconds=0.0))
+        stats['samples'] += job['samples'][1] - job['samples'][0] + 1
+        stats['frames'] += result.get('frames', 0)
+        stats['seconds'] += result.get('seconds', 0.0)
+
+    for worker, stats in sorted(per_worker.items(), key=lambda item: str(item[0])):
+        seconds = max(stats['seconds'], 1e-9)
+        print('Worker {}: {} samples in {:.1f} s, {:.3f} samples/s, {:.2f} frames/s'.format(
+            worker, stats['samples'], stats['seconds'], stats['samples'] / seconds, stats['frames'] / seconds))
+
+def reportTimings(timing_paths):
+    #   where the render time went, per device and over all devices
+    records = timing.load([ path for path in timing_paths if os.path.exists(path) ])
+    if records:
+        timing.print_summary(timing.summarize(records))
+
+def cpuWorkerCores(n_workers, threads_per_worker=0):
+    #   ( threads per worker, cores of every worker ), workers get disjoint cores as long as there are enough
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    if threads_per_worker <= 0:
+        threads_per_worker = max(len(cores) // n_workers, 1)
+    return threads_per_worker, [ sorted(set( cores[(i * threads_per_worker + t) % len(cores)] for t in range(threads_per_worker) ))
+                                 for i in range(n_workers) ]
+
+def launchWorkers(blender_root, rel_queue_dir, used_gpus, max_samples, max_memory,
+        undistorted='render', max_crashes=3, wait=False, cpu_workers=0, threads_per_worker=0,
+        lease=0, local_workers=True, log_name='render', persistent_data=False):
+    #   an uncaught exception in the script must not look like a clean exit
+    args_list = ['blender',
+                '-b', BLENDER_BLEND_REL_PATH,
+                '--python-exit-code', BLENDER_PYTHON_EXIT_CODE,
+                '-P', BLENDER_SCRIPT_REL_PATH,
+                '--',
+                '--wait' if wait else '',
+                '--persistent_data' if persistent_data else '',
+                '--queue_dir', rel_queue_dir,
+                '--max_samples', max_samples,
+                '--max_memory', max_memory,
+                '--undistorted', undistorted]
+    queue_dir = os.path.join(blender_root, rel_queue_dir)
+    log_dir = os.path.join(BLENDER_ROOT, BLENDER_OUTPUT_REL_PATH)
+    os.makedirs(log_dir, exist_ok=True)
+
+    #   if no GPU specified, a single worker uses all of them
+    devices = used_gpus if used_gpus else [-1]
+    worker_ids = [ 'gpu{}'.format(gpu) if gpu >= 0 else 'all' for gpu in devices ]
+
+    #   or several CPU-only workers share the cores of this node
+    if cpu_workers > 0:
+        devices = [-1] * cpu_workers
+        worker_ids = [ 'cpu{}'.format(i) for i in range(cpu_workers) ]
+        threads_per_worker, worker_cores = cpuWorkerCores(cpu_workers, threads_per_worker)
+        print('{} CPU workers with {} threads each'.format(cpu_workers, threads_per_worker))
+
+    #   or only workers of other nodes take the jobs
+    if not local_workers:
+        devices, worker_ids = [], []
+
+    #   worker ids are unique across the nodes sharing the queue
+    worker_ids = [ jobs.sanitize_worker_id('{}-{}'.format(socket.gethostname(), worker_id)) for worker_id in worker_ids ]
+
+    #   wall-clock timing records next to the render logs, one file per device
+    #   recycled workers append to them, so they only hold this launch
+    timing_files = [ os.path.join(BLENDER_OUTPUT_REL_PATH, '{}.timing.{}.jsonl'.format(log_name, i + 1)) for i in range(len(devices)) ]
+    for path in timing_files:
+        if os.path.exists(os.path.join(blender_root, path)):
+            os.remove(os.path.join(blender_root, path))
+
+    def spawn(i):
+        worker_args = ['--timing_file', timing_files[i], '--gpu_id', devices[i], '--worker_id', worker_ids[i]]
+        if cpu_workers > 0:
+            worker_args += ['--cpu', '--threads', threads_per_worker, '--cores'] + worker_cores[i]
+        args = ' '.join(str(arg) for arg in args_list + worker_args)
+        started[i] = time.time()
+        return subprocess.Popen(args, shell=True, cwd=blender_root, stdout=logs[i], stderr=sys.stderr)
+
+    logs = [ open( os.path.join( log_dir, log_name + ".log." + str(i + 1) ), "a" ) for i in range( len(devices) ) ]
+    started = [0.0] * len(devices)
+    procs = { i: spawn(i) for i in range( len(devices) ) }
+    crashes = [0] * len(devices)
+
+    #   the generation of the queue is not deleted by another run while this node works on it
+    node_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+    jobs.attach(queue_dir, node_id)
+
+    #   every worker pulls jobs until the queue is empty, recycled or crashed workers are restarted
+    while True:
+        time.sleep(1)
+        jobs.attach(queue_dir, node_id)
+
+        #   jobs of workers that stopped renewing their lease, on any node, are taken again
+        if lease > 0:
+            expired = jobs.expire(queue_dir, lease)
+            if expired:
+                print('Lease of {} job(s) expired, re-queued'.format(len(expired)))
+                timeline.instant('lease_expired', jobs=expired)
+
+        for i, proc in list(procs.items()):
+            code = proc.poll()
+            if code is None:
+                continue
+            del procs[i]
+            timeline.complete('worker ' + worker_ids[i], time.time() - started[i], 'process',
+                              device=devices[i], exit_code=code)
+
+            #   whatever the exit reason, the worker does not hold its jobs anymore
+            #   a worker leaving its own jobs running did not finish them, whatever its exit code
+            requeued = jobs.requeue(queue_dir, worker_ids[i])
+            if code not in (0, BLENDER_WORKER_EXIT_RECYCLE) or requeued:
+                crashes[i] += 1
+                print('Worker {} exited with code {}, re-queued {} job(s)'.format(worker_ids[i], code, len(requeued)))
+
+        #   waiting workers are kept alive until the queue is closed
+        pending = jobs.list_jobs(queue_dir, jobs.PENDING)
+        if pending or (wait and not jobs.is_closed(queue_dir)):
+            for i in range( len(devices) ):
+                if i not in procs and crashes[i] < max_crashes:
+                    procs[i] = spawn(i)
+
+        if not procs:
+            #   with leases, jobs held by other nodes are waited for, they come back if their worker dies
+            if lease > 0 and (jobs.list_jobs(queue_dir, jobs.RUNNING) or (pending and not devices)):
+                continue
+            if pending:
+                print('All workers failed, {} job(s) left in {}'.format(len(pending), queue_dir))
+            break
+
+    for log in logs:
+        log.close()
+    jobs.detach(queue_dir, node_id)
+
+    reportThroughput(queue_dir)
+    reportTimings([ os.path.join(blender_root, path) for path in timing_files ])
+
 def generateDistortedImages(blender_root, rel_samples_dir,
-        rel_output_dir, n_samples, n_frames_per_sample, used_gpus):
+        rel_output_dir, n_samples, n_frames_per_sample, used_gpus, undistorted='render',
+        persistent=False, batch_size=1, max_samples=0, max_memory=0.0, frames_per_job=-1, todo=None,
+        cpu_workers=0, threads_per_worker=0, rel_queue_dir=BLENDER_QUEUE_REL_PATH, lease=0, local_workers=True,
+        persistent_data=False):
+
+    #   a partially rendered output is completed through the queue, sample by sample
+    if todo is not None and len(todo) == n_samples and \
+            all(len(frames) == n_frames_per_sample and undistorted_missing
+                for frames, undistorted_missing in todo.values()):
+        todo = None
+
+    #   several GPUs or CPU workers (or persistent workers, or other nodes) pull batches of samples from a shared queue
+    if used_gpus or persistent or todo is not None or cpu_workers > 0 or lease > 0 or not local_workers:
+        if frames_per_job < 0:
+            frames_per_job = autoFramesPerJob(n_samples, n_frames_per_sample, batch_size,
+                                              max(len(used_gpus), cpu_workers, 1))
+        generation = submitSampleJobs(
+                os.path.join(blender_root, rel_queue_dir),
+                os.path.join(blender_root, rel_samples_dir),
+                os.path.join(blender_root, rel_output_dir),
+                n_samples,
+                n_frames_per_sample,
+                batch_size,
+                frames_per_job,
+                todo)
+        #   workers joining from other nodes wait for the queue to be closed
+        rel_queue_dir = os.path.join(rel_queue_dir, generation)
+        jobs.close(os.path.join(blender_root, rel_queue_dir))
+        launchWorkers(blender_root, rel_queue_dir, used_gpus, max_samples, max_memory, undistorted,
+                cpu_workers=cpu_workers, threads_per_worker=threads_per_worker, lease=lease,
+                local_workers=local_workers, persistent_data=persistent_data)
+        return
+
+    #   timing records of this single worker, named like the ones of launchWorkers
+    timing_file = os.path.join(BLENDER_OUTPUT_REL_PATH, 'render.timing.1.jsonl')
+    if os.path.exists(os.path.join(blender_root, timing_file)):
+        os.remove(os.path.join(blender_root, timing_file))
+
+    #   an uncaught exception in the script must not look like a clean exit
     args_list = ['blender',
                 '-b', BLENDER_BLEND_REL_PATH,
+                '--python-exit-code', BLENDER_PYTHON_EXIT_CODE,
                 '-P', BLENDER_SCRIPT_REL_PATH,
                 '--',
+                '--timing_file', timing_file,
                 '--sample_dir', rel_samples_dir,
                 '--output_dir', rel_output_dir,
                 '--samples', 0, n_samples - 1,
                 '--frames', 1, n_frames_per_sample,
-                '--param_file', BLENDER_SAMPLE_PARAM_FILE_NAME]
-    
-    #   if no GPU specified, use all
-    if not used_gpus:
-        args = ' '.join(str(arg) for arg in args_list)
-        subprocess.call(args, shell=True, cwd=blender_root)
+                '--param_file', BLENDER_SAMPLE_PARAM_FILE_NAME,
+                '--undistorted', undistorted,
+                '--persistent_data' if persistent_data else '']
+    args = ' '.join(str(arg) for arg in args_list)
+    subprocess.call(args, shell=True, cwd=blender_root)
+    reportTimings([ os.path.join(blender_root, timing_file) ])
+
+def numpySampleParams(params, sample_id):
+    sample_params = refraction.drawSampleParams(refraction.sampleRng(params.get('seed', 0), sample_id),
+            params['wave_scales'][sample_id], params['amplifiers'][sample_id])
+    musgrave = sampleMusgrave(params, sample_id)
+    if musgrave is not None:
+        sample_params.update(w_coarse=musgrave['w_coarse'], w_fine=musgrave['w_fine'], scale_fine=musgrave['scale_fine'])
+    return sample_params
+
+def calibrateNumpy(blender_root, rel_samples_dir, used_gpus, calibration_path):
+    '''render the first sample with Blender and fit the numpy backend to it'''
+    rel_output_dir = BLENDER_NUMPY_CALIBRATION_REL_PATH
+    output_dir = os.path.join(blender_root, rel_output_dir)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    generateDistortedImages(blender_root, rel_samples_dir, rel_output_dir, 1, NUMPY_CALIBRATION_FRAMES, used_gpus)
+
+    sample_name = BLENDER_SAMPLE_NAME_FORMAT.format(0)
+    distorted_dir = os.path.join(output_dir, 'distorted', os.path.splitext(sample_name)[0])
+    reference = np.asarray(Image.open(os.path.join(output_dir, 'undistorted', sample_name)).convert('RGB'))
+    reference_frames = np.stack([np.asarray(Image.open(os.path.join(distorted_dir,
+            BLENDER_SAMPLE_NAME_FORMAT.format(frame))).convert('RGB')) for frame in range(1, NUMPY_CALIBRATION_FRAMES + 1)])
+
+    with open( os.path.join( blender_root, BLENDER_SAMPLE_PARAM_FILE_NAME ), "r" ) as param_fp:
+        params = json.load( param_fp )
+    calibration = refraction.calibrate(os.path.join(blender_root, rel_samples_dir, sample_name),
+            numpySampleParams(params, 0), reference, reference_frames, np.arange(1, NUMPY_CALIBRATION_FRAMES + 1))
+    with open(calibration_path, 'w') as calibration_fp:
+        json.dump(calibration, calibration_fp)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    print('numpy backend calibrated: {0[0]}x{0[1]}, texture {1}, {2:.1f} dB undistorted, water depth {3:.4f}'.format(
+            calibration['resolution'], calibration['texture_fit'], calibration['psnr'], calibration['water_depth']))
+    return calibration
+
+def loadNumpyCalibration(calibration_path, resolution=None):
+    '''settings of the numpy backend, from its calibration against Blender when there is one'''
+    if os.path.exists(calibration_path):
+        with open(calibration_path, 'r') as calibration_fp:
+            calibration = json.load(calibration_fp)
+    else:
+        calibration = dict(resolution=list(refraction.RENDER_RESOLUTION), texture_fit='crop', curve=None,
+                           water_depth=refraction.WATER_DEPTH)
+        if resolution is None:
+            print('WARNING: the numpy backend is not calibrated against Blender (--numpy_calibrate), '
+                  'rendering at {0[0]}x{0[1]} without tone curve'.format(calibration['resolution']))
+    if resolution is not None:
+        calibration['resolution'] = list(resolution)
+    return calibration
+
+def renderSampleNumpy(job):
+    sample_path, output_dir, sample_id, n_frames_per_sample, params, calibration = job
+
+    with timeline.span('sample', 'render', sample=sample_id):
+        texture = refraction.loadTexture(sample_path, calibration['resolution'], calibration['texture_fit'])
+        frames = refraction.distortFrames(texture, params, np.arange(1, n_frames_per_sample + 1),
+                                          calibration['water_depth'])
+        undistorted = texture.astype(np.uint8)
+        if calibration['curve'] is not None:
+            curve = np.asarray(calibration['curve'], dtype=np.uint8)
+            undistorted = refraction.applyCurve(undistorted, curve)
+            frames = refraction.applyCurve(frames, curve)
+
+        sample_name = BLENDER_SAMPLE_NAME_FORMAT.format(sample_id)
+        Image.fromarray(undistorted).save(os.path.join(output_dir, 'undistorted', sample_name))
+
+        distorted_dir = os.path.join(output_dir, 'distorted', os.path.splitext(sample_name)[0])
+        os.makedirs(distorted_dir, exist_ok=True)
+        for i, frame in enumerate(frames):
+            Image.fromarray(frame).save(os.path.join(distorted_dir, BLENDER_SAMPLE_NAME_FORMAT.format(i + 1)))
+
+def generateDistortedImagesNumpy(blender_root, rel_samples_dir,
+        rel_output_dir, n_samples, n_frames_per_sample, n_workers, todo=None, calibration=None):
+    samples_dir = os.path.join(blender_root, rel_samples_dir)
+    output_dir = os.path.join(blender_root, rel_output_dir)
+    os.makedirs(os.path.join(output_dir, 'undistorted'), exist_ok=True)
+
+    with open( os.path.join( blender_root, BLENDER_SAMPLE_PARAM_FILE_NAME ), "r" ) as param_fp:
+        params = json.load( param_fp )
+
+    sample_jobs = []
+    for sample_id in range(n_samples):
+        sample_path = os.path.join(samples_dir, BLENDER_SAMPLE_NAME_FORMAT.format(sample_id))
+        if not os.path.exists(sample_path):
+            break
+        if todo is not None and sample_id not in todo:
+            continue
+        sample_jobs.append((sample_path, output_dir, sample_id, n_frames_per_sample,
+                     numpySampleParams(params, sample_id), calibration or loadNumpyCalibration(NUMPY_CALIBRATION_PATH)))
+
+    #   one process per core, each sample is rendered as a single batch of frames
+    with Pool(processes=n_workers if n_workers > 0 else None) as p:
+        p.map(renderSampleNumpy, sample_jobs)
+
+def stopDownloader(downloader, paused):
+    #   the downloader runs its own workers, the whole process group is stopped
+    if os.name == 'nt':
+        downloader.terminate()
     else:
-        #   determine the amount of samples on which each GPU will work
-        num_gpus = len(used_gpus)
-        n_samples_per_gpu = [ n_samples // num_gpus ] * num_gpus
-        rem_n_samples = n_samples % num_gpus
-        for i in range( num_gpus ):
-            if rem_n_samples == 0:
+        if paused:
+            os.killpg(downloader.pid, signal.SIGCONT)
+        os.killpg(downloader.pid, signal.SIGTERM)
+    downloader.wait()
+
+def streamImages(n_classes, n_images_per_class, n_samples, n_frames_per_sample,
+        wave_scale, amplifier, used_gpus, undistorted='render', max_buffered=16,
+        texture_size=BLENDER_TEXTURE_SIZE, dedup_db='', dedup_distance=-1, seed=0, cpu_workers=0, threads_per_worker=0,
+        persistent_data=False, manifest=None):
+    samples_dir = BLENDER_SAMPLES_PATH
+    output_dir = os.path.join(BLENDER_ROOT, BLENDER_OUTPUT_REL_PATH)
+    os.makedirs(samples_dir, exist_ok=True)
+    q_root = os.path.join(BLENDER_ROOT, BLENDER_QUEUE_REL_PATH)
+    rel_queue_dir = os.path.join(BLENDER_QUEUE_REL_PATH, jobs.new_generation(q_root))
+    jobs.remove_stale_generations(q_root)
+    queue_dir = os.path.join(BLENDER_ROOT, rel_queue_dir)
+
+    #   render workers wait for jobs while the images are being downloaded
+    render_thread = threading.Thread(target=launchWorkers,
+            args=(BLENDER_ROOT, rel_queue_dir, used_gpus, 0, 0.0, undistorted),
+            kwargs=dict(wait=True, cpu_workers=cpu_workers, threads_per_worker=threads_per_worker,
+                        persistent_data=persistent_data))
+    render_thread.start()
+
+    #   the downloader runs in its own process group so that it can be paused as a whole
+    dedup_args = ['-dedup_db', dedup_db, '-dedup_distance', str(dedup_distance)] if len(dedup_db) > 0 else []
+    downloader = subprocess.Popen(['python', DOWNLOADER_PATH,
+                '-number_of_classes', str(n_classes),
+                '-images_per_class', str(n_images_per_class),
+                '-data_root', DOWNLOADS_ROOT] + downloaderEngineArgs() + dedup_args, start_new_session=(os.name != 'nt'))
+    t_download = time.time()
+    paused = False
+
+    params = dict(wave_scales=[], amplifiers=[], w_coarse=[], w_fine=[], fine_scales=[], seed=seed)
+    per_class = {}
+    in_flight = {}
+    next_sample_id = 0
+    #   an error while streaming must not leave the downloader running, nor the render workers waiting for jobs
+    try:
+        while True:
+            #   without render workers, pending jobs would fill the buffer and pause the downloader for good
+            if not render_thread.is_alive():
+                raise RuntimeError('Render workers stopped, {} job(s) left in {}'.format(
+                        len(jobs.list_jobs(queue_dir, jobs.PENDING)), queue_dir))
+
+            downloading = downloader.poll() is None
+            if not downloading and t_download is not None:
+                timeline.complete('download', time.time() - t_download, 'process', classes=n_classes)
+                t_download = None
+
+            #   prepare every complete download (partial ones end with .part)
+            new_images = []
+            if os.path.isdir(DOWNLOADS_PATH):
+                for cls in sorted(os.listdir(DOWNLOADS_PATH)):
+                    cls_path = os.path.join(DOWNLOADS_PATH, cls)
+                    new_images.extend( (cls, os.path.join(cls_path, name)) for name in sorted(os.listdir(cls_path))
+                                       if not name.endswith('.part') )
+
+            for cls, image_path in new_images:
+                if next_sample_id == n_samples or per_class.get(cls, 0) == n_images_per_class:
+                    os.remove(image_path)
+                    continue
+                sample_path = os.path.join(samples_dir, BLENDER_SAMPLE_NAME_FORMAT.format(next_sample_id))
+                sample_hash = prepareSample((image_path, sample_path, texture_size))
+                os.remove(image_path)
+                per_class[cls] = per_class.get(cls, 0) + 1
+
+                sample_params = refraction.drawSampleParams(refraction.sampleRng(seed, next_sample_id), wave_scale, amplifier)
+                sample_params['seed'] = seed
+                if manifest is not None:
+                    manifest.recordSample(next_sample_id, image_path, sample_path, sample_params, sample_hash)
+                params['wave_scales'].append( sample_params['scale_coarse'] )
+                params['amplifiers'].append( sample_params['amplifier'] )
+                params['w_coarse'].append( sample_params['w_coarse'] )
+                params['w_fine'].append( sample_params['w_fine'] )
+                params['fine_scales'].append( sample_params['scale_fine'] )
+
+                jobs.submit(queue_dir, next_sample_id, dict(
+                    samples=[next_sample_id, next_sample_id],
+                    frames=[1, n_frames_per_sample],
+                    sample_dir=os.path.abspath(samples_dir),
+                    output_dir=os.path.abspath(output_dir),
+                    wave_scales=[sample_params['scale_coarse']],
+                    amplifiers=[sample_params['amplifier']],
+                    musgrave=[dict(w_coarse=sample_params['w_coarse'], w_fine=sample_params['w_fine'],
+                                   scale_fine=sample_params['scale_fine'])],
+                    seed=seed))
+                in_flight[jobs.job_name_format.format(next_sample_id)] = sample_path
+                timeline.instant('queued', sample=next_sample_id)
+                next_sample_id += 1
+
+            #   rendered samples are not needed anymore
+            for name in jobs.list_jobs(queue_dir, jobs.DONE):
+                job_name, _ = jobs.parse_name(name)
+                if job_name in in_flight:
+                    os.remove(in_flight.pop(job_name))
+
+            #   bound the number of samples waiting for a GPU by pausing the downloader
+            if downloading and os.name != 'nt':
+                n_waiting = len(jobs.list_jobs(queue_dir, jobs.PENDING))
+                if not paused and n_waiting >= max_buffered:
+                    os.killpg(downloader.pid, signal.SIGSTOP)
+                    paused = True
+                elif paused and n_waiting < max_buffered // 2:
+                    os.killpg(downloader.pid, signal.SIGCONT)
+                    paused = False
+
+            if next_sample_id == n_samples and downloading:
+                stopDownloader(downloader, paused)
+                timeline.complete('download', time.time() - t_download, 'process', classes=n_classes)
+            if next_sample_id == n_samples or not downloading:
                 break
-            n_samples_per_gpu[i] += 1
-            rem_n_samples -= 1
+            time.sleep(0.5)
 
-        #   launch separated processes for each GPU defined
-        logs = []
-        procs = []
-        args_list.extend( [ '--gpu_id', -1 ] )
-        args_list[12] = n_samples_per_gpu[-1] - 1
-        for i in range( num_gpus ):
-            args_list[-1] = used_gpus[i]
-            args = ' '.join(str(arg) for arg in args_list)
+    finally:
+        if downloader.poll() is None:
+            stopDownloader(downloader, paused)
+        jobs.close(queue_dir)
 
-            logs.append( open( os.path.join( BLENDER_ROOT, BLENDER_OUTPUT_REL_PATH, "render.log." + str(i + 1) ) , "w" ) )
+    print('All {} samples queued, waiting for the render workers'.format(next_sample_id))
+    with timeline.span('render_drain'):
+        render_thread.join()
 
-            procs.append( subprocess.Popen(args, shell=True, cwd=blender_root, stdout=logs[-1], stderr=sys.stderr) )
+    for sample_path in in_flight.values():
+        if os.path.exists(sample_path):
+            os.remove(sample_path)
 
-            args_list[11] = args_list[12] + 1
-            args_list[12] = args_list[11] + n_samples_per_gpu.pop() - 1
+    #   the outputs are recorded like those of a regular run, for the dataset reader and the packing
+    if manifest is not None:
+        for sample_id in range(next_sample_id):
+            manifest.recordOutputs(sample_id, output_dir, n_frames_per_sample)
+        manifest.markStage('prepare', next_sample_id == n_samples, samples=next_sample_id)
+        manifest.markStage('render', not pendingSamples(manifest, output_dir, next_sample_id, n_frames_per_sample))
 
-        #   synchronize all processes and close logging file descriptors
-        for i in range( num_gpus ):
-            procs[i].wait()
-            logs[i].close()
+    with open( os.path.join( BLENDER_ROOT, BLENDER_SAMPLE_PARAM_FILE_NAME ), "w" ) as param_fp:
+        json.dump( params, param_fp )
+
+    return next_sample_id
+
+def packOutputs(manifest, output_dir, n_samples, n_frames_per_sample, shard_size, shard_writers):
+    shard_dir = os.path.join(BLENDER_ROOT, BLENDER_SHARDS_REL_PATH)
+    sample_params = { sample_id: dict(entry['params'], source=entry['source'], hash=entry['hash'])
+                      for sample_id, entry in manifest.data['samples'].items() }
+    with timeline.span('pack', samples=n_samples):
+        shards.packShards(output_dir, shard_dir, n_samples, n_frames_per_sample, sample_params,
+                shard_size, shard_writers)
+    manifest.markStage('pack', shard_dir=shard_dir, shard_size=shard_size)
+    cleanUp([os.path.join(output_dir, 'distorted'), os.path.join(output_dir, 'undistorted')])
+
+def joinQueue(blender_root, rel_queue_dir, used_gpus, max_samples, max_memory, undistorted='render',
+        cpu_workers=0, threads_per_worker=0, lease=0, persistent_data=False, generation=''):
+    #   render the jobs a coordinator on another node publishes to a shared queue directory
+    #   either the given generation, or the first one that still has work : a closed generation without
+    #   jobs is what a previous run left, the coordinator of the next run publishes a new one
+    q_root = os.path.join(blender_root, rel_queue_dir)
+    print('Waiting for jobs in {}'.format(q_root))
+    while True:
+        current = generation if generation else jobs.current_generation(q_root)
+        if current is not None and os.path.isdir(os.path.join(q_root, current, jobs.PENDING)):
+            if generation or not jobs.is_finished(os.path.join(q_root, current)):
+                break
+        time.sleep(5)
+    print('Joining generation {}'.format(current))
+    rel_queue_dir = os.path.join(rel_queue_dir, current)
+    #   logs are named after the node, in case blender/output is shared too
+    launchWorkers(blender_root, rel_queue_dir, used_gpus, max_samples, max_memory, undistorted,
+            wait=True, cpu_workers=cpu_workers, threads_per_worker=threads_per_worker, lease=lease,
+            log_name='render.' + jobs.sanitize_worker_id(socket.gethostname()), persistent_data=persistent_data)
+
+def startTrace(trace_path):
+    #   every process started from now on appends its events next to the merged trace
+    trace_dir = os.path.splitext(trace_path)[0] + '.events'
+    shutil.rmtree(trace_dir, ignore_errors=True)
+    timeline.enable(trace_dir)
+    timeline.init('run.py')
+    atexit.register(mergeTrace, trace_dir, trace_path)
+
+def mergeTrace(trace_dir, trace_path):
+    n_events = timeline.merge(trace_dir, trace_path)
+    print('Trace of {} events written to {} (open it in chrome://tracing or ui.perfetto.dev)'.format(n_events, trace_path))
 
 def cleanUp(dirs):
     for d in dirs:
+        if not os.path.exists(d):
+            continue
         if os.name == 'nt':
             subprocess.call('rmdir /s /q {}'.format(d), shell=True)
         else:
@@ -138,9 +780,90 @@ if __name__ == "__main__":
     parser.add_argument('--gpus', default = [], type=int, nargs='+', 
         help='''identify gpu index (CUDA) used to render the distortion (ex. --gpus 0 1 2). 
                     use \'nvidia-smi\' to list all available gpu indices in the current system.''')
+    parser.add_argument('--backend', default = 'blender', choices=['blender', 'numpy'],
+        help='''renderer producing the distorted images. \'numpy\' approximates water_noise.blend
+                    on CPU without launching Blender.''')
+    parser.add_argument('--numpy_workers', default = 0, type=int,
+        help='number of processes used by the numpy backend, default is one per core.')
+    parser.add_argument('--numpy_calibrate', action='store_true',
+        help='''render the first sample with Blender before using the numpy backend, and fit the backend to it
+                    (resolution of the scene, texture fit, tone curve, water depth). the calibration is saved in
+                    {} and reused by later runs.'''.format(NUMPY_CALIBRATION_PATH))
+    parser.add_argument('--numpy_resolution', default = None, type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+        help='resolution of the numpy backend frames, default is the calibrated one.')
+    parser.add_argument('--persistent_workers', action='store_true',
+        help='''keep Blender running between samples, workers take samples from a job queue
+                    instead of being launched with a fixed sample range.''')
+    parser.add_argument('--batch_size', default = 1, type=int,
+        help='''number of samples per job taken from the queue when rendering on several GPUs
+                    (or with --persistent_workers). small batches balance the load between devices.''')
+    parser.add_argument('--frames_per_job', default = -1, type=int,
+        help='''split the frames of each sample into jobs of this many frames, so that few samples
+                    with many frames still keep every GPU busy. 0 disables the split, default
+                    splits automatically when there are fewer sample batches than GPUs.''')
+    parser.add_argument('--worker_max_samples', default = 0, type=int,
+        help='restart a persistent worker after rendering this many samples, 0 means never.')
+    parser.add_argument('--worker_max_memory', default = 0.0, type=float,
+        help='restart a persistent worker once it uses this many MB of memory, 0 means never.')
+    parser.add_argument('--analytic_undistorted', action='store_true',
+        help='''compute the undistorted targets by projecting the sample image through a cached
+                    camera map instead of rendering them with Cycles. the map is first calibrated against one
+                    Cycles render and refused (targets are rendered) if they do not agree.''')
+    parser.add_argument('--texture_size', default = BLENDER_TEXTURE_SIZE, type=int,
+        help='''longest side of the sample textures given to Blender, larger images are downscaled
+                    while being prepared.''')
+    parser.add_argument('--prepare_workers', default = 0, type=int,
+        help='number of processes preparing the samples, default is one per core.')
+    parser.add_argument('--streaming', action='store_true',
+        help='''overlap downloading, preparation and rendering: every downloaded image is prepared and
+                    queued for rendering right away, and deleted once consumed (no resume).''')
+    parser.add_argument('--stream_buffer', default = 16, type=int,
+        help='with --streaming, pause the downloader while this many samples wait for a GPU.')
+    parser.add_argument('--restart', action='store_true',
+        help='ignore the manifest of a previous run and start from scratch.')
+    parser.add_argument('--dedup_db', default = DEDUP_DB_PATH, type=str,
+        help='''content hash database shared by the downloader and the sample preparation, images whose
+                    content is already known (from any class or run) are skipped. empty string disables it.''')
+    parser.add_argument('--output_format', default = 'files', choices=['files', 'shards'],
+        help='''files keeps one JPEG per frame in blender/output, shards packs every sample (frames, target and
+                    parameters) into tar shards with an index in blender/shards once rendering is complete.''')
+    parser.add_argument('--shard_size', default = 1000, type=int,
+        help='number of samples per shard.')
+    parser.add_argument('--shard_writers', default = 0, type=int,
+        help='number of processes writing shards concurrently, default is one per core.')
+    parser.add_argument('--seed', default = None, type=int,
+        help='''run seed, the parameters of every sample only depend on it and on the sample id. default is
+                    the seed of the run being resumed, or a new random one (recorded in the manifest).''')
+    parser.add_argument('--dedup_distance', default = -1, type=int,
+        help='also skip images whose perceptual hash differs by at most this many bits, -1 disables it.')
+    parser.add_argument('--cpu_workers', default = 0, type=int,
+        help='''render on CPU only with this many Blender workers pulling jobs from the queue, for nodes without GPU.
+                    each worker is pinned to its own cores, several small processes usually beat a single one.''')
+    parser.add_argument('--threads_per_worker', default = 0, type=int,
+        help='with --cpu_workers, render threads (and cores) of every worker, default splits the cores evenly.')
+    parser.add_argument('--queue_dir', default = BLENDER_QUEUE_REL_PATH, type=str,
+        help='''job queue directory, relative to blender/. to render on several nodes, use a directory shared
+                    by all of them (mounted at the same path, as are blender/samples and blender/output).''')
+    parser.add_argument('--lease', default = 0, type=int,
+        help='''seconds a worker may go without rendering a frame before its job is re-queued for another worker,
+                    on any node. needed when workers of other nodes take jobs, 0 disables it (single node).''')
+    parser.add_argument('--join', action='store_true',
+        help='''only render: take the jobs published to --queue_dir by a run.py on another node, until that run
+                    closes the queue and no job is left. use the same --lease and render options on every node.''')
+    parser.add_argument('--generation', default = '', type=str,
+        help='''with --join, take the jobs of this generation of the queue ( printed by the run that published them )
+                    instead of the first generation that still has jobs.''')
+    parser.add_argument('--no_local_workers', action='store_true',
+        help='publish the jobs to --queue_dir and wait for workers of other nodes without rendering on this one.')
+    parser.add_argument('--persistent_data', action='store_true',
+        help='''keep the Blender render data (scene, BVH, kernels) between frames and samples, only the texture and
+                    the material inputs are updated. see main_render.py --benchmark_persistent for the gain.''')
+    parser.add_argument('--trace', default = '', type=str,
+        help='''write a timeline of every stage and subprocess (downloader, preparation, Blender workers, packing)
+                    with begin/end events per process, device and sample to this Chrome trace JSON file.''')
     args = parser.parse_known_args()[0]
 
-    if args.total_images <= 0 and args.number_of_classes <= 0:
+    if args.total_images <= 0 and args.number_of_classes <= 0 and not args.join:
         print("either --total_images or --number_of_classes must be specified")
         exit()
 
@@ -154,29 +877,172 @@ if __name__ == "__main__":
     else:
         args.total_images = args.number_of_classes * args.images_per_class
 
+    if args.batch_size <= 0:
+        print("--batch_size must be positive")
+        exit()
+
+    if args.shard_size <= 0:
+        print("--shard_size must be positive")
+        exit()
+
     for gpu in args.gpus:
         if gpu < 0:
             print("--gpus specified invalid GPU index")
             exit()
 
-    downloadClasses(
-            DOWNLOADER_PATH,
-            args.number_of_classes,
-            args.images_per_class,
-            DOWNLOADS_ROOT)
-    prepareBlenderData(
-            DOWNLOADS_PATH,
-            BLENDER_SAMPLES_PATH,
-            args.total_images,
-            args.images_per_class,
-            args.wave_scale,
-            args.amplifier)
-    generateDistortedImages(
-            BLENDER_ROOT,
-            BLENDER_SAMPLES_REL_PATH,
-            BLENDER_OUTPUT_REL_PATH,
-            args.total_images,
-            args.frames_per_image,
-            args.gpus)
-
-    cleanUp([DOWNLOADS_PATH, BLENDER_SAMPLES_PATH])
+    if args.cpu_workers < 0 or args.threads_per_worker < 0:
+        print("--cpu_workers and --threads_per_worker must not be negative")
+        exit()
+
+    if args.cpu_workers > 0 and args.gpus:
+        print("--cpu_workers and --gpus cannot be used together")
+        exit()
+
+    if args.lease < 0:
+        print("--lease must not be negative")
+        exit()
+
+    if args.no_local_workers and args.lease <= 0:
+        print("--no_local_workers needs a --lease, so that the jobs of failed remote workers are taken again")
+        exit()
+
+    if len(args.trace) > 0:
+        startTrace(args.trace)
+
+    if args.join:
+        joinQueue(
+                BLENDER_ROOT,
+                args.queue_dir,
+                args.gpus,
+                args.worker_max_samples,
+                args.worker_max_memory,
+                'analytic' if args.analytic_undistorted else 'render',
+                args.cpu_workers,
+                args.threads_per_worker,
+                args.lease,
+                args.persistent_data,
+                args.generation)
+        exit()
+
+    if args.streaming:
+        #   a streamed run does not resume, its manifest only describes what it produced
+        if os.path.exists(MANIFEST_PATH):
+            os.remove(MANIFEST_PATH)
+        manifest = Manifest(MANIFEST_PATH)
+        output_dir = os.path.join(BLENDER_ROOT, BLENDER_OUTPUT_REL_PATH)
+        n_streamed = streamImages(
+                args.number_of_classes,
+                args.images_per_class,
+                args.total_images,
+                args.frames_per_image,
+                args.wave_scale,
+                args.amplifier,
+                args.gpus,
+                'analytic' if args.analytic_undistorted else 'render',
+                args.stream_buffer,
+                args.texture_size,
+                args.dedup_db,
+                args.dedup_distance,
+                manifest.seed(args.seed),
+                args.cpu_workers,
+                args.threads_per_worker,
+                args.persistent_data,
+                manifest)
+        if args.output_format == 'shards':
+            if manifest.stageDone('render'):
+                packOutputs(manifest, output_dir, n_streamed, args.frames_per_image, args.shard_size, args.shard_writers)
+            else:
+                print('Some streamed samples were not rendered completely, outputs left unpacked in {}'.format(output_dir))
+        cleanUp([DOWNLOADS_PATH, BLENDER_SAMPLES_PATH])
+        exit()
+
+    #   every stage skips what an earlier, interrupted run already did
+    if args.restart and os.path.exists(MANIFEST_PATH):
+        os.remove(MANIFEST_PATH)
+    manifest = Manifest(MANIFEST_PATH)
+    seed = manifest.seed(args.seed)
+    output_dir = os.path.join(BLENDER_ROOT, BLENDER_OUTPUT_REL_PATH)
+
+    if not manifest.stageDone('prepare'):
+        n_missing_classes = args.number_of_classes - countDownloadedClasses(DOWNLOADS_PATH, args.images_per_class)
+        if n_missing_classes > 0:
+            downloadClasses(
+                    DOWNLOADER_PATH,
+                    n_missing_classes,
+                    args.images_per_class,
+                    DOWNLOADS_ROOT,
+                    args.dedup_db,
+                    args.dedup_distance)
+        manifest.markStage('download')
+
+        n_prepared = prepareBlenderData(
+                DOWNLOADS_PATH,
+                BLENDER_SAMPLES_PATH,
+                args.total_images,
+                args.images_per_class,
+                args.wave_scale,
+                args.amplifier,
+                manifest,
+                args.texture_size,
+                args.prepare_workers,
+                ContentStore(args.dedup_db, args.dedup_distance) if len(args.dedup_db) > 0 else None,
+                seed)
+        manifest.markStage('prepare', n_prepared == args.total_images, samples=n_prepared)
+
+    #   once packed, the loose outputs are gone and nothing needs rendering
+    packed = manifest.stageDone('pack')
+    todo = {} if packed else pendingSamples(manifest, output_dir, args.total_images, args.frames_per_image)
+    print('{} of {} samples need rendering'.format(len(todo), args.total_images))
+
+    if todo:
+        with timeline.span('render', samples=len(todo)):
+            if args.backend == 'numpy':
+                if args.numpy_calibrate:
+                    calibrateNumpy(BLENDER_ROOT, BLENDER_SAMPLES_REL_PATH, args.gpus, NUMPY_CALIBRATION_PATH)
+                generateDistortedImagesNumpy(
+                        BLENDER_ROOT,
+                        BLENDER_SAMPLES_REL_PATH,
+                        BLENDER_OUTPUT_REL_PATH,
+                        args.total_images,
+                        args.frames_per_image,
+                        args.numpy_workers,
+                        todo,
+                        loadNumpyCalibration(NUMPY_CALIBRATION_PATH, args.numpy_resolution))
+            else:
+                generateDistortedImages(
+                        BLENDER_ROOT,
+                        BLENDER_SAMPLES_REL_PATH,
+                        BLENDER_OUTPUT_REL_PATH,
+                        args.total_images,
+                        args.frames_per_image,
+                        args.gpus,
+                        'analytic' if args.analytic_undistorted else 'render',
+                        args.persistent_workers,
+                        args.batch_size,
+                        args.worker_max_samples,
+                        args.worker_max_memory,
+                        args.frames_per_job,
+                        todo,
+                        args.cpu_workers,
+                        args.threads_per_worker,
+                        args.queue_dir,
+                        args.lease,
+                        not args.no_local_workers,
+                        args.persistent_data)
+
+    if not packed:
+        for sample_id in range(args.total_images):
+            manifest.recordOutputs(sample_id, output_dir, args.frames_per_image)
+        todo = pendingSamples(manifest, output_dir, args.total_images, args.frames_per_image)
+        manifest.markStage('render', not todo)
+
+    if args.output_format == 'shards' and not packed and manifest.stageDone('prepare') and not todo:
+        packOutputs(manifest, output_dir, args.total_images, args.frames_per_image, args.shard_size, args.shard_writers)
+
+    #   inputs are only removed once every sample is complete, a rerun needs them otherwise
+    if manifest.stageDone('prepare') and not todo:
+        cleanUp([DOWNLOADS_PATH, BLENDER_SAMPLES_PATH])
+    else:
+        n_unprepared = args.total_images - len(manifest.data['samples'])
+        print('{} samples incomplete, {} not prepared, run again with the same arguments to resume'.format(
+            len(todo), n_unprepared))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+#   Packing of the rendered samples into sharded tar archives ( WebDataset layout ).
+#   Every sample becomes the members
+#       <key>.undistorted.jpg, <key>.distorted.<frame>.jpg, <key>.params.json
+#   where key is the zero padded sample id. Archives are not compressed, so that a member
+#   can be read straight from its byte offset, which index.json records for every sample.
+
+import os
+import io
+import json
+import tarfile
+from multiprocessing import Pool
+
+import manifest as manifest_module
+
+SHARD_INDEX_VERSION = 1
+SHARD_INDEX_NAME = 'index.json'
+SHARD_NAME_FORMAT = 'shard-{:05d}.tar'
+SAMPLE_KEY_FORMAT = '{:06d}'
+FRAME_NAME_FORMAT = 'distorted.{:04d}.jpg'
+UNDISTORTED_NAME = 'undistorted.jpg'
+PARAMS_NAME = 'params.json'
+
+def sampleMembers(output_dir, sample_id, n_frames):
+    '''( member name, path ) of the rendered files of a sample'''
+    undistorted, frames = manifest_module.outputPaths(output_dir, sample_id, n_frames)
+    key = SAMPLE_KEY_FORMAT.format(sample_id)
+    members = [ (key + '.' + UNDISTORTED_NAME, undistorted) ]
+    members += [ (key + '.' + FRAME_NAME_FORMAT.format(f), path) for f, path in sorted(frames.items()) ]
+    return members
+
+def writeShard(job):
+    '''write the samples of one shard, returns ( shard name, { sample id: { member: [offset, size] } } )'''
+    shard_dir, shard_idx, output_dir, sample_ids, n_frames, params = job
+    shard_name = SHARD_NAME_FORMAT.format(shard_idx)
+    shard_path = os.path.join(shard_dir, shard_name)
+
+    #   written under a temporary name, a shard is either complete or absent
+    with tarfile.open(shard_path + '.part', 'w', format=tarfile.GNU_FORMAT) as tar:
+        for sample_id in sample_ids:
+            for name, path in sampleMembers(output_dir, sample_id, n_frames):
+                tar.add(path, arcname=name)
+
+            content = json.dumps(params.get(str(sample_id), {})).encode('utf-8')
+            info = tarfile.TarInfo(SAMPLE_KEY_FORMAT.format(sample_id) + '.' + PARAMS_NAME)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    os.replace(shard_path + '.part', shard_path)
+
+    #   member offsets are only known once the headers are written
+    index = {}
+    with tarfile.open(shard_path, 'r') as tar:
+        for info in tar.getmembers():
+            key, member = info.name.split('.', 1)
+            index.setdefault(str(int(key)), {})[member] = [info.offset_data, info.size]
+    return shard_name, index
+
+def packShards(output_dir, shard_dir, n_samples, n_frames, params, shard_size=1000, n_writers=0):
+    '''pack the rendered samples into shards of shard_size samples, one writer process per shard at a time'''
+    os.makedirs(shard_dir, exist_ok=True)
+
+    shard_jobs = []
+    for shard_idx, first in enumerate(range(0, n_samples, shard_size)):
+        sample_ids = list(range(first, min(first + shard_size, n_samples)))
+        shard_jobs.append((shard_dir, shard_idx, output_dir, sample_ids, n_frames,
+                           { str(s): params.get(str(s), {}) for s in sample_ids }))
+
+    index = dict(version=SHARD_INDEX_VERSION, n_frames=n_frames, shards=[], samples={})
+    with Pool(processes=n_writers if n_writers > 0 else None) as p:
+        for shard_name, shard_index in p.imap(writeShard, shard_jobs):
+            shard = len(index['shards'])
+            index['shards'].append(shard_name)
+            for sample_id, members in shard_index.items():
+                index['samples'][sample_id] = dict(shard=shard, members=members)
+
+    index_path = os.path.join(shard_dir, SHARD_INDEX_NAME)
+    with open(index_path + '.tmp', 'w') as fp:
+        json.dump(index, fp)
+    os.replace(index_path + '.tmp', index_path)
+
+    print('Packed {} samples into {} shards in {}'.format(n_samples, len(index['shards']), shard_dir))
+    return index